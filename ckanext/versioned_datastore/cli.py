@@ -5,9 +5,17 @@ from ckan.plugins import toolkit
 from ckantools.cache import CacheClearError, clear_cache_region
 
 from ckanext.versioned_datastore.lib import utils
+from ckanext.versioned_datastore.lib.downloads import eviction
+from ckanext.versioned_datastore.lib.query.schema import get_schema
+from ckanext.versioned_datastore.lib.query.schemas.v1_0_0 import (
+    get_named_area_index,
+    get_named_area_tolerance,
+    v1_0_0Schema,
+)
 from ckanext.versioned_datastore.model.details import datastore_resource_details_table
 from ckanext.versioned_datastore.model.downloads import (
     datastore_downloads_core_files_table,
+    datastore_downloads_core_resources_table,
     datastore_downloads_derivative_files_table,
     datastore_downloads_requests_table,
 )
@@ -41,6 +49,7 @@ def init_db():
         datastore_slugs_table,
         navigational_slugs_table,
         datastore_downloads_core_files_table,
+        datastore_downloads_core_resources_table,
         datastore_downloads_derivative_files_table,
         datastore_downloads_requests_table,
     ]
@@ -110,3 +119,64 @@ def clear_cache():
         click.secho('Cleared vds cache', fg='green')
     except CacheClearError as e:
         click.secho(f'Failed to clear vds cache: {e}', fg='red')
+
+
+@versioned_datastore.command(name='index-named-areas')
+def index_named_areas():
+    """
+    Load the named area shapes used by geo_named_area queries into the index set in the
+    ckanext.versioned_datastore.named_area_index config option.
+    """
+    index = get_named_area_index()
+    if index is None:
+        click.secho(
+            'ckanext.versioned_datastore.named_area_index must be set', fg='red'
+        )
+        raise click.Abort()
+
+    schema = get_schema(v1_0_0Schema.version)
+    indexed, failed = schema.index_named_areas(
+        utils.es_client(), index, get_named_area_tolerance()
+    )
+    click.secho(f'Indexed {indexed} named areas into {index}', fg='green')
+    if failed:
+        click.secho(f'Failed to index {failed} named areas', fg='red')
+
+
+@versioned_datastore.command(name='evict-downloads')
+@click.option(
+    '--budget',
+    type=int,
+    help='The disk budget in bytes, defaults to the download_disk_budget option',
+)
+@click.option(
+    '--policy',
+    type=click.Choice(eviction.POLICIES),
+    help='Whether to evict the least recently (lru) or least frequently (lfu) used '
+    'files first, defaults to the download_eviction_policy option',
+)
+@click.option(
+    '--dry-run',
+    is_flag=True,
+    default=False,
+    help='List the files which would be evicted without evicting them',
+)
+def evict_downloads(budget: int = None, policy: str = None, dry_run: bool = False):
+    """
+    Evict the least used core and derivative download files until the download
+    directory is within the disk budget.
+    """
+    if budget is None and eviction.get_budget() is None:
+        click.secho(
+            'ckanext.versioned_datastore.download_disk_budget must be set or a budget '
+            'given',
+            fg='red',
+        )
+        raise click.Abort()
+
+    evicted = eviction.collect(budget=budget, policy=policy, dry_run=dry_run)
+    for cached_file in evicted:
+        click.echo(f'{cached_file.path} ({cached_file.size} bytes)')
+    freed = sum(cached_file.size for cached_file in evicted)
+    verb = 'Would evict' if dry_run else 'Evicted'
+    click.secho(f'{verb} {len(evicted)} files, freeing {freed} bytes', fg='green')
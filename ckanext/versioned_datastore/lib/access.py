@@ -0,0 +1,105 @@
+import logging
+import threading
+from typing import Callable, Dict, Hashable, Optional
+
+from cachetools import TTLCache
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+# the redis key used to store the access generation, this is shared between all web and
+# worker processes and is incremented whenever a change is made which could alter the
+# resources available to a user
+GENERATION_KEY = 'ckanext.versioned_datastore.access_generation'
+
+# the cache is created on first use so that the config is available when it is sized
+_cache: Optional[TTLCache] = None
+# cachetools caches aren't thread safe
+_lock = threading.Lock()
+
+
+def get_cache_size() -> int:
+    """
+    Returns the maximum number of users to hold resource access information for in this
+    process. If this is 0, which is the default, access caching is disabled.
+
+    :returns: the cache size
+    """
+    return int(
+        toolkit.config.get('ckanext.versioned_datastore.access_cache_size', 0) or 0
+    )
+
+
+def get_cache_ttl() -> int:
+    """
+    Returns the number of seconds resource access information is cached for. Changes to
+    packages and resources invalidate the cache straight away, but changes to user
+    memberships don't, so this is the maximum time these take to be reflected.
+
+    :returns: the ttl in seconds
+    """
+    return int(toolkit.config.get('ckanext.versioned_datastore.access_cache_ttl', 60))
+
+
+def get_cache() -> TTLCache:
+    """
+    Retrieves the access cache, creating it if necessary.
+
+    :returns: the TTL cache
+    """
+    global _cache
+    if _cache is None:
+        _cache = TTLCache(maxsize=get_cache_size(), ttl=get_cache_ttl())
+    return _cache
+
+
+def get_generation() -> Optional[int]:
+    """
+    :returns: the current access generation, or None if there isn't one yet
+    """
+    value = connect_to_redis().get(GENERATION_KEY)
+    return int(value) if value is not None else None
+
+
+def invalidate():
+    """
+    Invalidates the cached resource access information in all processes.
+    """
+    try:
+        connect_to_redis().incr(GENERATION_KEY)
+    except Exception as e:
+        log.warning(f'Failed to update access generation: {e}')
+    # clear this process's cache regardless, just in case redis is unavailable
+    with _lock:
+        get_cache().clear()
+
+
+def get_cached(key: Hashable, load: Callable[[], Dict[str, bool]]) -> Dict[str, bool]:
+    """
+    Returns the resource access information for the given key from the cache if
+    available, otherwise calls load and caches the result.
+
+    :param key: the key identifying the user the information is for
+    :param load: a function which returns a dict of available resource IDs -> whether
+        they are datastore active
+    :returns: a dict of available resource IDs -> whether they are datastore active
+    """
+    if get_cache_size() <= 0:
+        return load()
+
+    try:
+        generation = get_generation()
+    except Exception as e:
+        log.warning(f'Failed to retrieve access generation, not caching: {e}')
+        return load()
+
+    cache = get_cache()
+    cache_key = (key, generation)
+    with _lock:
+        access = cache.get(cache_key)
+    if access is None:
+        access = load()
+        with _lock:
+            cache[cache_key] = access
+    return access
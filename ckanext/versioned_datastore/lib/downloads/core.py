@@ -0,0 +1,709 @@
+import io
+import multiprocessing
+import os
+import pickle
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import fastavro
+from ckan.plugins import get_plugin, toolkit
+from elasticsearch import NotFoundError
+from elasticsearch_dsl import MultiSearch, Search
+from fastavro.write import Writer
+from splitgill.indexing.fields import DocumentField
+from splitgill.search import rebuild_data
+
+from ckanext.versioned_datastore.lib.downloads.utils import RecordStats
+from ckanext.versioned_datastore.lib.query.search.routing import get_version_indexes
+from ckanext.versioned_datastore.lib.utils import es_client, get_database
+
+
+@dataclass
+class WriterOptions:
+    """
+    Options controlling how core avro files are written.
+    """
+
+    # the avro codec to compress blocks with
+    codec: str = 'deflate'
+    # the compression level to use with the codec, None means the codec's default
+    codec_level: Optional[int] = None
+    # the maximum number of records to write in each block
+    block_size: int = 10000
+    # the maximum number of uncompressed bytes to write in each block
+    sync_interval: int = 1024 * 1024
+
+    @classmethod
+    def create(cls, overrides: Optional[dict] = None) -> 'WriterOptions':
+        """
+        Creates a WriterOptions object using the values in the config, updated with the
+        given overrides. If any of the options are invalid, a ValueError is raised.
+
+        :param overrides: a dict of option names -> values to use instead of the
+            config values
+        :returns: a WriterOptions object
+        """
+        values = {}
+        for option in fields(cls):
+            value = toolkit.config.get(
+                f'ckanext.versioned_datastore.download_{option.name}'
+            )
+            if value is not None:
+                values[option.name] = value
+        unknown = set(overrides or {}).difference(option.name for option in fields(cls))
+        if unknown:
+            raise ValueError(f'Unknown core options: {", ".join(sorted(unknown))}')
+        values.update(overrides or {})
+
+        options = cls(
+            codec=str(values.get('codec', cls.codec)),
+            codec_level=(
+                int(values['codec_level'])
+                if values.get('codec_level') not in (None, '')
+                else None
+            ),
+            block_size=int(values.get('block_size', cls.block_size)),
+            sync_interval=int(values.get('sync_interval', cls.sync_interval)),
+        )
+        if options.block_size < 1 or options.sync_interval < 1:
+            raise ValueError('The block size and sync interval must be at least 1')
+        # check the codec is supported and that any library it needs is installed
+        writer = Writer(io.BytesIO(), CHECK_SCHEMA, **options.writer_kwargs())
+        writer.write({})
+        writer.flush()
+        return options
+
+    def writer_kwargs(self) -> dict:
+        """
+        :returns: the keyword arguments to pass to a fastavro writer
+        """
+        return dict(
+            codec=self.codec,
+            compression_level=self.codec_level,
+            sync_interval=self.sync_interval,
+        )
+
+
+# the maximum number of records Elasticsearch will return in one request by default
+MAX_PAGE_SIZE = 10000
+
+# how long the point in time used to page through a resource's records is kept open
+# between requests. Interrupted core files which aren't resumed within this time have to
+# be generated from the start again
+PIT_KEEP_ALIVE = '1h'
+
+# an empty schema used to check codecs are available
+CHECK_SCHEMA = {'type': 'record', 'name': 'Check', 'fields': []}
+
+
+@dataclass
+class CoreFile:
+    """
+    A core avro file to be generated for a resource.
+    """
+
+    resource_id: str
+    version: int
+    # the path of the core file
+    path: str
+    # the avro schema of the records in the file, this is set after the scan when the
+    # file is generated in a single pass
+    schema: Optional[dict]
+    # how the file should be written
+    options: WriterOptions = field(default_factory=WriterOptions)
+    # the number of records written, set once the file has been generated
+    total: int = 0
+    # the field counts of the records written, set once the file has been generated in
+    # a single pass
+    field_counts: Optional[Dict[str, int]] = None
+    # the last checkpoint saved while generating the file, if there is one generation
+    # will resume from it
+    checkpoint: Optional[dict] = None
+
+    def slice_path(self, directory: str, slice_id: int) -> str:
+        """
+        Returns the path of the avro file for the given slice of this core file.
+
+        :param directory: the directory to put the slice files in
+        :param slice_id: the slice ID
+        :returns: the path
+        """
+        name = os.path.basename(self.path)
+        return os.path.join(directory, f'{name}.{slice_id}')
+
+
+def get_slice_count() -> int:
+    """
+    Returns the number of slices to split the scroll over each resource into when
+    generating core files. Each slice is read and written by a separate process and then
+    the slices are merged into the core file. If this is 1, slicing is disabled.
+
+    :returns: the number of slices
+    """
+    return int(
+        toolkit.config.get('ckanext.versioned_datastore.download_slices', 1) or 1
+    )
+
+
+def get_resource_workers() -> int:
+    """
+    Returns the maximum number of resources to generate core files for at the same time.
+
+    :returns: the number of resources
+    """
+    return int(
+        toolkit.config.get('ckanext.versioned_datastore.download_resource_workers', 1)
+        or 1
+    )
+
+
+def is_single_pass() -> bool:
+    """
+    Returns whether core files should be generated in a single pass, working out the
+    field counts and Avro schema from the records as they are scanned instead of
+    running separate aggregations over the records first.
+
+    :returns: True if single pass generation is enabled, False if not
+    """
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.versioned_datastore.download_single_pass', False)
+    )
+
+
+def should_split_jobs() -> bool:
+    """
+    Returns whether downloads with more than one datastore resource should be split
+    into a separate job for each resource's core file, followed by a job which
+    generates the derivative from them.
+
+    :returns: True if downloads should be split into multiple jobs, False if not
+    """
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.versioned_datastore.download_split_jobs', False)
+    )
+
+
+def get_checkpoint_interval() -> int:
+    """
+    Returns the minimum number of records to write between each checkpoint when
+    generating a core file. The checkpoints allow the generation to be resumed from
+    where it got to if the download is interrupted. If this is 0, checkpoints are
+    disabled.
+
+    :returns: the number of records
+    """
+    return int(
+        toolkit.config.get(
+            'ckanext.versioned_datastore.download_checkpoint_interval', 0
+        )
+        or 0
+    )
+
+
+def _init_worker():
+    """
+    Sets up a core file generation worker process. The Elasticsearch and Mongo
+    connections created in the parent process can't be shared with the workers so new
+    clients are created.
+    """
+    get_plugin('versioned_datastore').create_clients(toolkit.config)
+
+
+def build_search(resource_id: str, version: int, query: dict) -> Search:
+    """
+    Creates a search over the records in the resource at the given version which match
+    the query.
+
+    :param resource_id: the resource ID
+    :param version: the version
+    :param query: the query DSL to filter the records by
+    :returns: a Search object
+    """
+    database = get_database(resource_id)
+    return (
+        database.search(version)
+        .index()
+        .index(get_version_indexes([resource_id], version))
+        .filter(query)
+    )
+
+
+def count_records(resource_id: str, version: int, query: dict) -> int:
+    """
+    Counts the records in the resource at the given version which match the query.
+
+    :param resource_id: the resource ID
+    :param version: the version
+    :param query: the query DSL to filter the records by
+    :returns: the number of records
+    """
+    return build_search(resource_id, version, query).count()
+
+
+def count_all_records(
+    resource_ids_and_versions: Dict[str, int], query: dict, timeout: float
+) -> int:
+    """
+    Counts the records matching the query in all the given resources at their versions.
+    The counts are made in a single multi search request so that they're bounded by a
+    single request timeout.
+
+    :param resource_ids_and_versions: a dict of resource IDs -> versions
+    :param query: the query DSL to filter the records by
+    :param timeout: the number of seconds to wait for the counts before giving up
+    :returns: the number of records
+    """
+    if not resource_ids_and_versions:
+        return 0
+    multi_search = MultiSearch(using=es_client().options(request_timeout=timeout))
+    for resource_id, version in resource_ids_and_versions.items():
+        search = build_search(resource_id, version, query)
+        multi_search = multi_search.add(search.extra(size=0, track_total_hits=True))
+    return sum(response.hits.total.value for response in multi_search.execute())
+
+
+def scan_records(
+    resource_id: str, version: int, query: dict, slice_id: int = 0, slices: int = 1
+) -> Iterable[dict]:
+    """
+    Scans the records in the resource at the given version which match the query and
+    yields their data. If there is more than one slice, only the records in the given
+    slice are yielded.
+
+    :param resource_id: the resource ID
+    :param version: the version
+    :param query: the query DSL to filter the records by
+    :param slice_id: the slice to scan
+    :param slices: the total number of slices
+    :returns: yields the data of each record
+    """
+    search = build_search(resource_id, version, query)
+    if slices > 1:
+        search = search.extra(slice={'id': slice_id, 'max': slices})
+    for hit in search.scan():
+        yield rebuild_data(hit.data.to_dict())
+
+
+def open_pit(resource_id: str, version: int) -> str:
+    """
+    Opens a point in time over the indexes holding the resource's records at the given
+    version so that they can be paged through without being affected by any changes
+    made to the indexes in the meantime.
+
+    :param resource_id: the resource ID
+    :param version: the version
+    :returns: the point in time's ID
+    """
+    return es_client().open_point_in_time(
+        index=get_version_indexes([resource_id], version), keep_alive=PIT_KEEP_ALIVE
+    )['id']
+
+
+def is_pit_open(pit: str) -> bool:
+    """
+    Checks whether the given point in time still exists, which also keeps it open for
+    another PIT_KEEP_ALIVE.
+
+    :param pit: the point in time's ID
+    :returns: True if it can still be used, False if it has expired
+    """
+    try:
+        es_client().search(pit={'id': pit, 'keep_alive': PIT_KEEP_ALIVE}, size=0)
+    except NotFoundError:
+        return False
+    return True
+
+
+def close_pit(pit: str):
+    """
+    Closes the given point in time, if it still exists.
+
+    :param pit: the point in time's ID
+    """
+    try:
+        es_client().close_point_in_time(id=pit)
+    except NotFoundError:
+        pass
+
+
+def page_records(
+    resource_id: str,
+    version: int,
+    query: dict,
+    pit: str,
+    after: Optional[list] = None,
+    page_size: int = MAX_PAGE_SIZE,
+) -> Iterable[Tuple[dict, list, str]]:
+    """
+    Pages through the records in the resource at the given version which match the
+    query in ID order using the given point in time and yields their data along with
+    their sort values. Unlike a scroll, the sort values can be used to carry on from a
+    record at any point later, as long as the point in time is still open.
+
+    :param resource_id: the resource ID
+    :param version: the version
+    :param query: the query DSL to filter the records by
+    :param pit: the ID of a point in time opened with open_pit
+    :param after: the sort values of the record to start after, if None, start from the
+        first record
+    :param page_size: the number of records to retrieve in each request
+    :returns: yields 3-tuples of each record's data, its sort values and the latest
+        point in time ID, which should be used if the paging is carried on later
+    """
+    search = (
+        build_search(resource_id, version, query)
+        # searches using a point in time can't specify the indexes
+        .index()
+        # the shard doc tiebreaker makes sure the sort values are unique
+        .sort({DocumentField.ID: 'asc'}, {'_shard_doc': 'asc'})
+        .extra(size=page_size, track_total_hits=False)
+    )
+    while True:
+        page = search.extra(pit={'id': pit, 'keep_alive': PIT_KEEP_ALIVE})
+        if after is not None:
+            page = page.extra(search_after=after)
+        response = page.execute()
+        # the point in time ID can change between requests
+        pit = response.pit_id
+        for hit in response.hits:
+            after = list(hit.meta.sort)
+            yield rebuild_data(hit.data.to_dict()), after, pit
+        if len(response.hits) < page_size:
+            break
+
+
+def get_resume_offset(core_file: CoreFile) -> Optional[int]:
+    """
+    Checks whether the core file can be resumed from its checkpoint and returns the
+    position in the file to resume from if it can. The checkpoint must be for the same
+    version, the file must end with the checkpoint's sync marker at the checkpoint's
+    offset, which means the checkpoint's block was completely written, and the point in
+    time the records were being paged through with must still be open so that the
+    remaining records come from the same view of the data.
+
+    :param core_file: the core file
+    :returns: the offset to truncate the file to and resume from, or None if the file
+        can't be resumed
+    """
+    checkpoint = core_file.checkpoint
+    if checkpoint is None or checkpoint['version'] != core_file.version:
+        return None
+    offset = checkpoint['offset']
+    sync_marker = bytes.fromhex(checkpoint['sync'])
+    try:
+        with open(core_file.path, 'rb') as f:
+            f.seek(offset - len(sync_marker))
+            if f.read(len(sync_marker)) != sync_marker:
+                return None
+    except (FileNotFoundError, OSError):
+        return None
+    if 'pit' not in checkpoint or not is_pit_open(checkpoint['pit']):
+        return None
+    return offset
+
+
+def write_resumable(
+    core_file: CoreFile,
+    query: dict,
+    on_checkpoint: Callable[[CoreFile, Optional[dict]], None],
+) -> int:
+    """
+    Writes the records in the resource which match the query to the core file, calling
+    on_checkpoint with a checkpoint after every few blocks. The checkpoint records where
+    the last complete block ended in the file, the sort values of its last record and
+    the point in time being paged through so that if the generation is interrupted, it
+    can resume from there instead of starting again. If the core file has a checkpoint,
+    the generation is resumed from it. Once the file is complete, on_checkpoint is
+    called with None.
+
+    :param core_file: the core file to write
+    :param query: the query DSL to filter the records by
+    :param on_checkpoint: a function which is called with the core file and a
+        checkpoint dict
+    :returns: the number of records in the core file
+    """
+    schema = fastavro.parse_schema(core_file.schema)
+    block_size = core_file.options.block_size
+    interval = get_checkpoint_interval()
+
+    offset = get_resume_offset(core_file)
+    if offset is None:
+        f = open(core_file.path, 'wb')
+        total = 0
+        after = None
+        pit = open_pit(core_file.resource_id, core_file.version)
+    else:
+        f = open(core_file.path, 'r+b')
+        # lose anything after the checkpoint's block
+        f.truncate(offset)
+        f.seek(offset)
+        total = core_file.checkpoint['records']
+        after = core_file.checkpoint['sort']
+        pit = core_file.checkpoint['pit']
+
+    with f:
+        # if the file is being resumed, the writer reads the header from the file and
+        # appends to it
+        writer = Writer(f, schema, **core_file.options.writer_kwargs())
+        last_checkpoint = total
+        for record, sort, pit in page_records(
+            core_file.resource_id,
+            core_file.version,
+            query,
+            pit,
+            after,
+            min(block_size, MAX_PAGE_SIZE),
+        ):
+            writer.write(record)
+            total += 1
+            if total % block_size == 0:
+                writer.flush()
+                if total - last_checkpoint >= interval:
+                    # make sure the block is actually on disk before it's recorded
+                    f.flush()
+                    os.fsync(f.fileno())
+                    on_checkpoint(
+                        core_file,
+                        {
+                            'version': core_file.version,
+                            'records': total,
+                            'sort': sort,
+                            'pit': pit,
+                            'offset': f.tell(),
+                            'sync': writer.sync_marker.hex(),
+                        },
+                    )
+                    last_checkpoint = total
+        writer.flush()
+
+    on_checkpoint(core_file, None)
+    close_pit(pit)
+    return total
+
+
+def write_slice(
+    core_file: CoreFile, query: dict, path: str, slice_id: int = 0, slices: int = 1
+) -> int:
+    """
+    Scans the records in the resource which match the query and writes them to the
+    given path as an avro file. If there is more than one slice, only the records in the
+    given slice are written.
+
+    :param core_file: the core file being generated
+    :param query: the query DSL to filter the records by
+    :param path: the path to write the avro file to
+    :param slice_id: the slice to write
+    :param slices: the total number of slices
+    :returns: the number of records written
+    """
+    schema = fastavro.parse_schema(core_file.schema)
+    block_size = core_file.options.block_size
+    total = 0
+    with open(path, 'wb') as f:
+        writer = Writer(f, schema, **core_file.options.writer_kwargs())
+        for record in scan_records(
+            core_file.resource_id, core_file.version, query, slice_id, slices
+        ):
+            writer.write(record)
+            total += 1
+            if total % block_size == 0:
+                # end the block, the writer also does this itself if the block gets
+                # bigger than the sync interval
+                writer.flush()
+        writer.flush()
+    return total
+
+
+def scan_slice(
+    core_file: CoreFile, query: dict, path: str, slice_id: int = 0, slices: int = 1
+) -> Tuple[int, RecordStats]:
+    """
+    Scans the records in the resource which match the query and writes them to the
+    given path as a series of pickled chunks, collecting the field counts and types of
+    the records as it goes. This is used when the core file's schema isn't known before
+    the scan. If there is more than one slice, only the records in the given slice are
+    written.
+
+    :param core_file: the core file being generated
+    :param query: the query DSL to filter the records by
+    :param path: the path to write the chunks to
+    :param slice_id: the slice to write
+    :param slices: the total number of slices
+    :returns: the number of records written and their stats
+    """
+    stats = RecordStats()
+    total = 0
+    chunk = []
+    with open(path, 'wb') as f:
+        for record in scan_records(
+            core_file.resource_id, core_file.version, query, slice_id, slices
+        ):
+            stats.add(record)
+            chunk.append(record)
+            total += 1
+            if len(chunk) == core_file.options.block_size:
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+                chunk = []
+        if chunk:
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return total, stats
+
+
+def merge_slices(core_file: CoreFile, paths: List[str]):
+    """
+    Merges the given slice avro files into the core file. The blocks in each slice file
+    are copied over whole so no records are decoded and encoded again.
+
+    :param core_file: the core file to write
+    :param paths: the paths of the slice files
+    """
+    schema = fastavro.parse_schema(core_file.schema)
+    with open(core_file.path, 'wb') as f:
+        writer = Writer(f, schema, **core_file.options.writer_kwargs())
+        for path in paths:
+            with open(path, 'rb') as slice_file:
+                for block in fastavro.block_reader(slice_file):
+                    writer.write_block(block)
+        writer.flush()
+    for path in paths:
+        os.remove(path)
+
+
+def write_chunks(core_file: CoreFile, paths: List[str]):
+    """
+    Writes the records in the given pickled chunk files created by scan_slice to the
+    core file. Each chunk is written as a single avro block.
+
+    :param core_file: the core file to write
+    :param paths: the paths of the chunk files
+    """
+    schema = fastavro.parse_schema(core_file.schema)
+    with open(core_file.path, 'wb') as f:
+        writer = Writer(f, schema, **core_file.options.writer_kwargs())
+        for path in paths:
+            with open(path, 'rb') as chunk_file:
+                while True:
+                    try:
+                        chunk = pickle.load(chunk_file)
+                    except EOFError:
+                        break
+                    for record in chunk:
+                        writer.write(record)
+                    writer.flush()
+        writer.flush()
+    for path in paths:
+        os.remove(path)
+
+
+def generate_core_files(
+    core_files: List[CoreFile],
+    query: dict,
+    temp_dir: str,
+    on_start: Callable[[CoreFile], None],
+    single_pass: bool = False,
+    on_checkpoint: Optional[Callable[[CoreFile, Optional[dict]], None]] = None,
+):
+    """
+    Generates the given core files and sets the total on each. If slicing or concurrent
+    resources are enabled, the scrolling and writing is done by a pool of processes,
+    otherwise each core file is generated one after the other in this process.
+
+    If single_pass is True, the core files' schemas don't need to be set as they are
+    worked out from the records during the scan, along with the field counts which are
+    also set on each core file. The records are written to temporary files during the
+    scan and then written to the core file once the schema is known.
+
+    :param core_files: the core files to generate
+    :param query: the query DSL to filter the records by
+    :param temp_dir: a directory to write the slice files to
+    :param on_start: a function which is called with each core file when its generation
+        starts
+    :param single_pass: whether to work out the schemas and field counts during the scan
+    :param on_checkpoint: a function which is called with a core file and a checkpoint
+        as it is generated, and then with None once it's complete. Checkpoints are only
+        made if they are enabled and the core files are generated one after the other
+        in this process without slicing or single pass
+    """
+    slices = get_slice_count()
+    workers = get_resource_workers()
+    task = scan_slice if single_pass else write_slice
+
+    def get_paths(core_file: CoreFile) -> List[str]:
+        if slices == 1 and not single_pass:
+            # write straight to the core file
+            return [core_file.path]
+        return [core_file.slice_path(temp_dir, slice_id) for slice_id in range(slices)]
+
+    def finish(core_file: CoreFile, paths: List[str], results: list):
+        if single_pass:
+            stats = RecordStats()
+            for _, slice_stats in results:
+                stats.update(slice_stats)
+            core_file.total = sum(count for count, _ in results)
+            core_file.schema = stats.schema()
+            core_file.field_counts = stats.field_counts()
+            write_chunks(core_file, paths)
+        else:
+            core_file.total = sum(results)
+            if slices > 1:
+                merge_slices(core_file, paths)
+
+    if slices == 1 and workers == 1:
+        resumable = (
+            on_checkpoint is not None
+            and not single_pass
+            and get_checkpoint_interval() > 0
+        )
+        for core_file in core_files:
+            on_start(core_file)
+            if resumable:
+                core_file.total = write_resumable(core_file, query, on_checkpoint)
+                continue
+            paths = get_paths(core_file)
+            finish(core_file, paths, [task(core_file, query, paths[0])])
+        return
+
+    # fork so that the workers inherit the loaded plugins and config
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(
+        max_workers=slices * workers, mp_context=context, initializer=_init_worker
+    ) as executor:
+        queue = deque(core_files)
+        # futures -> the core file they're writing a slice of
+        running = {}
+        # resource IDs -> the paths of their slice files
+        slice_paths = {}
+        # resource IDs -> the results of their completed slices
+        results = defaultdict(list)
+        while queue or running:
+            # start generating the next resources, up to the limit
+            while queue and len(slice_paths) < workers:
+                core_file = queue.popleft()
+                on_start(core_file)
+                paths = get_paths(core_file)
+                slice_paths[core_file.resource_id] = paths
+                for slice_id, path in enumerate(paths):
+                    future = executor.submit(
+                        task, core_file, query, path, slice_id, slices
+                    )
+                    running[future] = core_file
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                core_file = running.pop(future)
+                try:
+                    results[core_file.resource_id].append(future.result())
+                except Exception:
+                    # don't bother with the other slices if one has failed
+                    for other in running:
+                        other.cancel()
+                    raise
+                if core_file not in running.values():
+                    # all the slices for this resource have been written
+                    finish(
+                        core_file,
+                        slice_paths.pop(core_file.resource_id),
+                        results.pop(core_file.resource_id),
+                    )
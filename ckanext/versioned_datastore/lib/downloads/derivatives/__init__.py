@@ -1,9 +1,15 @@
 from .csv import CsvDerivativeGenerator
 from .dwc import DwcDerivativeGenerator
 from .json import JsonDerivativeGenerator
+from .jsonl import JsonLinesDerivativeGenerator
+from .parquet import ParquetDerivativeGenerator
+from .xlsx import XlsxDerivativeGenerator
 
 derivatives = [
     CsvDerivativeGenerator,
     JsonDerivativeGenerator,
+    JsonLinesDerivativeGenerator,
+    ParquetDerivativeGenerator,
+    XlsxDerivativeGenerator,
     DwcDerivativeGenerator,
 ]
@@ -40,6 +40,9 @@ class BaseDerivativeGenerator(metaclass=ABCMeta):
         self.file_paths = {'main': os.path.join(self.output_dir, self.output_name)}
         # this will contain open file handles
         self.files = {}
+        # a function which returns the Avro schema of a resource's records, this is set
+        # by the download before any records are written
+        self.schema_loader = None
         # indicators
         self._initialised = False
         self._opened = False
@@ -47,7 +50,7 @@ class BaseDerivativeGenerator(metaclass=ABCMeta):
 
     def __enter__(self):
         for fn, fp in self.file_paths.items():
-            self.files[fn] = open(fp, 'a')
+            self.files[fn] = self.open_file(fp)
         self._opened = True
         self.setup()
         if not self._initialised:
@@ -64,6 +67,16 @@ class BaseDerivativeGenerator(metaclass=ABCMeta):
         self.files = {}
         self._opened = False
 
+    def open_file(self, path):
+        """
+        Opens one of the component files for appending. Override this to open the files
+        in a different mode or through a compression library.
+
+        :param path: the file path
+        :returns: the open file handle
+        """
+        return open(path, 'a')
+
     @property
     def main_file(self):
         if 'main' in self.files:
@@ -73,6 +86,19 @@ class BaseDerivativeGenerator(metaclass=ABCMeta):
         else:
             return
 
+    def get_schema(self, resource_id):
+        """
+        Returns the Avro schema of the given resource's records, as used to write its
+        core file. This is for derivatives which need to know the types of the fields
+        before the records are written.
+
+        :param resource_id: the resource ID
+        :returns: the schema as a dict, or None if the resource has no records
+        """
+        if self.schema_loader is None:
+            raise Exception('No schema loader has been set on this derivative.')
+        return self.schema_loader(resource_id)
+
     def initialise(self):
         """
         Runs after files have opened, before any records are processed.
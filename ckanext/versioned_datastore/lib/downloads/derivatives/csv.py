@@ -3,7 +3,10 @@ import csv
 from ckanext.versioned_datastore.lib.downloads.derivatives.base import (
     BaseDerivativeGenerator,
 )
-from ckanext.versioned_datastore.lib.downloads.utils import flatten_dict
+from ckanext.versioned_datastore.lib.downloads.utils import flatten_to_row
+
+# the number of rows which are held in memory before being written out together
+BATCH_SIZE = 1000
 
 
 class CsvDerivativeGenerator(BaseDerivativeGenerator):
@@ -24,31 +27,37 @@ class CsvDerivativeGenerator(BaseDerivativeGenerator):
         )
         self.delimiter = {'comma': ',', 'tab': '\t'}[delimiter]
         self.writer = None
+        # the position of each flattened field in the rows, worked out once up front so
+        # that the values can be placed straight into a list for each record
+        self.columns = {field: i for i, field in enumerate(self.fields['main'])}
+        self.rows = []
 
     def initialise(self):
-        self.writer.writeheader()
+        self.writer.writerow(self.fields['main'])
         super(CsvDerivativeGenerator, self).initialise()
 
     def setup(self):
-        self.writer = csv.DictWriter(
-            self.main_file, self.fields['main'], delimiter=self.delimiter
-        )
+        self.writer = csv.writer(self.main_file, delimiter=self.delimiter)
         super(CsvDerivativeGenerator, self).setup()
 
     def finalise(self):
+        self.flush()
         self.writer = None
         super(CsvDerivativeGenerator, self).finalise()
 
+    def flush(self):
+        """
+        Writes out the rows waiting in the batch.
+        """
+        if self.rows:
+            self.writer.writerows(self.rows)
+            self.rows = []
+
     def _write(self, record):
-        row = flatten_dict(record)
-        filtered_row = {}
-        for field, value in row.items():
-            if value is None and field not in self.fields['main']:
-                continue
-            elif field not in self.fields['main']:
-                raise ValueError(f'Unexpected field ({field})')
-            else:
-                filtered_row[field] = value
+        # the csv writer writes Nones as empty strings
+        row = flatten_to_row(record, self.columns)
         if self.resource_id:
-            filtered_row[self.RESOURCE_ID_FIELD_NAME] = self.resource_id
-        self.writer.writerow(filtered_row)
+            row[self.columns[self.RESOURCE_ID_FIELD_NAME]] = self.resource_id
+        self.rows.append(row)
+        if len(self.rows) >= BATCH_SIZE:
+            self.flush()
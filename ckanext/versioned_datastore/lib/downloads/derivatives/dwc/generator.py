@@ -2,10 +2,12 @@ import csv
 import json
 import os
 import shutil
+import zipfile
 from collections import OrderedDict
 from datetime import datetime as dt
 from uuid import uuid4
 
+from ckan.model import Resource, Session
 from ckan.plugins import plugin_loaded, toolkit
 from lxml import etree
 
@@ -17,6 +19,16 @@ from ckanext.versioned_datastore.lib.downloads.derivatives.dwc.schema import Sch
 from ckanext.versioned_datastore.lib.utils import idownload_implementations
 
 
+def _serialise_value(field_value):
+    # implement custom serialisation for field values, e.g. pipe-delimit lists
+    if isinstance(field_value, list):
+        return ' | '.join(
+            [str(subvalue) for subvalue in field_value if subvalue is not None]
+        )
+    else:
+        return field_value
+
+
 class DwcDerivativeGenerator(BaseDerivativeGenerator):
     name = 'dwc'
     extension = 'zip'
@@ -117,57 +129,80 @@ class DwcDerivativeGenerator(BaseDerivativeGenerator):
             self.fields[e.name] = ext_field_names
         # this will contain csv writers for each component csv
         self.writers = {}
-        # add meta and eml paths
-        self.file_paths['_meta'] = os.path.join(self._build_dir, 'meta.xml')
-        self.file_paths['_eml'] = os.path.join(self._build_dir, 'eml.xml')
+        # the meta and eml files are written once all the records have been written
+        self._meta_path = os.path.join(self._build_dir, 'meta.xml')
+        self._eml_path = os.path.join(self._build_dir, 'eml.xml')
+        # the extension each root field's data is written to
+        self._extension_map = {
+            f: e.name for e in self.schema.extensions for f in e.location.fields
+        }
+        # the position of each field in the rows of each component csv, worked out in
+        # .compile() once the fields are finalised
+        self._positions = {}
 
         # counts number of rows written
         self.rows_written = 0
 
-    def __exit__(self, *args, **kwargs):
-        super(DwcDerivativeGenerator, self).__exit__(*args, **kwargs)
-        shutil.make_archive(
-            os.path.join(self.output_dir, os.path.splitext(self.output_name)[0]),
-            'zip',
-            self._build_dir,
-        )
-
     def setup(self):
         if not self._opened:
             raise Exception('Files should be open.')
         self.writers = {
-            k: csv.DictWriter(self.files[k], self.fields[k], dialect='unix')
-            for k in self.fields
+            k: csv.writer(self.files[k], dialect='unix') for k in self.fields
         }
         # headers are written in .validate()
         super(DwcDerivativeGenerator, self).setup()
 
     def validate(self, record):
         if 'type' in record and record['type'] not in utils.valid_types:
-            self.writers['core'].fieldnames = [
-                f for f in self.fields['core'] if f != 'type'
-            ]
+            self.fields['core'] = [f for f in self.fields['core'] if f != 'type']
+        self.compile()
         for k, writer in self.writers.items():
-            writer.writeheader()
+            writer.writerow(self.fields[k])
         super(DwcDerivativeGenerator, self).validate(record)
 
+    def compile(self):
+        """
+        Works out the position of each field in each component csv's rows, so that
+        records can be written without looking the fields up for every record.
+        """
+        self._positions = {
+            k: {field: i for i, field in enumerate(fields)}
+            for k, fields in self.fields.items()
+        }
+
     def finalise(self):
-        self.files['_meta'].write(self.make_meta())
-        self.files['_eml'].write(self.make_eml())
         self.writers = {}
 
     def cleanup(self):
+        # only build the archive if the generator was opened, it won't have been if its
+        # resource was empty
+        if self._initialised:
+            with open(self._meta_path, 'w') as f:
+                f.write(self.make_meta())
+            with open(self._eml_path, 'w') as f:
+                f.write(self.make_eml())
+            self.make_archive()
         try:
             shutil.rmtree(self._build_dir)
         except FileNotFoundError:
             pass
 
+    def make_archive(self):
+        """
+        Zips up the component files to create the archive. The files are stored without
+        compression because the archive is compressed when it's added to the download
+        zip, and compressing the files twice takes time without making them smaller.
+        """
+        archive_path = os.path.join(self.output_dir, self.output_name)
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED) as archive:
+            for filename in sorted(os.listdir(self._build_dir)):
+                archive.write(os.path.join(self._build_dir, filename), filename)
+
     def _write(self, record):
         core_row, ext_rows = self._extract_record(record)
         self.writers['core'].writerow(core_row)
         for e, rows in ext_rows.items():
-            for row in rows:
-                self.writers[e].writerow(row)
+            self.writers[e].writerows(rows)
         self.rows_written += 1
 
     def _extract_record(self, record):
@@ -176,62 +211,62 @@ class DwcDerivativeGenerator(BaseDerivativeGenerator):
         fields from core fields and filters out any fields that don't match the schema.
 
         :param record: the row of data
-        :returns: core row (dict), extension rows keyed on extension name (dict of lists
-            of dicts)
+        :returns: core row (list), extension rows keyed on extension name (dict of lists
+            of lists)
         """
-        core = {}
         ext = {}
         dynamic_properties = {}
 
         if self._id_field not in record:
             raise Exception(f'Record does not have ID field {self._id_field}')
         record_id = record.get(self._id_field)
-        core['_id'] = record_id
-
-        extension_map = {}
-        for e in self.schema.extensions:
-            for f in e.location.fields:
-                extension_map[f] = e.name
-
-        def _serialise_value(field_value):
-            # implement custom serialisation for field values, e.g. pipe-delimit lists
-            if isinstance(field_value, list):
-                return ' | '.join(
-                    [str(subvalue) for subvalue in field_value if subvalue is not None]
-                )
-            else:
-                return field_value
+        core_positions = self._positions['core']
+        core = [None] * len(core_positions)
+        core[core_positions['_id']] = record_id
 
         for k, v in record.items():
-            if k in extension_map:
-                ext_props = self.writers[extension_map[k]].fieldnames
-
-                def _extract_ext(subdict):
-                    props = {'_id': record_id}
-                    for ek, ev in subdict.items():
-                        if ek in ext_props and ek != '_id':
-                            props[ek] = _serialise_value(ev)
-                    return props
-
+            extension = self._extension_map.get(k)
+            if extension is not None:
                 if isinstance(v, list):
-                    ext_extracted = [_extract_ext(x) for x in v]
+                    ext_extracted = [
+                        self._extract_ext(extension, record_id, x) for x in v
+                    ]
                 elif isinstance(v, dict):
-                    ext_extracted = [_extract_ext(v)]
+                    ext_extracted = [self._extract_ext(extension, record_id, v)]
                 elif v is None:
                     # skip if empty
                     ext_extracted = []
                 else:
-                    ext_extracted = [_extract_ext({k: v})]
-                ext[extension_map[k]] = ext_extracted
+                    ext_extracted = [self._extract_ext(extension, record_id, {k: v})]
+                ext[extension] = ext_extracted
             else:
-                if k in self.writers['core'].fieldnames:
-                    core[k] = _serialise_value(v)
+                position = core_positions.get(k)
+                if position is not None:
+                    core[position] = _serialise_value(v)
                 else:
                     dynamic_properties[k] = _serialise_value(v)
 
-        core['dynamicProperties'] = json.dumps(dynamic_properties)
+        core[core_positions['dynamicProperties']] = json.dumps(dynamic_properties)
         return core, ext
 
+    def _extract_ext(self, extension, record_id, subdict):
+        """
+        Creates a row for the given extension from a dict of the extension's fields.
+
+        :param extension: the extension name
+        :param record_id: the ID of the record the dict is from
+        :param subdict: the dict
+        :returns: the row (list)
+        """
+        positions = self._positions[extension]
+        row = [None] * len(positions)
+        row[0] = record_id
+        for ek, ev in subdict.items():
+            position = positions.get(ek)
+            if position is not None and ek != '_id':
+                row[position] = _serialise_value(ev)
+        return row
+
     def make_meta(self):
         """
         Create the xml text content of the metafile.
@@ -264,7 +299,7 @@ class DwcDerivativeGenerator(BaseDerivativeGenerator):
         core_files_location = etree.SubElement(core_files, 'location')
         core_files_location.text = self._core_file_name
         etree.SubElement(core, 'id', index='0')
-        for i, c in enumerate(self.writers['core'].fieldnames):
+        for i, c in enumerate(self.fields['core']):
             if c == '_id':
                 continue
             prop = self.schema.props.get(c)
@@ -280,7 +315,7 @@ class DwcDerivativeGenerator(BaseDerivativeGenerator):
             ext_files_location.text = f'{e.name.lower()}.csv'
             etree.SubElement(ext_root, 'coreid', index='0')
             ext_props = self.schema.extension_props[e.name]
-            for i, c in enumerate(self.writers[e.name].fieldnames):
+            for i, c in enumerate(self.fields[e.name]):
                 if c == '_id':
                     continue
                 etree.SubElement(
@@ -288,6 +323,48 @@ class DwcDerivativeGenerator(BaseDerivativeGenerator):
                 )
         return etree.tostring(root, pretty_print=True).decode()
 
+    def get_metadata(self):
+        """
+        Retrieves the resource and package dicts for the resources in the query. The
+        package of every resource is found with a single query and then each package is
+        only retrieved once, with the resource dicts taken from the package dicts.
+
+        :returns: a 2-tuple of the list of resource dicts and the list of distinct
+            package dicts
+        """
+        package_show = toolkit.get_action('package_show')
+        resource_ids = self._query.resource_ids
+        package_ids = dict(
+            Session.query(Resource.id, Resource.package_id).filter(
+                Resource.id.in_(resource_ids)
+            )
+        )
+        packages = {}
+        resources = []
+        for resource_id in resource_ids:
+            package_id = package_ids.get(resource_id)
+            resource = None
+            if package_id is not None:
+                if package_id not in packages:
+                    packages[package_id] = package_show({}, {'id': package_id})
+                resource = next(
+                    (
+                        r
+                        for r in packages[package_id].get('resources', [])
+                        if r['id'] == resource_id
+                    ),
+                    None,
+                )
+            if resource is None:
+                # fall back to retrieving the resource on its own
+                resource = toolkit.get_action('resource_show')({}, {'id': resource_id})
+                if resource['package_id'] not in packages:
+                    packages[resource['package_id']] = package_show(
+                        {}, {'id': resource['package_id']}
+                    )
+            resources.append(resource)
+        return resources, list(packages.values())
+
     def make_eml(self):
         """
         Create the xml text content of the resource metadata file.
@@ -297,13 +374,8 @@ class DwcDerivativeGenerator(BaseDerivativeGenerator):
         data.
         :returns: xml string
         """
-        # load some useful actions so we don't have to fetch them repeatedly
-        resource_show = toolkit.get_action('resource_show')
-        package_show = toolkit.get_action('package_show')
-
         # get the resources and packages associated with the query
-        resources = [resource_show({}, {'id': r}) for r in self._query.resource_ids]
-        packages = [package_show({}, {'id': r['package_id']}) for r in resources]
+        resources, packages = self.get_metadata()
 
         # useful bools
         single_resource = len(resources) == 1
@@ -486,8 +558,8 @@ class DwcDerivativeGenerator(BaseDerivativeGenerator):
                 'package_contributions_show'
             )
             authors = []
-            for r in resources:
-                contributions = package_contributions_show({}, {'id': r['package_id']})
+            for p in packages:
+                contributions = package_contributions_show({}, {'id': p['id']})
                 for c in contributions['contributions']:
                     if c['agent']['id'] in authors:
                         continue
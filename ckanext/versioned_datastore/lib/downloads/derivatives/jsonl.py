@@ -0,0 +1,48 @@
+import gzip
+import os
+
+from ckan.plugins import toolkit
+
+from ckanext.versioned_datastore.lib.downloads.derivatives.base import (
+    BaseDerivativeGenerator,
+)
+from ckanext.versioned_datastore.lib.downloads.utils import dumps
+
+
+class JsonLinesDerivativeGenerator(BaseDerivativeGenerator):
+    """
+    Writes each record as compact JSON on its own line so that the file can be read one
+    record at a time. Records are serialised with orjson if it's installed.
+    """
+
+    name = 'jsonl'
+    extension = 'jsonl'
+
+    def __init__(
+        self,
+        output_dir,
+        fields,
+        query,
+        resource_id=None,
+        compress=False,
+        **format_args,
+    ):
+        super(JsonLinesDerivativeGenerator, self).__init__(
+            output_dir, fields, query, resource_id, **format_args
+        )
+        self.compress = toolkit.asbool(compress)
+        if self.compress:
+            self.output_name = os.extsep.join([self.output_name, 'gz'])
+            self.file_paths['main'] = os.path.join(self.output_dir, self.output_name)
+
+    def open_file(self, path):
+        # each time the file is reopened a new gzip member is appended, which gzip
+        # readers treat as one continuous stream
+        if self.compress:
+            return gzip.open(path, 'ab')
+        return open(path, 'ab')
+
+    def _write(self, record):
+        if self.resource_id:
+            record[self.RESOURCE_ID_FIELD_NAME] = self.resource_id
+        self.main_file.write(dumps(record) + b'\n')
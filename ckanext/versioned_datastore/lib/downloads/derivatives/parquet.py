@@ -0,0 +1,220 @@
+import json
+from typing import Callable, List, Tuple, Union
+
+from ckanext.versioned_datastore.lib.downloads.derivatives.base import (
+    BaseDerivativeGenerator,
+)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def _identity(value):
+    return value
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _flatten_types(types: List[Union[str, dict, list]]) -> List[Union[str, dict]]:
+    # the items of avro arrays are unions of unions, so flatten them out
+    flat = []
+    for avro_type in types:
+        if isinstance(avro_type, list):
+            flat.extend(_flatten_types(avro_type))
+        else:
+            flat.append(avro_type)
+    return flat
+
+
+def _list_converter(converter: Callable) -> Callable:
+    def convert(value):
+        return None if value is None else [converter(element) for element in value]
+
+    return convert
+
+
+def _struct_converter(converters: List[Tuple[str, Callable]]) -> Callable:
+    def convert(value):
+        if value is None:
+            return None
+        return {name: converter(value.get(name)) for name, converter in converters}
+
+    return convert
+
+
+def compile_field(
+    types: List[Union[str, dict, list]],
+) -> Tuple['pyarrow.DataType', Callable]:
+    """
+    Works out the Arrow type for a field from its Avro types and creates a function
+    which converts the field's values so that they fit the Arrow type. Fields with one
+    basic type keep it, longs and doubles become doubles, lists become list columns and
+    dicts become struct columns. Anything more mixed than that is written as strings,
+    with lists and dicts encoded as JSON.
+
+    :param types: the field's Avro types, as created by get_schema
+    :returns: a 2-tuple of the Arrow type and the conversion function
+    """
+    types = _flatten_types(types)
+    basic = {avro_type for avro_type in types if isinstance(avro_type, str)}
+    basic.discard('null')
+    complex_types = [avro_type for avro_type in types if isinstance(avro_type, dict)]
+    arrays = [avro_type for avro_type in complex_types if avro_type['type'] == 'array']
+    records = [
+        avro_type for avro_type in complex_types if avro_type['type'] == 'record'
+    ]
+
+    if arrays and not basic and not records:
+        items = [item for array in arrays for item in array['items']]
+        item_type, item_converter = compile_field(items)
+        return pyarrow.list_(item_type), _list_converter(item_converter)
+
+    if records and not basic and not arrays:
+        # merge the fields of the records, they can come from different resources
+        children = {}
+        for record in records:
+            for child in record['fields']:
+                children.setdefault(child['name'], []).append(child['type'])
+        compiled = [(name, *compile_field(child)) for name, child in children.items()]
+        return (
+            pyarrow.struct([(name, arrow_type) for name, arrow_type, _ in compiled]),
+            _struct_converter([(name, converter) for name, _, converter in compiled]),
+        )
+
+    if not arrays and not records:
+        if basic == {'long'}:
+            return pyarrow.int64(), _identity
+        if basic == {'boolean'}:
+            return pyarrow.bool_(), _identity
+        if basic and basic <= {'long', 'double'}:
+            return pyarrow.float64(), _to_float
+
+    return pyarrow.string(), _to_string
+
+
+class ParquetDerivativeGenerator(BaseDerivativeGenerator):
+    """
+    Writes the records to a Parquet file with a column for each root field, keeping
+    nested data as list and struct columns. The columns' types are worked out from the
+    core files' schemas and the records are written in row groups so that only one
+    group is held in memory at a time.
+    """
+
+    name = 'parquet'
+    extension = 'parquet'
+
+    def __init__(
+        self,
+        output_dir,
+        fields,
+        query,
+        resource_id=None,
+        compression='snappy',
+        row_group_size=10000,
+        **format_args,
+    ):
+        super(ParquetDerivativeGenerator, self).__init__(
+            output_dir, fields, query, resource_id, **format_args
+        )
+        if pyarrow is None:
+            raise Exception('pyarrow must be installed to create parquet downloads.')
+        self.compression = compression
+        self.row_group_size = int(row_group_size)
+        if self.row_group_size < 1:
+            raise ValueError('row_group_size must be at least 1')
+        # the parquet writer has to stay open until all the resources have been written
+        # so it manages the file itself rather than using the file handles opened for
+        # each resource
+        self.output_path = self.file_paths.pop('main')
+        self.writer = None
+        self.arrow_schema = None
+        self.converters = []
+        self.columns = {}
+        # the number of records waiting to be written
+        self.buffered = 0
+
+    def compile(self):
+        """
+        Creates the Arrow schema and the conversion functions for each column from the
+        Avro schemas of the resources in this file.
+        """
+        resource_ids = (
+            [self.resource_id] if self.resource_id else self._query.resource_ids
+        )
+        root_types = {}
+        for resource_id in resource_ids:
+            schema = self.get_schema(resource_id)
+            if schema is None:
+                continue
+            for field in schema['fields']:
+                root_types.setdefault(field['name'], []).append(field['type'])
+
+        # only include the root fields which have fields in the download, this removes
+        # empty fields if they're being ignored
+        roots = {field.split('.')[0] for field in self.fields['main']}
+        arrow_fields = []
+        self.converters = []
+        for name in sorted(root_types, key=lambda f: f.lower()):
+            if name not in roots:
+                continue
+            arrow_type, converter = compile_field(root_types[name])
+            arrow_fields.append(pyarrow.field(name, arrow_type))
+            self.converters.append((name, converter))
+        if self.resource_id:
+            arrow_fields.append(
+                pyarrow.field(self.RESOURCE_ID_FIELD_NAME, pyarrow.string())
+            )
+        self.arrow_schema = pyarrow.schema(arrow_fields)
+        self.columns = {field.name: [] for field in arrow_fields}
+
+    def initialise(self):
+        self.compile()
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.output_path, self.arrow_schema, compression=self.compression
+        )
+        super(ParquetDerivativeGenerator, self).initialise()
+
+    def finalise(self):
+        self.flush()
+        super(ParquetDerivativeGenerator, self).finalise()
+
+    def cleanup(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        super(ParquetDerivativeGenerator, self).cleanup()
+
+    def flush(self):
+        """
+        Writes the buffered records out as a row group.
+        """
+        if self.writer is None or self.buffered == 0:
+            return
+        table = pyarrow.Table.from_pydict(self.columns, schema=self.arrow_schema)
+        self.writer.write_table(table)
+        for column in self.columns.values():
+            column.clear()
+        self.buffered = 0
+
+    def _write(self, record):
+        columns = self.columns
+        for name, converter in self.converters:
+            columns[name].append(converter(record.get(name)))
+        if self.resource_id:
+            columns[self.RESOURCE_ID_FIELD_NAME].append(self.resource_id)
+        self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self.flush()
@@ -0,0 +1,91 @@
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+from ckanext.versioned_datastore.lib.downloads.derivatives.base import (
+    BaseDerivativeGenerator,
+)
+from ckanext.versioned_datastore.lib.downloads.utils import flatten_to_row
+
+# the maximum number of rows in an Excel worksheet, including the header
+MAX_ROWS = 1048576
+# the maximum number of characters in an Excel cell
+MAX_CELL_LENGTH = 32767
+SHEET_NAME = 'Records'
+
+
+class XlsxDerivativeGenerator(BaseDerivativeGenerator):
+    """
+    Writes the records to an Excel workbook using openpyxl's write-only mode, which
+    streams the rows out to disk rather than keeping the whole workbook in memory.
+    Records are flattened in the same way as the CSV derivative and a new worksheet is
+    started whenever one fills up.
+    """
+
+    name = 'xlsx'
+    extension = 'xlsx'
+
+    def __init__(self, output_dir, fields, query, resource_id=None, **format_args):
+        super(XlsxDerivativeGenerator, self).__init__(
+            output_dir, fields, query, resource_id, **format_args
+        )
+        # workbooks can't be appended to, so the workbook has to stay open until all
+        # the resources have been written rather than using the file handles opened
+        # for each resource
+        self.output_path = self.file_paths.pop('main')
+        self.columns = {field: i for i, field in enumerate(self.fields['main'])}
+        self.workbook = None
+        self.sheet = None
+        # the number of rows written to the current sheet
+        self.sheet_rows = 0
+
+    def initialise(self):
+        self.workbook = openpyxl.Workbook(write_only=True)
+        super(XlsxDerivativeGenerator, self).initialise()
+
+    def cleanup(self):
+        if self.workbook is not None:
+            # workbooks need at least one sheet, even if there weren't any records
+            if self.sheet is None:
+                self.add_sheet()
+            self.workbook.save(self.output_path)
+            self.workbook.close()
+            self.workbook = None
+        super(XlsxDerivativeGenerator, self).cleanup()
+
+    def add_sheet(self):
+        """
+        Starts a new worksheet and writes the header row to it.
+        """
+        count = len(self.workbook.worksheets)
+        title = SHEET_NAME if count == 0 else f'{SHEET_NAME} {count + 1}'
+        self.sheet = self.workbook.create_sheet(title)
+        self.sheet.append(self.fields['main'])
+        self.sheet_rows = 1
+
+    def to_cell(self, value):
+        """
+        Makes sure the given value can be written to a cell. Strings have any
+        characters Excel doesn't allow removed and are truncated to the maximum cell
+        length. Strings which look like formulae are forced to be written as text.
+
+        :param value: the value
+        :returns: the value to write
+        """
+        if not isinstance(value, str):
+            return value
+        value = ILLEGAL_CHARACTERS_RE.sub('', value)[:MAX_CELL_LENGTH]
+        if value.startswith('='):
+            cell = WriteOnlyCell(self.sheet, value)
+            cell.data_type = 's'
+            return cell
+        return value
+
+    def _write(self, record):
+        if self.sheet is None or self.sheet_rows >= MAX_ROWS:
+            self.add_sheet()
+        row = flatten_to_row(record, self.columns)
+        if self.resource_id:
+            row[self.columns[self.RESOURCE_ID_FIELD_NAME]] = self.resource_id
+        self.sheet.append([self.to_cell(value) for value in row])
+        self.sheet_rows += 1
@@ -1,5 +1,6 @@
 import hashlib
 import json
+import logging
 import os
 import os.path
 import shutil
@@ -8,25 +9,36 @@ import zipfile
 from collections import defaultdict
 from datetime import datetime as dt
 from functools import partial
-from glob import iglob
+from typing import Iterable, List, Optional, Tuple
+from uuid import uuid4
 
 import fastavro
 from ckan.lib import uploader
 from ckan.plugins import toolkit
-from splitgill.search import rebuild_data
+from rq.job import Dependency, Job
 
 from ckanext.versioned_datastore.lib import common
+from ckanext.versioned_datastore.lib.downloads.core import (
+    CoreFile,
+    WriterOptions,
+    count_all_records,
+    count_records,
+    generate_core_files,
+    is_single_pass,
+    scan_records,
+    should_split_jobs,
+)
 from ckanext.versioned_datastore.lib.downloads.utils import (
     calculate_field_counts,
     filter_data_fields,
     get_fields,
     get_schema,
+    get_shard_path,
+    is_sharded,
 )
+from ckanext.versioned_datastore.lib.query.slugs.slugs import is_saved_query
 from ckanext.versioned_datastore.lib.query.utils import get_resources_and_versions
-from ckanext.versioned_datastore.lib.utils import (
-    get_database,
-    idownload_implementations,
-)
+from ckanext.versioned_datastore.lib.utils import idownload_implementations
 from ckanext.versioned_datastore.logic.download.arg_objects import (
     DerivativeArgs,
     NotifierArgs,
@@ -39,12 +51,23 @@ from ckanext.versioned_datastore.model.downloads import (
     DownloadRequest,
 )
 
+from . import eviction, inflight
 from .loaders import (
     get_derivative_generator,
     get_file_server,
     get_notifier,
     get_transformation,
 )
+from .queues import (
+    DEFAULT_QUEUE,
+    add_in_progress,
+    get_estimate_timeout,
+    get_queue_name,
+    is_sized,
+    remove_in_progress,
+)
+
+log = logging.getLogger(__name__)
 
 
 class DownloadRunManager:
@@ -84,6 +107,7 @@ class DownloadRunManager:
             query_args.slug_or_doi = None
 
         self.query = query_args.to_schema_query()
+        self.core_options = WriterOptions.create(query_args.core_options)
         self.allow_non_datastore = (
             derivative_args.format == 'raw'
             and derivative_args.format_args.get('allow_non_datastore', False)
@@ -103,6 +127,8 @@ class DownloadRunManager:
 
         # initialise core and derivative records
         self.core_record, self.derivative_record = self.check_for_records()
+        # work out whether to skip the core files for this download
+        self.direct = self.should_stream(query_args)
 
         # initialises a log entry in the database
         self.request = DownloadRequest(
@@ -117,6 +143,10 @@ class DownloadRunManager:
         )
 
         self._temp = []
+        # these are set when the download is queued
+        self.owner = None
+        self.queue_name = DEFAULT_QUEUE
+        self.claimed = []
 
         for plugin in idownload_implementations():
             plugin.download_after_init(self.request)
@@ -157,21 +187,143 @@ class DownloadRunManager:
     @property
     def core_folder_path(self):
         """
-        Location of the core files for this query.
+        Location of the core files for this query. If the core directory is sharded,
+        an existing unsharded folder for the query is still used.
         """
-        return os.path.join(self.core_dir, self.query.hash)
+        unsharded = os.path.join(self.core_dir, self.query.hash)
+        if not is_sharded() or os.path.exists(unsharded):
+            return unsharded
+        return get_shard_path(self.core_dir, self.query.hash)
+
+    def queue(self, owner: Optional[str] = None) -> Job:
+        """
+        Queues the download on a download queue. Usually this is a single job which
+        runs the whole download, but if split jobs are enabled and there's more than
+        one datastore resource in the download, the core files for each resource are
+        generated in separate jobs so that they can be run by multiple download workers
+        at once. A final job then generates the derivative and notifies the user once
+        they've all finished.
+
+        If size limits are configured, the queue is chosen based on the number of
+        records in the download so that small downloads don't have to wait behind large
+        ones.
+
+        If an identical download is already being generated, this download waits for it
+        to finish and then uses its file instead of generating another. Similarly, if a
+        download of the same records in a different format is being generated, this
+        download waits for its core files.
+
+        If the user already has the maximum number of downloads in progress, the
+        download is marked as failed and a ValidationError is raised.
+
+        :param owner: the name of the user requesting the download, if they're logged
+            in, used to limit the number of downloads they can have in progress
+        :returns: the first job queued for the download
+        """
+        self.owner = owner
+        try:
+            add_in_progress(self.owner, self.request.id)
+        except toolkit.ValidationError:
+            self.request.update_status(
+                DownloadRequest.state_failed, 'Too many downloads in progress'
+            )
+            raise
+
+        title = self.request.created.strftime('%Y-%m-%d %H:%M:%S')
+        # the id of the download's final job, so that other downloads can depend on it
+        final_job_id = str(uuid4())
+        depends_on = []
+
+        # this is done even if the download is going to wait for an identical one, as
+        # if that one fails this download is generated in full instead
+        if is_sized():
+            self.queue_name = get_queue_name(self.estimate_size())
+
+        if inflight.should_coalesce() and self.derivative_record.filepath is None:
+            leader = inflight.get_claim(self.hash)
+            if leader is not None:
+                return toolkit.enqueue_job(
+                    self.run,
+                    kwargs={'leader_id': leader['request_id']},
+                    queue=self.queue_name,
+                    title=title,
+                    rq_kwargs={
+                        'timeout': '24h',
+                        'depends_on': Dependency(
+                            [leader['job_id']], allow_failure=True
+                        ),
+                    },
+                )
+            # the hashes are claimed once the jobs have been enqueued, but the jobs need
+            # to know which ones to release when they finish
+            self.claimed.append(self.hash)
+
+            # direct downloads don't use core files so there's nothing to wait for
+            if not self.direct:
+                core_leader = inflight.get_claim(self.record_hash)
+                if core_leader is None:
+                    self.claimed.append(self.record_hash)
+                else:
+                    depends_on.append(core_leader['job_id'])
+
+        resource_ids = self.get_datastore_resource_ids()
+        if not should_split_jobs() or len(resource_ids) < 2:
+            rq_kwargs = {'timeout': '24h', 'job_id': final_job_id}
+            if depends_on:
+                rq_kwargs['depends_on'] = Dependency(depends_on, allow_failure=True)
+            job = toolkit.enqueue_job(
+                self.run, queue=self.queue_name, title=title, rq_kwargs=rq_kwargs
+            )
+        else:
+            rq_kwargs = {}
+            if depends_on:
+                rq_kwargs['depends_on'] = Dependency(depends_on, allow_failure=True)
+            job = toolkit.enqueue_job(
+                self.start, queue=self.queue_name, title=title, rq_kwargs=rq_kwargs
+            )
+            # the core jobs and the package job are still run if the jobs they depend
+            # on fail so that they can tidy up and tell the user what happened
+            core_jobs = [
+                toolkit.enqueue_job(
+                    self.run_core,
+                    args=[resource_id],
+                    queue=self.queue_name,
+                    title=f'{title} ({resource_id})',
+                    rq_kwargs={
+                        'timeout': '24h',
+                        'depends_on': Dependency([job], allow_failure=True),
+                    },
+                )
+                for resource_id in resource_ids
+            ]
+            toolkit.enqueue_job(
+                self.run_package,
+                queue=self.queue_name,
+                title=title,
+                rq_kwargs={
+                    'timeout': '24h',
+                    'job_id': final_job_id,
+                    'depends_on': Dependency(core_jobs, allow_failure=True),
+                },
+            )
+
+        # only publish the claims now that the final job exists, rq ignores dependencies
+        # on jobs it doesn't know about so other downloads would otherwise start right
+        # away. If another download claimed a hash in the meantime, both generate the
+        # files
+        for download_hash in self.claimed:
+            inflight.claim(download_hash, self.request.id, final_job_id)
+        return job
 
-    def run(self):
+    def run(self, leader_id: Optional[str] = None):
         """
         Run the download process.
+
+        :param leader_id: the ID of an identical download request this download waited
+            for, if there was one (default None)
         """
         try:
-            # refresh the db objects because they were probably retrieved in a
-            # different session (the __init__ is run by the main ckan process,
-            # this is run by the download worker)
-            self.request = DownloadRequest.get(self.request.id)
-            self.core_record = CoreFileRecord.get(self.core_record.id)
-            self.derivative_record = DerivativeFileRecord.get(self.derivative_record.id)
+            self.refresh()
 
             self.notifier.notify_start()
             self.request.update_status(DownloadRequest.state_initial)
@@ -180,32 +332,243 @@ class DownloadRunManager:
             # technically we don't need core files if the format is 'raw', but we'll
             # generate them anyway for consistency/avoidance of thousands of ifs, and
             # also so we have some field metadata
-            self.generate_core()
+            if leader_id is not None and self.adopt(leader_id):
+                # the identical download's files can be used as they are
+                pass
+            elif self.direct:
+                # unless we're streaming straight into the derivative, in which case we
+                # just need the metadata
+                self.count_core()
+            else:
+                self.generate_core()
 
-            # generate derivative file if needed
-            self.generate_derivative()
+            self.finish()
+        except Exception as e:
+            self.fail(e)
+            raise e
+        finally:
+            self.cleanup()
+            inflight.release(self.claimed, self.request.id)
+            remove_in_progress(self.owner, self.request.id)
+            for plugin in idownload_implementations():
+                plugin.download_after_run(self.request)
 
-            # finish up
-            self.request.update_status(DownloadRequest.state_complete)
-            url = self.server.serve(self.request)
-            self.notifier.notify_end(url)
+    def start(self):
+        """
+        The first job of a split download; notifies the user that the download has
+        started.
+        """
+        try:
+            self.refresh()
+            self.notifier.notify_start()
+            self.request.update_status(DownloadRequest.state_initial)
         except Exception as e:
-            current_state = self.request.state
-            self.request.update_status(
-                DownloadRequest.state_failed,
-                f'{current_state}, {e.__class__.__name__}: {str(e)}',
+            # the package job notifies the user about the error
+            self.fail(e, notify=False)
+            raise e
+
+    def run_core(self, resource_id: str):
+        """
+        Generates the core file for a single resource as part of a split download and
+        stores its total and field counts on the core record.
+
+        :param resource_id: the resource ID
+        """
+        self.refresh()
+        if self.request.state == DownloadRequest.state_failed:
+            # another part of the download has already failed so there's no point
+            return
+
+        try:
+            if self.direct:
+                resource_totals, field_counts = self.count_resources([resource_id])
+            else:
+                resource_totals, field_counts = self.build_core([resource_id])
+            self.core_record.update_resource(
+                resource_id, resource_totals[resource_id], field_counts[resource_id]
             )
-            self.notifier.notify_error()
+            if not self.direct:
+                # the core file has been written so other downloads can use it now
+                self.core_record.add_to_catalogue([resource_id])
+        except Exception as e:
+            # the package job notifies the user about the error
+            self.fail(e, notify=False)
             raise e
         finally:
-            for t in self._temp:
-                try:
-                    shutil.rmtree(t)
-                except FileNotFoundError:
-                    pass
+            self.cleanup()
+
+    def run_package(self):
+        """
+        The final job of a split download; generates the derivative from the core
+        files created by the other jobs and serves it, or notifies the user of the
+        error if one of the other jobs failed.
+        """
+        try:
+            self.refresh()
+            if self.request.state == DownloadRequest.state_failed:
+                # the job which failed has already recorded why
+                self.notifier.notify_error()
+                return
+
+            resource_totals = dict(self.core_record.resource_totals)
+            field_counts = dict(self.core_record.field_counts)
+            missing = [
+                resource_id
+                for resource_id in self.get_datastore_resource_ids()
+                if resource_id not in resource_totals
+            ]
+            if missing:
+                raise Exception(f'No core file for {", ".join(missing)}')
+            self.update_core_record(resource_totals, field_counts)
+
+            self.finish()
+        except Exception as e:
+            self.fail(e)
+            raise e
+        finally:
+            self.cleanup()
+            inflight.release(self.claimed, self.request.id)
+            remove_in_progress(self.owner, self.request.id)
             for plugin in idownload_implementations():
                 plugin.download_after_run(self.request)
 
+    def adopt(self, leader_id: str) -> bool:
+        """
+        Switches this download over to the core and derivative records of the given
+        identical download request, as long as it completed successfully.
+
+        :param leader_id: the ID of the identical download request
+        :returns: True if the records were adopted, False if not
+        """
+        leader = DownloadRequest.get(leader_id)
+        if leader is None or leader.state != DownloadRequest.state_complete:
+            return False
+        derivative_record = leader.derivative_record
+        if derivative_record.filepath is None or not os.path.exists(
+            derivative_record.filepath
+        ):
+            return False
+        self.core_record = derivative_record.core_record
+        self.derivative_record = derivative_record
+        self.request.update(
+            core_id=self.core_record.id, derivative_id=self.derivative_record.id
+        )
+        return True
+
+    def refresh(self):
+        """
+        Refreshes the db objects because they were probably retrieved in a different
+        session (the __init__ is run by the main ckan process, the jobs are run by the
+        download worker).
+        """
+        self.request = DownloadRequest.get(self.request.id)
+        self.core_record = CoreFileRecord.get(self.core_record.id)
+        self.derivative_record = DerivativeFileRecord.get(self.derivative_record.id)
+
+    def finish(self):
+        """
+        Generates the derivative file if needed, serves it and notifies the user.
+        """
+        # generate derivative file if needed
+        self.generate_derivative()
+
+        # finish up
+        self.request.update_status(DownloadRequest.state_complete)
+        url = self.server.serve(self.request)
+        self.notifier.notify_end(url)
+        # now there's a new file, check whether any old ones need evicting
+        eviction.queue_collection()
+
+    def fail(self, error: Exception, notify: bool = True):
+        """
+        Marks the download as failed.
+
+        :param error: the exception which caused the failure
+        :param notify: whether to notify the user (default True)
+        """
+        current_state = self.request.state
+        self.request.update_status(
+            DownloadRequest.state_failed,
+            f'{current_state}, {error.__class__.__name__}: {str(error)}',
+        )
+        if notify:
+            self.notifier.notify_error()
+
+    def cleanup(self):
+        """
+        Removes any temporary directories created by this process.
+        """
+        for t in self._temp:
+            try:
+                shutil.rmtree(t)
+            except FileNotFoundError:
+                pass
+        self._temp = []
+
+    def estimate_size(self) -> Optional[int]:
+        """
+        Counts the records which will be in the download. This is just a count of the
+        records matching the query in each resource, made in one request with a short
+        timeout, so it is cheap enough to do before the download is queued.
+
+        :returns: the number of records, or None if they couldn't be counted in time
+        """
+        resource_ids_and_versions = {
+            resource_id: self.resource_ids_and_versions[resource_id]
+            for resource_id in self.get_datastore_resource_ids()
+        }
+        try:
+            return count_all_records(
+                resource_ids_and_versions, self.query.to_dsl(), get_estimate_timeout()
+            )
+        except Exception as e:
+            log.warning(f'Failed to estimate download size: {e}')
+            return None
+
+    def get_datastore_resource_ids(self) -> List[str]:
+        """
+        :returns: the IDs of the resources in this download which have core files
+        """
+        return [
+            resource_id
+            for resource_id, version in self.resource_ids_and_versions.items()
+            if version != common.NON_DATASTORE_VERSION
+        ]
+
+    def should_stream(self, query_args: QueryArgs) -> bool:
+        """
+        Decides whether the records for this download should be streamed straight from
+        Elasticsearch into the derivative file without writing core files first. Core
+        files are only worth writing if they're likely to be used again, so they're
+        still used for saved queries (i.e. ones with a slug or DOI) and if some of them
+        already exist.
+
+        :param query_args: the query args for this download
+        :returns: True if the core files should be skipped, False if not
+        """
+        if not toolkit.asbool(
+            toolkit.config.get('ckanext.versioned_datastore.download_direct', False)
+        ):
+            return False
+        # raw downloads don't use the records so there's nothing to stream
+        if self.derivative_options.format == 'raw':
+            return False
+        # a derivative we can reuse already exists
+        if self.derivative_record.filepath is not None:
+            return False
+        # queries with a slug or doi are likely to be downloaded again
+        if query_args.slug_or_doi or is_saved_query(self.query):
+            return False
+        # if there are already some core files for this query, use them
+        if os.path.exists(self.core_folder_path):
+            existing_files = os.listdir(self.core_folder_path)
+            if any(
+                f'{resource_id}_{version}.avro' in existing_files
+                for resource_id, version in self.resource_ids_and_versions.items()
+            ):
+                return False
+        return True
+
     def check_for_records(self):
         """
         Check if relevant files and records already exist and returns the records if
@@ -225,21 +588,18 @@ class DownloadRunManager:
         core_record = None
         derivative_record = None
 
-        # search for derivative first
-        fp = os.path.join(self.download_dir, f'{self.hash}.zip')
-        if os.path.exists(fp):
-            existing_file = fp
-        else:
-            # check old-style names with the request id in front as well
-            fn = f'*_{self.hash}.zip'
-            existing_file = next(iglob(os.path.join(self.download_dir, fn)), None)
-        if existing_file is not None:
-            # could return multiple options, sorted by most recent first
-            possible_records = DerivativeFileRecord.get_by_filepath(existing_file)
-            if possible_records:
-                # use the most recent one
-                derivative_record = possible_records[0]
-                core_record = derivative_record.core_record
+        # search for derivative first, the records could point at files which have
+        # since been removed so use the most recent one whose file still exists
+        derivative_record = next(
+            (
+                record
+                for record in DerivativeFileRecord.get_by_hash(self.hash)
+                if record.filepath is not None and os.path.exists(record.filepath)
+            ),
+            None,
+        )
+        if derivative_record is not None:
+            core_record = derivative_record.core_record
 
         # if the core record hasn't been found by searching for the derivative, try and
         # find it now
@@ -286,29 +646,50 @@ class DownloadRunManager:
         filters, reducing data duplication.
         :returns: the core record
         """
-        if not os.path.exists(self.core_folder_path):
-            os.makedirs(self.core_folder_path)
+        resource_totals, field_counts = self.build_core(
+            list(self.core_record.resource_ids_and_versions)
+        )
+        core_record = self.update_core_record(resource_totals, field_counts)
+        # all the core files have been written so other downloads can use them now
+        core_record.add_to_catalogue(self.get_datastore_resource_ids())
+        return core_record
+
+    def build_core(self, resource_ids: List[str]) -> Tuple[dict, dict]:
+        """
+        Generates the core files for the given resources if they don't already exist.
+
+        :param resource_ids: the IDs of the resources to generate core files for
+        :returns: a tuple of two dicts, resource IDs -> record totals and resource IDs
+            -> field counts
+        """
+        os.makedirs(self.core_folder_path, exist_ok=True)
+
+        resources_and_versions = {
+            rid: self.core_record.resource_ids_and_versions[rid] for rid in resource_ids
+        }
 
         # check if there are new resources to generate
         existing_files = os.listdir(self.core_folder_path)
         resources_to_generate = {
             rid: v
-            for rid, v in self.core_record.resource_ids_and_versions.items()
+            for rid, v in resources_and_versions.items()
             if f'{rid}_{v}.avro' not in existing_files
             and v != common.NON_DATASTORE_VERSION
         }
 
         # todo: are these needed?
-        resource_totals = {k: 0 for k in self.core_record.resource_ids_and_versions}
-        field_counts = {k: None for k in self.core_record.resource_ids_and_versions}
+        resource_totals = {k: 0 for k in resources_and_versions}
+        field_counts = {k: None for k in resources_and_versions}
 
         # get info for resources that weren't just generated first, so we know if they
         # need regenerating
         existing_resources = [
             k
-            for k, v in self.core_record.resource_ids_and_versions.items()
+            for k, v in resources_and_versions.items()
             if k not in resources_to_generate and v != common.NON_DATASTORE_VERSION
         ]
+        # checkpoints left by previous attempts to generate core files for this record
+        checkpoints = self.core_record.checkpoints or {}
         for resource_id in existing_resources:
             # find a matching core record
             record = CoreFileRecord.find_resource(
@@ -320,54 +701,109 @@ class DownloadRunManager:
                 resource_totals[resource_id] = record.resource_totals[resource_id]
                 field_counts[resource_id] = record.field_counts[resource_id]
             else:
-                # if there's no record we should regenerate the avro file
+                # if there's no record we should regenerate the avro file, unless it
+                # was only partly generated and can be resumed
                 resource_version = self.core_record.resource_ids_and_versions[
                     resource_id
                 ]
-                core_file_path = os.path.join(
-                    self.core_folder_path, f'{resource_id}_{resource_version}.avro'
-                )
-                os.remove(core_file_path)
+                if resource_id not in checkpoints:
+                    core_file_path = os.path.join(
+                        self.core_folder_path, f'{resource_id}_{resource_version}.avro'
+                    )
+                    os.remove(core_file_path)
                 resources_to_generate[resource_id] = resource_version
 
         if len(resources_to_generate) > 0:
+            # in single pass mode the field counts and schema are worked out during the
+            # scan, otherwise they're retrieved from elasticsearch first
+            single_pass = is_single_pass()
+            core_files = []
             for resource_id, version in resources_to_generate.items():
-                self.request.update_status(DownloadRequest.state_core_gen, resource_id)
-
-                resource_totals[resource_id] = 0
-                field_counts[resource_id] = calculate_field_counts(
-                    resource_id, version, self.query
+                if not single_pass:
+                    field_counts[resource_id] = calculate_field_counts(
+                        resource_id, version, self.query
+                    )
+                core_files.append(
+                    CoreFile(
+                        resource_id,
+                        version,
+                        os.path.join(
+                            self.core_folder_path, f'{resource_id}_{version}.avro'
+                        ),
+                        None
+                        if single_pass
+                        else get_schema(resource_id, version, self.query),
+                        self.core_options,
+                        checkpoint=checkpoints.get(resource_id),
+                    )
                 )
 
-                database = get_database(resource_id)
-                search = database.search(version).filter(self.query.to_dsl())
+            # for storing the slice files
+            temp_dir = tempfile.mkdtemp()
+            self._temp.append(temp_dir)
 
-                schema = fastavro.parse_schema(
-                    get_schema(resource_id, version, self.query)
-                )
+            generate_core_files(
+                core_files,
+                self.query.to_dsl(),
+                temp_dir,
+                lambda core_file: self.request.update_progress(
+                    DownloadRequest.state_core_gen, core_file.resource_id
+                ),
+                single_pass,
+                lambda core_file, checkpoint: self.core_record.set_checkpoint(
+                    core_file.resource_id, checkpoint
+                ),
+            )
+            for core_file in core_files:
+                resource_totals[core_file.resource_id] = core_file.total
+                if single_pass:
+                    field_counts[core_file.resource_id] = core_file.field_counts
 
-                fn = f'{resource_id}_{version}.avro'
-                fp = os.path.join(self.core_folder_path, fn)
+        return resource_totals, field_counts
 
-                codec_kwargs = dict(codec='bzip2', codec_compression_level=9)
-                chunk_size = 10000
-                with open(fp, 'wb') as f:
-                    fastavro.writer(f, schema, [], **codec_kwargs)
+    def count_core(self):
+        """
+        Retrieves the record totals and field counts for each resource without
+        generating any core files. This is used when the records are streamed straight
+        from Elasticsearch into the derivative.
 
-                def _flush(record_block):
-                    with open(fp, 'a+b') as outfile:
-                        fastavro.writer(outfile, None, record_block, **codec_kwargs)
+        :returns: the core record
+        """
+        resource_totals, field_counts = self.count_resources(
+            self.get_datastore_resource_ids()
+        )
+        return self.update_core_record(resource_totals, field_counts)
+
+    def count_resources(self, resource_ids: List[str]) -> Tuple[dict, dict]:
+        """
+        Retrieves the record totals and field counts for the given datastore resources.
+
+        :param resource_ids: the resource IDs
+        :returns: a tuple of two dicts, resource IDs -> record totals and resource IDs
+            -> field counts
+        """
+        resource_totals = {}
+        field_counts = {}
+        for resource_id in resource_ids:
+            version = self.resource_ids_and_versions[resource_id]
+            self.request.update_progress(DownloadRequest.state_core_gen, resource_id)
+            resource_totals[resource_id] = count_records(
+                resource_id, version, self.query.to_dsl()
+            )
+            field_counts[resource_id] = calculate_field_counts(
+                resource_id, version, self.query
+            )
+        return resource_totals, field_counts
 
-                chunk = []
-                for hit in search.scan():
-                    data = rebuild_data(hit.data.to_dict())
-                    resource_totals[resource_id] += 1
-                    chunk.append(data)
-                    if len(chunk) == chunk_size:
-                        _flush(chunk)
-                        chunk = []
-                _flush(chunk)
+    def update_core_record(self, resource_totals: dict, field_counts: dict):
+        """
+        Adds the non-datastore resources to the given totals and field counts and then
+        saves them on the core record.
 
+        :param resource_totals: dict of resource IDs -> record totals
+        :param field_counts: dict of resource IDs -> field counts
+        :returns: the core record
+        """
         non_datastore_resources = [
             k
             for k, v in self.resource_ids_and_versions.items()
@@ -385,6 +821,45 @@ class DownloadRunManager:
 
         return self.core_record
 
+    def read_records(self, resource_id: str, version: int) -> Iterable[dict]:
+        """
+        Yields the records for the given resource, either from its core file or, if
+        this download is streaming directly, from Elasticsearch.
+
+        :param resource_id: the resource ID
+        :param version: the resource version
+        :returns: yields the records' data
+        """
+        if self.direct:
+            yield from scan_records(resource_id, version, self.query.to_dsl())
+        else:
+            core_file_path = os.path.join(
+                self.core_folder_path, f'{resource_id}_{version}.avro'
+            )
+            with open(core_file_path, 'rb') as core_file:
+                yield from fastavro.reader(core_file)
+
+    def load_schema(self, resource_id: str) -> Optional[dict]:
+        """
+        Returns the Avro schema of the given resource's records. This is read from the
+        resource's core file or, if this download is streaming directly, created from
+        Elasticsearch at the resource's version.
+
+        :param resource_id: the resource ID
+        :returns: the schema as a dict, or None if the resource isn't a datastore
+            resource
+        """
+        version = self.resource_ids_and_versions.get(resource_id)
+        if version is None or version == common.NON_DATASTORE_VERSION:
+            return None
+        if self.direct:
+            return get_schema(resource_id, version, self.query)
+        core_file_path = os.path.join(
+            self.core_folder_path, f'{resource_id}_{version}.avro'
+        )
+        with open(core_file_path, 'rb') as core_file:
+            return json.loads(fastavro.reader(core_file).metadata['avro.schema'])
+
     def generate_derivative(self):
         """
         Generates derivative files, if necessary.
@@ -397,7 +872,8 @@ class DownloadRunManager:
         if self.derivative_record.filepath is None:
             # if this _is_ defined, we don't need to generate the file
             zip_name = f'{self.hash}.zip'
-            zip_path = os.path.join(self.download_dir, zip_name)
+            zip_path = get_shard_path(self.download_dir, zip_name)
+            os.makedirs(os.path.dirname(zip_path), exist_ok=True)
 
             self.derivative_record.update(filepath=zip_path)
 
@@ -445,6 +921,8 @@ class DownloadRunManager:
                         )
                         for rid in self.resource_ids_and_versions
                     }
+                    for generator in components.values():
+                        generator.schema_loader = self.load_schema
                 else:
                     gen = get_derivative_generator(
                         self.derivative_options.format,
@@ -454,6 +932,7 @@ class DownloadRunManager:
                         **self.derivative_options.format_args,
                     )
                     components = defaultdict(lambda: gen)
+                    gen.schema_loader = self.load_schema
 
                 # load transformation functions
                 transformations = [
@@ -473,11 +952,8 @@ class DownloadRunManager:
                         # don't generate empty files unless there's only one resource
                         continue
                     derivative_generator = components[resource_id]
-                    core_file_path = os.path.join(
-                        self.core_folder_path, f'{resource_id}_{version}.avro'
-                    )
-                    with derivative_generator, open(core_file_path, 'rb') as core_file:
-                        for record in fastavro.reader(core_file):
+                    with derivative_generator:
+                        for record in self.read_records(resource_id, version):
                             # apply the transformations first
                             for transform in transformations:
                                 record = transform(record)
@@ -0,0 +1,331 @@
+import logging
+import os
+from contextlib import suppress
+from dataclasses import dataclass, field
+from datetime import datetime
+from glob import iglob
+from typing import Dict, List, Optional
+
+from ckan.lib.redis import connect_to_redis
+from ckan.model import Session
+from ckan.plugins import plugin_loaded, toolkit
+from sqlalchemy import func
+
+from ckanext.versioned_datastore.lib.downloads.queues import DEFAULT_QUEUE
+from ckanext.versioned_datastore.lib.downloads.utils import SHARD_LENGTH
+from ckanext.versioned_datastore.model.downloads import (
+    CoreFileRecord,
+    DerivativeFileRecord,
+    DownloadRequest,
+)
+
+log = logging.getLogger(__name__)
+
+# the redis key used to make sure the periodic eviction job isn't queued more often than
+# the configured interval
+EVICTION_KEY = 'ckanext.versioned_datastore.download_eviction'
+
+POLICIES = ('lru', 'lfu')
+
+
+def get_budget() -> Optional[int]:
+    """
+    Returns the maximum number of bytes the core and derivative download files can use
+    on disk before the least used are evicted. If this is None, files are never evicted.
+
+    :returns: the budget in bytes, or None
+    """
+    budget = toolkit.config.get('ckanext.versioned_datastore.download_disk_budget')
+    return int(budget) if budget else None
+
+
+def get_policy() -> str:
+    """
+    Returns how files are chosen for eviction, either 'lru' (least recently used first)
+    or 'lfu' (least frequently used first).
+
+    :returns: the policy name
+    """
+    return toolkit.config.get(
+        'ckanext.versioned_datastore.download_eviction_policy', 'lru'
+    ).lower()
+
+
+def get_grace_period() -> int:
+    """
+    Returns the number of seconds after it was last modified that a file is protected
+    from eviction. This stops files which are still being written from being removed.
+
+    :returns: the number of seconds
+    """
+    return int(
+        toolkit.config.get(
+            'ckanext.versioned_datastore.download_eviction_grace', 24 * 60 * 60
+        )
+    )
+
+
+def get_interval() -> int:
+    """
+    Returns the minimum number of seconds between each run of the eviction job which is
+    queued after downloads complete.
+
+    :returns: the number of seconds
+    """
+    return int(
+        toolkit.config.get(
+            'ckanext.versioned_datastore.download_eviction_interval', 60 * 60
+        )
+    )
+
+
+@dataclass
+class CachedFile:
+    """
+    A core or derivative file in the download directory.
+    """
+
+    path: str
+    # the size of the file in bytes
+    size: int
+    # when the file was last modified
+    modified: datetime
+    # the time of the most recent download request which used the file, or the
+    # modified time if there are none
+    last_used: datetime
+    # the number of download requests which used the file
+    uses: int = 0
+    # the IDs of the core or derivative records which refer to the file
+    record_ids: List[str] = field(default_factory=list)
+    # whether this is a derivative zip (True) or a core avro file (False)
+    derivative: bool = False
+    # the ID of the resource in a core avro file
+    resource_id: Optional[str] = None
+
+
+def _get_usage(record_column, request_column) -> Dict[str, tuple]:
+    """
+    Retrieves the time of the most recent request and the number of requests for each
+    record in the given table.
+
+    :param record_column: the record table's ID column
+    :param request_column: the request table's column referencing the record
+    :returns: a dict of record IDs -> 2-tuples of the last request time (or None) and
+        the number of requests
+    """
+    rows = (
+        Session.query(
+            record_column,
+            func.max(DownloadRequest.created),
+            func.count(DownloadRequest.id),
+        )
+        .outerjoin(DownloadRequest, request_column == record_column)
+        .group_by(record_column)
+        .all()
+    )
+    return {record_id: (last, count) for record_id, last, count in rows}
+
+
+def _add_use(
+    cached_file: CachedFile, record_id: str, last: Optional[datetime], count: int
+):
+    cached_file.record_ids.append(record_id)
+    cached_file.uses += count
+    if last is not None and last > cached_file.last_used:
+        cached_file.last_used = last
+
+
+def _stat(path: str, derivative: bool) -> Optional[CachedFile]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    modified = datetime.utcfromtimestamp(stat.st_mtime)
+    # files which haven't been requested since they were created are treated as having
+    # last been used when they were created
+    return CachedFile(path, stat.st_size, modified, modified, derivative=derivative)
+
+
+def find_files(download_dir: str) -> List[CachedFile]:
+    """
+    Finds the core and derivative files in the given download directory and works out
+    their size and how much they have been used from the download requests which
+    referred to them.
+
+    :param download_dir: the download directory
+    :returns: a list of CachedFile objects
+    """
+    cached_files = {}
+    # files can be directly in their directory or in a shard directory, regardless of
+    # the current sharding setting
+    shard = '?' * SHARD_LENGTH
+
+    for pattern in ('*.zip', os.path.join(shard, '*.zip')):
+        for path in iglob(os.path.join(download_dir, pattern)):
+            cached_file = _stat(path, True)
+            if cached_file is not None:
+                cached_files[path] = cached_file
+    usage = _get_usage(DerivativeFileRecord.id, DownloadRequest.derivative_id)
+    for record_id, filepath in Session.query(
+        DerivativeFileRecord.id, DerivativeFileRecord.filepath
+    ).filter(DerivativeFileRecord.filepath.isnot(None)):
+        if filepath in cached_files:
+            _add_use(
+                cached_files[filepath], record_id, *usage.get(record_id, (None, 0))
+            )
+
+    core_dir = os.path.join(download_dir, 'core')
+    for pattern in (os.path.join('*', '*.avro'), os.path.join(shard, '*', '*.avro')):
+        for path in iglob(os.path.join(core_dir, pattern)):
+            cached_file = _stat(path, False)
+            if cached_file is not None:
+                cached_files[path] = cached_file
+    usage = _get_usage(CoreFileRecord.id, DownloadRequest.core_id)
+    for record_id, query_hash, resource_ids_and_versions in Session.query(
+        CoreFileRecord.id,
+        CoreFileRecord.query_hash,
+        CoreFileRecord.resource_ids_and_versions,
+    ):
+        folders = (
+            os.path.join(core_dir, query_hash),
+            os.path.join(core_dir, query_hash[:SHARD_LENGTH], query_hash),
+        )
+        for resource_id, version in resource_ids_and_versions.items():
+            for folder in folders:
+                path = os.path.join(folder, f'{resource_id}_{version}.avro')
+                if path in cached_files:
+                    cached_files[path].resource_id = resource_id
+                    _add_use(
+                        cached_files[path], record_id, *usage.get(record_id, (None, 0))
+                    )
+
+    return list(cached_files.values())
+
+
+def is_pinned(cached_file: CachedFile) -> bool:
+    """
+    Checks whether the given file is used by a download of a query which has a DOI. If
+    the query_dois plugin isn't loaded, nothing is pinned.
+
+    :param cached_file: the file
+    :returns: True if the file shouldn't be evicted, False if it can be
+    """
+    if not plugin_loaded('query_dois') or not cached_file.record_ids:
+        return False
+
+    from ckanext.query_dois.lib.doi import find_existing_doi
+    from ckanext.query_dois.lib.query import Query
+
+    column = (
+        DownloadRequest.derivative_id
+        if cached_file.derivative
+        else DownloadRequest.core_id
+    )
+    requests = Session.query(DownloadRequest).filter(column.in_(cached_file.record_ids))
+    # requests for the same record are for the same query, so only one of each needs to
+    # be checked
+    checked = set()
+    for request in requests:
+        key = request.derivative_id if cached_file.derivative else request.core_id
+        if key in checked:
+            continue
+        checked.add(key)
+        with suppress(Exception):
+            if find_existing_doi(Query.create_from_download_request(request)):
+                return True
+    return False
+
+
+def evict(cached_file: CachedFile):
+    """
+    Deletes the given file and updates the records which refer to it so that it is
+    regenerated the next time it's needed.
+
+    :param cached_file: the file
+    """
+    with suppress(FileNotFoundError):
+        os.remove(cached_file.path)
+    if cached_file.derivative:
+        if cached_file.record_ids:
+            Session.query(DerivativeFileRecord).filter(
+                DerivativeFileRecord.id.in_(cached_file.record_ids)
+            ).update({'filepath': None}, synchronize_session=False)
+            Session.commit()
+    elif cached_file.resource_id is not None:
+        # core files are regenerated if they're missing from the core folder, but the
+        # core records still need to stop claiming to have the file. The folder is left
+        # in place, even if it's empty, as another download could be about to write to it
+        CoreFileRecord.remove_resource(cached_file.record_ids, cached_file.resource_id)
+
+
+def collect(
+    download_dir: Optional[str] = None,
+    budget: Optional[int] = None,
+    policy: Optional[str] = None,
+    dry_run: bool = False,
+) -> List[CachedFile]:
+    """
+    Evicts download files until the total size of the files in the download directory
+    is within the budget. Files are evicted least recently used first or least
+    frequently used first depending on the policy. Files used by queries with DOIs and
+    files modified within the grace period are never evicted.
+
+    :param download_dir: the download directory, defaults to the configured one
+    :param budget: the budget in bytes, defaults to the configured one
+    :param policy: 'lru' or 'lfu', defaults to the configured one
+    :param dry_run: if True, work out which files would be evicted without evicting them
+    :returns: the evicted files
+    """
+    download_dir = download_dir or toolkit.config.get(
+        'ckanext.versioned_datastore.download_dir'
+    )
+    budget = budget if budget is not None else get_budget()
+    policy = (policy or get_policy()).lower()
+    if policy not in POLICIES:
+        raise ValueError(f'Unknown eviction policy: {policy}')
+    if download_dir is None or budget is None:
+        return []
+
+    cached_files = find_files(download_dir)
+    total = sum(cached_file.size for cached_file in cached_files)
+    if total <= budget:
+        return []
+
+    if policy == 'lru':
+        cached_files.sort(key=lambda f: (f.last_used, f.uses))
+    else:
+        cached_files.sort(key=lambda f: (f.uses, f.last_used))
+
+    now = datetime.utcnow()
+    grace = get_grace_period()
+    evicted = []
+    for cached_file in cached_files:
+        if total <= budget:
+            break
+        if (now - cached_file.modified).total_seconds() < grace:
+            continue
+        if is_pinned(cached_file):
+            continue
+        if not dry_run:
+            evict(cached_file)
+        log.info(f'Evicted {cached_file.path} ({cached_file.size} bytes)')
+        evicted.append(cached_file)
+        total -= cached_file.size
+    return evicted
+
+
+def queue_collection():
+    """
+    Queues a job to evict download files, as long as a budget is configured and one
+    hasn't been queued within the configured interval. This is called after each
+    download completes so that eviction runs periodically without needing a scheduler.
+    """
+    if get_budget() is None:
+        return
+    try:
+        if connect_to_redis().set(EVICTION_KEY, 1, nx=True, ex=get_interval()):
+            toolkit.enqueue_job(
+                collect, queue=DEFAULT_QUEUE, title='Evict download files'
+            )
+    except Exception as e:
+        log.warning(f'Failed to queue download eviction: {e}')
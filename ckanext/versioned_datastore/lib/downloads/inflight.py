@@ -0,0 +1,100 @@
+import json
+import logging
+from typing import Iterable, Optional
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+# the prefix of the redis keys which store the download currently generating each
+# download hash or record hash, along with the ID of its final job
+IN_FLIGHT_KEY = 'ckanext.versioned_datastore.downloads_in_flight'
+# downloads release their keys when they finish, but this won't happen if the worker
+# dies so the keys also expire after this many seconds (the download timeout)
+IN_FLIGHT_TTL = 24 * 60 * 60
+
+
+def should_coalesce() -> bool:
+    """
+    Returns whether downloads which are identical to one already being generated should
+    wait for it and use its results instead of generating their own.
+
+    :returns: True if downloads should be coalesced, False if not
+    """
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.versioned_datastore.download_coalesce', True)
+    )
+
+
+def _get_key(download_hash: str) -> str:
+    return f'{IN_FLIGHT_KEY}.{download_hash}'
+
+
+def get_claim(download_hash: str) -> Optional[dict]:
+    """
+    Returns the details of the download request currently generating the files for the
+    given hash, if there is one. If redis is unavailable, None is returned so that the
+    download is generated as normal.
+
+    :param download_hash: the download hash or record hash
+    :returns: None if the hash hasn't been claimed, otherwise a dict containing the
+        request_id and job_id of the request which has claimed the hash
+    """
+    try:
+        current = connect_to_redis().get(_get_key(download_hash))
+    except Exception as e:
+        log.warning(f'Failed to check for in flight download {download_hash}: {e}')
+        return None
+    return json.loads(current) if current is not None else None
+
+
+def claim(download_hash: str, request_id: str, job_id: str) -> Optional[dict]:
+    """
+    Attempts to register the given download request as the one generating the files for
+    the given hash. If another request has already claimed the hash, its details are
+    returned instead. If redis is unavailable the claim is assumed to succeed so that
+    the download is generated as normal.
+
+    Other downloads depend on the given job once the claim has been made, so it must
+    already have been enqueued.
+
+    :param download_hash: the download hash or record hash
+    :param request_id: the download request's ID
+    :param job_id: the ID of the request's final job, which other downloads can depend
+        on
+    :returns: None if the claim succeeded, otherwise a dict containing the request_id
+        and job_id of the request which has already claimed the hash
+    """
+    key = _get_key(download_hash)
+    value = json.dumps({'request_id': request_id, 'job_id': job_id})
+    try:
+        redis = connect_to_redis()
+        if redis.set(key, value, nx=True, ex=IN_FLIGHT_TTL):
+            return None
+        current = redis.get(key)
+    except Exception as e:
+        log.warning(f'Failed to check for in flight download {download_hash}: {e}')
+        return None
+    # if the other request released its claim in the meantime then it has finished and
+    # this one can just carry on as normal
+    return json.loads(current) if current is not None else None
+
+
+def release(download_hashes: Iterable[str], request_id: str):
+    """
+    Removes the given download request's claim on each of the given hashes. Claims made
+    by other requests are left alone.
+
+    :param download_hashes: the download hashes and record hashes claimed by the request
+    :param request_id: the download request's ID
+    """
+    try:
+        redis = connect_to_redis()
+        for download_hash in download_hashes:
+            key = _get_key(download_hash)
+            current = redis.get(key)
+            if current is not None and json.loads(current)['request_id'] == request_id:
+                redis.delete(key)
+    except Exception as e:
+        log.warning(f'Failed to release in flight download {request_id}: {e}')
@@ -0,0 +1,154 @@
+import logging
+import time
+from typing import Optional, Tuple
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+SMALL_QUEUE = 'download-small'
+DEFAULT_QUEUE = 'download'
+LARGE_QUEUE = 'download-large'
+# all the download queues, in the order workers should take jobs from them
+DOWNLOAD_QUEUES = [SMALL_QUEUE, DEFAULT_QUEUE, LARGE_QUEUE]
+
+# the prefix of the redis keys which store the downloads each user has in progress, as a
+# sorted set of request IDs scored by the time they were queued
+IN_PROGRESS_KEY = 'ckanext.versioned_datastore.downloads_in_progress'
+# downloads are removed from the set when they finish, but this won't happen if the
+# worker dies so they are also ignored after this many seconds (the download timeout)
+IN_PROGRESS_TTL = 24 * 60 * 60
+
+
+def get_size_limits() -> Tuple[Optional[int], Optional[int]]:
+    """
+    Returns the record counts used to decide which queue a download goes on. Downloads
+    with at most the small limit of records go on the small queue and downloads with
+    more than the large limit go on the large queue. Everything else, and everything if
+    neither limit is set, goes on the default download queue.
+
+    :returns: a tuple of the small limit and the large limit, either can be None
+    """
+    limits = (
+        toolkit.config.get('ckanext.versioned_datastore.download_small_limit'),
+        toolkit.config.get('ckanext.versioned_datastore.download_large_limit'),
+    )
+    return tuple(int(limit) if limit else None for limit in limits)
+
+
+def is_sized() -> bool:
+    """
+    :returns: whether downloads are routed to queues based on their size
+    """
+    return any(limit is not None for limit in get_size_limits())
+
+
+def get_estimate_timeout() -> float:
+    """
+    Returns the number of seconds to wait for a download's records to be counted when
+    choosing its queue. This happens while the download is being requested, so it
+    should be short. Downloads which can't be counted in time go on the default queue.
+
+    :returns: the timeout in seconds
+    """
+    return float(
+        toolkit.config.get('ckanext.versioned_datastore.download_estimate_timeout', 5)
+    )
+
+
+def get_queue_name(size: Optional[int]) -> str:
+    """
+    Returns the name of the queue a download with the given number of records should go
+    on.
+
+    :param size: the number of records in the download, or None if it isn't known
+    :returns: the queue name
+    """
+    if size is None:
+        return DEFAULT_QUEUE
+    small, large = get_size_limits()
+    if small is not None and size <= small:
+        return SMALL_QUEUE
+    if large is not None and size > large:
+        return LARGE_QUEUE
+    return DEFAULT_QUEUE
+
+
+def get_user_limit() -> int:
+    """
+    Returns the maximum number of downloads a single user can have queued or running at
+    once. If this is 0, there is no limit.
+
+    :returns: the limit
+    """
+    return int(
+        toolkit.config.get('ckanext.versioned_datastore.download_user_limit', 0) or 0
+    )
+
+
+def _get_key(owner: str) -> str:
+    return f'{IN_PROGRESS_KEY}.{owner}'
+
+
+def add_in_progress(owner: Optional[str], request_id: str):
+    """
+    Records that the given user has a download in progress, raising a ValidationError
+    if this takes them over the maximum number of downloads they can have in progress.
+    The download is added and the user's downloads are counted in one transaction so
+    that concurrent requests from the same user can't all get under the limit. If the
+    download takes the user over the limit it is removed again.
+
+    :param owner: the user's name, can be None if no one is logged in in which case
+        there is no limit
+    :param request_id: the download request's ID
+    """
+    limit = get_user_limit()
+    if not owner or limit <= 0:
+        return
+    key = _get_key(owner)
+    try:
+        redis = connect_to_redis()
+        with redis.pipeline() as pipeline:
+            pipeline.zremrangebyscore(key, '-inf', time.time() - IN_PROGRESS_TTL)
+            pipeline.zadd(key, {request_id: time.time()})
+            pipeline.zcard(key)
+            pipeline.expire(key, IN_PROGRESS_TTL)
+            in_progress = pipeline.execute()[2]
+        if in_progress > limit:
+            redis.zrem(key, request_id)
+    except Exception as e:
+        log.warning(f'Failed to record download {request_id} in progress: {e}')
+        return
+    if in_progress > limit:
+        raise toolkit.ValidationError(
+            f'You already have {in_progress - 1} downloads in progress, please wait '
+            f'for them to finish before requesting another'
+        )
+
+
+def remove_in_progress(owner: Optional[str], request_id: str):
+    """
+    Records that the given user's download is no longer in progress.
+
+    :param owner: the user's name, can be None
+    :param request_id: the download request's ID
+    """
+    if not owner:
+        return
+    try:
+        connect_to_redis().zrem(_get_key(owner), request_id)
+    except Exception as e:
+        log.warning(f'Failed to remove download {request_id} from in progress: {e}')
+
+
+def get_owner(context: dict) -> Optional[str]:
+    """
+    Works out who is requesting a download for the user limit. This is the logged in
+    user's name. Anonymous users aren't limited, as behind a reverse proxy the request's
+    address is usually the same for everyone.
+
+    :param context: the CKAN action context
+    :returns: the user's name, or None if no one is logged in
+    """
+    return context.get('user') or None
@@ -15,5 +15,7 @@ class DirectFileServer(BaseFileServer):
             return site_url + f'/downloads/custom/{self.filename}.zip'
 
         filepath = request.derivative_record.filepath
-        filename = os.path.split(filepath)[-1]
+        download_dir = toolkit.config.get('ckanext.versioned_datastore.download_dir')
+        # the file may be in a shard directory within the download dir
+        filename = os.path.relpath(filepath, download_dir).replace(os.sep, '/')
         return site_url + f'/downloads/direct/{filename}'
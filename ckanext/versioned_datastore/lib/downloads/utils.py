@@ -1,10 +1,30 @@
-from typing import Dict, List, Optional, Union
+import json
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Union
 
+from ckan.plugins import toolkit
 from splitgill.indexing.fields import DataField
 
 from ckanext.versioned_datastore.lib.query.search.query import SchemaQuery
 from ckanext.versioned_datastore.lib.utils import get_database
 
+# the number of characters from the start of a hash used to name its shard directory
+SHARD_LENGTH = 2
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def _fallback_dumps(data) -> bytes:
+    return _encoder.encode(data).encode('utf-8')
+
+
+try:
+    # much faster than the standard library and produces the same compact output
+    from orjson import dumps
+except ImportError:
+    dumps = _fallback_dumps
+
 
 def _get_field_type(field: DataField) -> List[Union[str, dict]]:
     """
@@ -91,6 +111,196 @@ def get_schema(
     return schema
 
 
+class FieldTypes:
+    """
+    Collects the types of the values found in a field across a set of records so that
+    an Avro schema can be created for the field without asking Elasticsearch.
+    """
+
+    def __init__(self):
+        # the basic Avro types found (string, long, double, boolean)
+        self.basic: Set[str] = set()
+        # the types of the elements of any list values found
+        self.element: Optional['FieldTypes'] = None
+        # the types of the children of any dict values found
+        self.children: Optional[Dict[str, 'FieldTypes']] = None
+
+    def add(self, value):
+        """
+        Adds the type of the given value to this field's types.
+
+        :param value: the value
+        """
+        # bool must be checked before int as it's a subclass
+        if isinstance(value, bool):
+            self.basic.add('boolean')
+        elif isinstance(value, int):
+            self.basic.add('long')
+        elif isinstance(value, float):
+            self.basic.add('double')
+        elif isinstance(value, str):
+            self.basic.add('string')
+        elif isinstance(value, list):
+            if self.element is None:
+                self.element = FieldTypes()
+            for element in value:
+                self.element.add(element)
+        elif isinstance(value, dict):
+            if self.children is None:
+                self.children = {}
+            for name, child_value in value.items():
+                if name not in self.children:
+                    self.children[name] = FieldTypes()
+                self.children[name].add(child_value)
+        # None values aren't recorded but the field will still exist in the schema
+
+    def update(self, other: 'FieldTypes'):
+        """
+        Adds the types from the other FieldTypes object to this one.
+
+        :param other: the other FieldTypes object
+        """
+        self.basic.update(other.basic)
+        if other.element is not None:
+            if self.element is None:
+                self.element = FieldTypes()
+            self.element.update(other.element)
+        if other.children is not None:
+            if self.children is None:
+                self.children = {}
+            for name, child in other.children.items():
+                if name not in self.children:
+                    self.children[name] = FieldTypes()
+                self.children[name].update(child)
+
+    def to_avro(self, path: str) -> List[Union[str, dict]]:
+        """
+        Creates the Avro type information for this field. This mirrors the types
+        created by _get_field_type from Elasticsearch's view of the data.
+
+        :param path: the path of the field, used to name records
+        :returns: the Avro types for the field
+        """
+        types = [
+            avro_type
+            for avro_type in ('string', 'long', 'double', 'boolean')
+            if avro_type in self.basic
+        ]
+        if self.element is not None:
+            types.append({'type': 'array', 'items': [self.element.to_avro(f'{path}.')]})
+        if self.children is not None:
+            types.append(
+                {
+                    'type': 'record',
+                    'name': f'{path}Record',
+                    'fields': [
+                        {'name': name, 'type': child.to_avro(f'{path}.{name}')}
+                        for name, child in sorted(self.children.items())
+                    ],
+                }
+            )
+        types.append('null')
+        return types
+
+    def paths(self, path: str) -> Set[str]:
+        """
+        Returns the paths of the values at and below this field, in the same form as
+        the field counts. List elements share the path of the list they're in.
+
+        :param path: the path of this field
+        :returns: a set of paths
+        """
+        paths = set()
+        # fields which only ever had None values or empty lists in them still exist
+        if self.basic or (self.element is None and self.children is None):
+            paths.add(path)
+        if self.element is not None:
+            paths.update(self.element.paths(path))
+        for name, child in (self.children or {}).items():
+            paths.update(child.paths(f'{path}.{name}' if path else name))
+        return paths
+
+
+class RecordStats:
+    """
+    Collects the field counts and field types of a set of records as they are read so
+    that the field counts and Avro schema don't have to be retrieved from Elasticsearch
+    with separate aggregations.
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.types = FieldTypes()
+
+    def add(self, record: dict):
+        """
+        Adds the given record to the stats.
+
+        :param record: the record's data
+        """
+        self.types.add(record)
+        for path in get_present_paths(record):
+            self.counts[path] += 1
+
+    def update(self, other: 'RecordStats'):
+        """
+        Adds the stats from the other RecordStats object to this one.
+
+        :param other: the other RecordStats object
+        """
+        for path, count in other.counts.items():
+            self.counts[path] += count
+        self.types.update(other.types)
+
+    def field_counts(self) -> Dict[str, int]:
+        """
+        :returns: a dict of field paths -> the number of records with a value in them,
+            including the fields in the schema which never had a value in them
+        """
+        counts = {
+            path: 0
+            for name, types in (self.types.children or {}).items()
+            for path in types.paths(name)
+        }
+        counts.update(self.counts)
+        return counts
+
+    def schema(self) -> dict:
+        """
+        :returns: an Avro schema for the records as a dict
+        """
+        return {
+            'type': 'record',
+            'name': 'Record',
+            'fields': [
+                {'name': name, 'type': types.to_avro(name)}
+                for name, types in sorted((self.types.children or {}).items())
+            ],
+        }
+
+
+def get_present_paths(data: dict, prefix: Optional[str] = None) -> Set[str]:
+    """
+    Finds the paths of the fields in the given data which have a value. Like the field
+    counts from Elasticsearch, nulls and empty strings aren't counted as values and
+    the elements of lists are treated as values of the list's field.
+
+    :param data: the data dict
+    :param prefix: the path the data dict is at, if it's nested
+    :returns: a set of dot separated field paths
+    """
+    paths = set()
+    for name, value in data.items():
+        path = f'{prefix}.{name}' if prefix is not None else name
+        values = value if isinstance(value, list) else [value]
+        for element in values:
+            if isinstance(element, dict):
+                paths.update(get_present_paths(element, path))
+            elif element is not None and element != '':
+                paths.add(path)
+    return paths
+
+
 def get_fields(field_counts, ignore_empty_fields, resource_id=None):
     """
     Return a sorted list of field names for the resource ids specified using the field
@@ -263,3 +473,51 @@ def flatten_dict(data, path=None, separator=' | '):
             flat[key] = value
 
     return flat
+
+
+def flatten_to_row(record: dict, columns: Dict[str, int]) -> list:
+    """
+    Flattens the given record with flatten_dict and puts its values into a list at the
+    positions of their fields. Positions for fields without a value are None.
+
+    :param record: the record's data
+    :param columns: a dict of flattened field names -> positions in the row
+    :returns: the row as a list
+    """
+    row = [None] * len(columns)
+    for field, value in flatten_dict(record).items():
+        position = columns.get(field)
+        if position is None:
+            if value is None:
+                continue
+            raise ValueError(f'Unexpected field ({field})')
+        row[position] = value
+    return row
+
+
+def is_sharded() -> bool:
+    """
+    Returns whether new download files and core folders are stored in subdirectories
+    named after the start of their hash rather than all together in one directory. This
+    stops the directories getting huge when there are lots of downloads.
+
+    :returns: True if the download directories are sharded, False if not
+    """
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.versioned_datastore.download_sharded', False)
+    )
+
+
+def get_shard_path(directory: str, name: str) -> str:
+    """
+    Returns the path of the file or folder with the given name in the given directory.
+    If sharding is enabled, this is inside a subdirectory named after the first
+    characters of the name (which should be a hash).
+
+    :param directory: the parent directory
+    :param name: the file or folder name
+    :returns: the path
+    """
+    if is_sharded():
+        return os.path.join(directory, name[:SHARD_LENGTH], name)
+    return os.path.join(directory, name)
@@ -6,6 +6,7 @@ from rq.job import Job
 from splitgill.indexing.syncing import BulkOptions
 from splitgill.model import IngestResult, Record
 
+from ckanext.versioned_datastore.lib import status
 from ckanext.versioned_datastore.lib.importing.details import (
     create_details,
     get_last_file_hash,
@@ -15,6 +16,7 @@ from ckanext.versioned_datastore.lib.importing.ingest import (
     iter_records,
 )
 from ckanext.versioned_datastore.lib.importing.readers import choose_reader_for_resource
+from ckanext.versioned_datastore.lib.query.search import cache as search_cache
 from ckanext.versioned_datastore.lib.tasks import Task
 from ckanext.versioned_datastore.lib.utils import (
     ReadOnlyResourceException,
@@ -259,37 +261,53 @@ class SyncResourceTask(Task):
         return self.resource['id']
 
     def run(self, tmpdir: Path):
-        with ImportStats.track(self.resource_id, INDEX) as stats:
-            database = get_database(self.resource_id)
-            index_version = database.get_elasticsearch_version()
-            data_version = database.get_committed_version()
-            # indicate that we've started doing something
-            stats.update(count=0)
-
-            if not self.full and index_version == data_version:
-                # nothing to do
-                self.log.info('Elasticsearch is already in sync, nothing to do')
-            else:
-                # work out how many records will be affected by the sync
-                if self.full or index_version is None:
-                    count = database.data_collection.count_documents({})
+        try:
+            with ImportStats.track(self.resource_id, INDEX) as stats:
+                database = get_database(self.resource_id)
+                index_version = database.get_elasticsearch_version()
+                data_version = database.get_committed_version()
+                # indicate that we've started doing something
+                stats.update(count=0)
+
+                if not self.full and index_version == data_version:
+                    # nothing to do
+                    self.log.info('Elasticsearch is already in sync, nothing to do')
                 else:
-                    count = database.data_collection.count_documents(
-                        {'version': {'$gt': index_version}}
+                    # work out how many records will be affected by the sync
+                    if self.full or index_version is None:
+                        count = database.data_collection.count_documents({})
+                    else:
+                        count = database.data_collection.count_documents(
+                            {'version': {'$gt': index_version}}
+                        )
+
+                    # use fairly modest values for syncing
+                    sync_options = BulkOptions(100, 2, 3)
+                    # do the sync and log/save info
+                    result = database.sync(bulk_options=sync_options, resync=self.full)
+                    index_version = database.get_elasticsearch_version()
+                    stats.update(
+                        operations={
+                            'deleted': result.deleted,
+                            'indexed': result.indexed,
+                        },
+                        count=count,
+                        version=index_version,
                     )
-
-                # use fairly modest values for syncing
-                sync_options = BulkOptions(100, 2, 3)
-                # do the sync and log/save info
-                result = database.sync(bulk_options=sync_options, resync=self.full)
-                stats.update(
-                    operations={'deleted': result.deleted, 'indexed': result.indexed},
-                    count=count,
-                    version=database.get_elasticsearch_version(),
-                )
-                self.log.info(
-                    f'Finished, indexed: {result.indexed}, deleted: {result.deleted}'
-                )
+                    self.log.info(
+                        f'Finished, indexed: {result.indexed}, deleted: {result.deleted}'
+                    )
+        except Exception:
+            # the sync may have written some data to Elasticsearch before it failed, so
+            # the stored versions can't be trusted anymore and must be reloaded
+            status.clear()
+            raise
+
+        # let all processes know about the resource's new version so that any cached
+        # search responses that could have been affected are no longer used
+        search_cache.bump_generation(self.resource_id, index_version)
+        # and keep the stored datastore status of the resource up to date
+        status.set_version(self.resource_id, index_version)
 
         # refresh the data about this package in the solr search index to ensure that
         # the datastore_active flag is set correctly. The flag is actually set in the
@@ -1,9 +1,12 @@
 import abc
+import copy
 import itertools
 import json
+import threading
 from collections import OrderedDict
 from typing import List
 
+from cachetools import LRUCache, cached
 from elasticsearch_dsl.query import Query as DSLQuery
 from importlib_resources import files
 from jsonschema.validators import RefResolver, validator_for
@@ -13,6 +16,37 @@ schema_base_path = (
     files('ckanext.versioned_datastore.theme') / 'public' / 'querySchemas'
 )
 
+# the maximum number of queries to hold the validation, translation, and hash results of
+# in each process-wide cache
+QUERY_CACHE_SIZE = 1024
+_validated_cache = LRUCache(maxsize=QUERY_CACHE_SIZE)
+_translated_cache = LRUCache(maxsize=QUERY_CACHE_SIZE)
+_hashed_cache = LRUCache(maxsize=QUERY_CACHE_SIZE)
+_query_cache_lock = threading.Lock()
+
+
+def query_cache_key(query: dict, version: str) -> tuple:
+    """
+    Creates a key to use in the query caches for the given query and version. Key order
+    is ignored so that equal queries share a key. The version's schema settings are
+    included too so that results created with different settings aren't reused.
+
+    :param query: the query dict
+    :param version: the query version
+    :returns: a hashable key
+    """
+    settings = schemas[version].get_settings() if version in schemas else ()
+    return version, settings, json.dumps(query, sort_keys=True, default=str)
+
+
+def clear_query_caches():
+    """
+    Empties the process-wide caches of query validation, translation, and hash results.
+    """
+    with _query_cache_lock:
+        for cache in (_validated_cache, _translated_cache, _hashed_cache):
+            cache.clear()
+
 
 def register_schema(version: str, schema: dict):
     """
@@ -33,6 +67,8 @@ def register_schema(version: str, schema: dict):
             key=lambda vs: [int(u) for u in vs[0][1:].split('.')],
         )
     )
+    # the schema for a version may have changed so remove any cached results
+    clear_query_caches()
 
 
 def get_latest_query_version() -> str:
@@ -49,11 +85,12 @@ class InvalidQuerySchemaVersionError(Exception):
         super(Exception, self).__init__(f'Invalid query version: {version}')
 
 
+@cached(_validated_cache, key=query_cache_key, lock=_query_cache_lock)
 def validate_query(query: dict, version: str) -> bool:
     """
     Validate the given query dict against the query schema for the given version. If the
     version doesn't match any registered schemas then an InvalidQuerySchemaVersionError
-    will be raised.
+    will be raised. Successful validations are cached.
 
     :param query: the query dict
     :param version: the query schema version to validate against
@@ -76,12 +113,19 @@ def translate_query(query: dict, version: str) -> DSLQuery:
     :param version: the query schema version to translate using
     :returns: an instantiated Elasticsearch DSL Query object
     """
+    # translations are cached, return a copy so that the cached object can't be changed
+    return copy.deepcopy(_translate_query(query, version))
+
+
+@cached(_translated_cache, key=query_cache_key, lock=_query_cache_lock)
+def _translate_query(query: dict, version: str) -> DSLQuery:
     if version not in schemas:
         raise InvalidQuerySchemaVersionError(version)
     else:
         return get_schema(version).translate(query)
 
 
+@cached(_hashed_cache, key=query_cache_key, lock=_query_cache_lock)
 def hash_query(query: dict, version: str) -> str:
     """
     Hashes the given query at the given version and returns the unique digest.
@@ -181,3 +225,12 @@ class Schema(abc.ABC):
         :returns: the corrected/normalised query dict
         """
         return query
+
+    def get_settings(self) -> tuple:
+        """
+        Returns the current values of any config settings which change how queries are
+        translated or hashed by this schema. These are included in the query cache keys.
+
+        :returns: a hashable tuple of setting values
+        """
+        return ()
@@ -1,10 +1,18 @@
 import hashlib
 import io
 import json
+import logging
+import os
 import string
+import tempfile
+import threading
 from collections import defaultdict
-from typing import Optional
+from collections.abc import Mapping
+from typing import Dict, List, Optional, Tuple
 
+from ckan.plugins import toolkit
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
 from elasticsearch_dsl.query import EMPTY_QUERY, Bool, Q, Query
 from splitgill.search import (
     ALL_POINTS,
@@ -24,8 +32,53 @@ from ckanext.versioned_datastore.lib.query.schema import (
 from ckanext.versioned_datastore.lib.query.utils import (
     convert_small_or_groups,
     remove_empty_groups,
+    simplify_multipolygon,
 )
 
+log = logging.getLogger(__name__)
+
+# bump this if the format of the named area lookups changes to invalidate cached files
+NAMED_AREA_CACHE_FORMAT = 2
+
+
+def get_geojson_cache_dir() -> Optional[str]:
+    """
+    Returns the directory the compiled named area lookups should be cached in. This
+    defaults to a directory in CKAN's storage path. If no directory is configured and
+    there is no storage path, None is returned and the lookups aren't cached.
+
+    :returns: the directory path or None
+    """
+    cache_dir = toolkit.config.get('ckanext.versioned_datastore.geojson_cache_dir')
+    if cache_dir:
+        return cache_dir
+    storage_path = toolkit.config.get('ckan.storage_path')
+    if storage_path:
+        return os.path.join(storage_path, 'vds_geojson')
+    return None
+
+
+def get_named_area_index() -> Optional[str]:
+    """
+    Returns the name of the Elasticsearch index the named area shapes have been loaded
+    into, or None if they haven't been and the shapes should be included in queries.
+
+    :returns: the index name or None
+    """
+    return toolkit.config.get('ckanext.versioned_datastore.named_area_index') or None
+
+
+def get_named_area_tolerance() -> float:
+    """
+    Returns the tolerance, in degrees, to simplify named area shapes with. If this is 0
+    then the shapes are not simplified.
+
+    :returns: the tolerance
+    """
+    return float(
+        toolkit.config.get('ckanext.versioned_datastore.named_area_tolerance', 0) or 0
+    )
+
 
 class v1_0_0Schema(Schema):
     """
@@ -36,19 +89,28 @@ class v1_0_0Schema(Schema):
 
     def __init__(self):
         self.schema, self.validator = load_core_schema(v1_0_0Schema.version)
-        self.geojson = {
-            'country': self.load_geojson(
-                '50m-admin-0-countries-v4.1.0.geojson', ('NAME_EN', 'NAME')
-            ),
-            # if we use name_en we end up with one atlantic ocean whereas if we use name
-            # we get 2 - the "North Atlantic Ocean" and the "South Atlantic Ocean". I
-            # think this is preferable.
-            'marine': self.load_geojson('50m-marine-regions-v4.1.0.geojson', ('name',)),
-            'geography': self.load_geojson(
-                '50m-geography-regions-v4.1.0.geojson', ('name_en', 'name')
-            ),
-        }
+        # the geojson files are large and slow to parse so they're only loaded when a
+        # category is first used
+        self.geojson = NamedAreas(
+            {
+                'country': (
+                    '50m-admin-0-countries-v4.1.0.geojson',
+                    ('NAME_EN', 'NAME'),
+                ),
+                # if we use name_en we end up with one atlantic ocean whereas if we use
+                # name we get 2 - the "North Atlantic Ocean" and the "South Atlantic
+                # Ocean". I think this is preferable.
+                'marine': ('50m-marine-regions-v4.1.0.geojson', ('name',)),
+                'geography': (
+                    '50m-geography-regions-v4.1.0.geojson',
+                    ('name_en', 'name'),
+                ),
+            }
+        )
         self.hasher = v1_0_0Hasher()
+        # cache of (category, name, tolerance) -> geo_named_area queries, these are used
+        # read only so the same object can be shared between translated queries
+        self.named_area_queries = {}
 
     def validate(self, query: dict):
         """
@@ -67,6 +129,15 @@ class v1_0_0Schema(Schema):
         """
         return self.hasher.hash_query(query)
 
+    def get_settings(self) -> tuple:
+        """
+        Returns the named area index and tolerance, which change the shapes used by
+        geo_named_area queries.
+
+        :returns: a 2-tuple of the named area index and tolerance
+        """
+        return get_named_area_index(), get_named_area_tolerance()
+
     def normalise(self, query):
         """
         Corrects some (small) common query errors, e.g. removing empty groups.
@@ -308,12 +379,116 @@ class v1_0_0Schema(Schema):
         numbers of points. See the `theme/public/querySchemas/geojson/` directory for
         source data and readme, and also the load_geojson function in this class.
 
+        If the named area shapes have been loaded into an index (see
+        index_named_areas), a geo_shape query referencing the indexed shape is returned
+        instead, which keeps the request small and lets Elasticsearch reuse the shape.
+
         :param options: the options for the geo_named_area query
-        :returns: an elasticsearch-dsl Query object (a single geo_polygon Query or a
-            Bool Query)
+        :returns: an elasticsearch-dsl Query object (a single geo_polygon or geo_shape
+            Query or a Bool Query)
         """
         category, name = next(iter(options.items()))
-        return self.build_multipolygon_query(self.geojson[category][name])
+
+        index = get_named_area_index()
+        if index is not None:
+            return Q(
+                'geo_shape',
+                **{
+                    ALL_POINTS: {
+                        'indexed_shape': {
+                            'index': index,
+                            'id': self.get_named_area_id(category, name),
+                            'path': 'shape',
+                        }
+                    }
+                },
+            )
+
+        tolerance = get_named_area_tolerance()
+        key = (category, name, tolerance)
+        if key not in self.named_area_queries:
+            self.named_area_queries[key] = self.build_multipolygon_query(
+                self.get_named_area(category, name, tolerance)
+            )
+        return self.named_area_queries[key]
+
+    def get_named_area(
+        self, category: str, name: str, tolerance: float = 0
+    ) -> List[list]:
+        """
+        Returns the MultiPolygon coordinates of the given named area, simplified using
+        the given tolerance.
+
+        :param category: the named area category (e.g. country)
+        :param name: the name of the area
+        :param tolerance: the tolerance to simplify the shape with, in degrees
+        :returns: the MultiPolygon coordinates list
+        """
+        return simplify_multipolygon(self.geojson[category][name], tolerance)
+
+    @staticmethod
+    def get_named_area_id(category: str, name: str) -> str:
+        """
+        Returns the ID of the document representing the given named area in the named
+        area index.
+
+        :param category: the named area category (e.g. country)
+        :param name: the name of the area
+        :returns: the document ID
+        """
+        return f'{category}:{name}'
+
+    def index_named_areas(
+        self, client: Elasticsearch, index: str, tolerance: float = 0
+    ) -> Tuple[int, int]:
+        """
+        Loads all the named area shapes into the given index so that they can be
+        referenced by geo_named_area queries. The index is created if it doesn't exist
+        and any existing shapes are replaced.
+
+        :param client: the Elasticsearch client to use
+        :param index: the name of the index to load the shapes into
+        :param tolerance: the tolerance to simplify the shapes with, in degrees
+        :returns: the number of shapes indexed and the number that failed to index
+        """
+        if not client.indices.exists(index=index):
+            client.indices.create(
+                index=index,
+                mappings={
+                    'properties': {
+                        'category': {'type': 'keyword'},
+                        'name': {'type': 'keyword'},
+                        'shape': {'type': 'geo_shape'},
+                    }
+                },
+            )
+
+        def actions():
+            for category, lookup in self.geojson.items():
+                for name in lookup:
+                    yield {
+                        '_index': index,
+                        '_id': self.get_named_area_id(category, name),
+                        '_source': {
+                            'category': category,
+                            'name': name,
+                            'shape': {
+                                'type': 'MultiPolygon',
+                                'coordinates': self.get_named_area(
+                                    category, name, tolerance
+                                ),
+                            },
+                        },
+                    }
+
+        indexed = failed = 0
+        for ok, _ in streaming_bulk(client, actions(), raise_on_error=False):
+            if ok:
+                indexed += 1
+            else:
+                failed += 1
+        client.indices.refresh(index=index)
+        return indexed, failed
 
     def create_geo_custom_area(self, coordinates):
         """
@@ -422,6 +597,8 @@ class v1_0_0Schema(Schema):
         # make sure we read the file using utf-8
         with io.open(path.joinpath(filename), 'r', encoding='utf-8') as f:
             lookup = defaultdict(list)
+            # the polygons already added to each name, in a hashable form
+            seen = defaultdict(set)
             for feature in json.load(f)['features']:
                 # find the first name key with a value and pass it to string.capwords
                 name = string.capwords(
@@ -450,11 +627,114 @@ class v1_0_0Schema(Schema):
                 for polygon in coordinates:
                     # if a polygon is already represented in the MultiPolygon, ignore
                     # the dupe
-                    if polygon not in lookup[name]:
+                    key = tuple(tuple(map(tuple, ring)) for ring in polygon)
+                    if key not in seen[name]:
+                        seen[name].add(key)
                         lookup[name].append(polygon)
 
             return lookup
 
+    @staticmethod
+    def load_cached_geojson(filename, name_keys):
+        """
+        Returns the same lookup as load_geojson but uses a compiled copy of the lookup
+        from the geojson cache directory if one is available, which is much faster to
+        load. If there isn't a compiled copy, the geojson file is loaded and a compiled
+        copy is written for next time. The compiled copies are stored as JSON so that
+        loading them can't run arbitrary code, even if the cache directory is writable
+        by others.
+
+        :param filename: the name geojson file to load from the given path
+        :param name_keys: a priority ordered sequence of keys to use for feature name
+            retrieval
+        :returns: a dict of names -> MultiPolygons
+        """
+        cache_dir = get_geojson_cache_dir()
+        if cache_dir is None:
+            return v1_0_0Schema.load_geojson(filename, name_keys)
+
+        source = (
+            schema_base_path.joinpath(v1_0_0Schema.version)
+            .joinpath('geojson')
+            .joinpath(filename)
+        )
+        # the cache file is tied to the source file so that it's rebuilt if the source
+        # changes
+        stat = os.stat(str(source))
+        signature = '|'.join(
+            map(
+                str,
+                (
+                    NAMED_AREA_CACHE_FORMAT,
+                    filename,
+                    name_keys,
+                    stat.st_size,
+                    stat.st_mtime,
+                ),
+            )
+        )
+        digest = hashlib.sha1(signature.encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, f'{filename}.{digest}.json')
+
+        try:
+            with io.open(cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning(f'Failed to load cached named areas from {cache_path}: {e}')
+
+        lookup = v1_0_0Schema.load_geojson(filename, name_keys)
+        temp_path = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file and then move it into place so that other
+            # processes never see a partially written file
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with io.open(fd, 'w', encoding='utf-8') as f:
+                json.dump(lookup, f)
+            os.replace(temp_path, cache_path)
+        except Exception as e:
+            log.warning(f'Failed to cache named areas to {cache_path}: {e}')
+        finally:
+            # this only exists if the file wasn't moved into place
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+        return lookup
+
+
+class NamedAreas(Mapping):
+    """
+    A lazy mapping of named area categories -> lookups of names -> MultiPolygons. Each
+    category's geojson file is only loaded when the category is first accessed.
+    """
+
+    def __init__(self, sources: Dict[str, Tuple[str, Tuple[str, ...]]]):
+        """
+        :param sources: a dict of categories -> the geojson filename and name keys to
+            pass to v1_0_0Schema.load_cached_geojson
+        """
+        self.sources = sources
+        self._lookups = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, category: str) -> Dict[str, list]:
+        lookup = self._lookups.get(category)
+        if lookup is None:
+            filename, name_keys = self.sources[category]
+            with self._lock:
+                lookup = self._lookups.get(category)
+                if lookup is None:
+                    lookup = v1_0_0Schema.load_cached_geojson(filename, name_keys)
+                    self._lookups[category] = lookup
+        return lookup
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
 
 class v1_0_0Hasher:
     """
@@ -625,12 +905,18 @@ class v1_0_0Hasher:
     def create_geo_named_area(options):
         """
         Given the options for a geo_named_area term, creates and returns a string
-        version of it.
+        version of it. If the named area shapes are simplified, the tolerance is
+        included as it changes the shape searched. The named area index isn't included
+        as searching the indexed shapes matches the same records as the inlined ones.
 
         :param options: the options for the geo_named_area query
         :returns: a string representing the term
         """
-        return 'geo_named_area:{};{}'.format(*next(iter(options.items())))
+        term = 'geo_named_area:{};{}'.format(*next(iter(options.items())))
+        tolerance = get_named_area_tolerance()
+        if tolerance:
+            term = f'{term};{tolerance}'
+        return term
 
     def create_geo_custom_area(self, coordinates):
         """
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import logging
+import threading
+from typing import Dict, Iterable, List, MutableMapping, Optional, Tuple
+
+from cachetools import LRUCache, TTLCache
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+
+log = logging.getLogger(__name__)
+
+# the redis key prefix used to store the Elasticsearch version each resource was last
+# synced at, this is shared between all web and worker processes
+GENERATION_KEY_PREFIX = 'ckanext.versioned_datastore.search_generation'
+
+# the caches are created on first use so that the config is available when they are
+# sized. Responses for searches pinned at a historic version can never change so they
+# live in an LRU, everything else lives in a TTL cache as a safety net for missed
+# invalidations
+_pinned_cache: Optional[LRUCache] = None
+_latest_cache: Optional[TTLCache] = None
+# cachetools caches aren't thread safe
+_lock = threading.Lock()
+
+
+def get_cache_size() -> int:
+    """
+    Returns the maximum number of search responses to hold in each of the search caches
+    in this process. If this is 0, search response caching is disabled.
+
+    :returns: the cache size
+    """
+    return int(
+        toolkit.config.get('ckanext.versioned_datastore.search_cache_size', 0) or 0
+    )
+
+
+def get_cache_ttl() -> int:
+    """
+    Returns the number of seconds responses to unpinned searches should be cached for.
+
+    :returns: the ttl in seconds
+    """
+    return int(toolkit.config.get('ckanext.versioned_datastore.search_cache_ttl', 300))
+
+
+def is_enabled() -> bool:
+    """
+    :returns: True if search response caching is enabled, False if not
+    """
+    return get_cache_size() > 0
+
+
+def get_caches():
+    """
+    Retrieves the pinned and latest caches, creating them if necessary.
+
+    :returns: a 2-tuple of the pinned LRU cache and the latest TTL cache
+    """
+    global _pinned_cache, _latest_cache
+    if _pinned_cache is None or _latest_cache is None:
+        size = get_cache_size()
+        _pinned_cache = LRUCache(maxsize=size)
+        _latest_cache = TTLCache(maxsize=size, ttl=get_cache_ttl())
+    return _pinned_cache, _latest_cache
+
+
+def clear():
+    """
+    Empties the search caches in this process.
+    """
+    with _lock:
+        for cache in get_caches():
+            cache.clear()
+
+
+def _generation_key(resource_id: str) -> str:
+    return f'{GENERATION_KEY_PREFIX}.{resource_id}'
+
+
+def get_generations(resource_ids: Iterable[str]) -> Dict[str, Optional[int]]:
+    """
+    Retrieves the Elasticsearch version each of the given resources was last synced at,
+    as recorded by bump_generation. Resources which haven't been synced since the
+    generations started being recorded have a value of None.
+
+    :param resource_ids: the resource IDs
+    :returns: a dict of resource IDs -> versions or None
+    """
+    resource_ids = sorted(set(resource_ids))
+    if not resource_ids:
+        return {}
+    values = connect_to_redis().mget([_generation_key(rid) for rid in resource_ids])
+    return {
+        resource_id: int(value) if value is not None else None
+        for resource_id, value in zip(resource_ids, values)
+    }
+
+
+def bump_generation(resource_id: str, version: Optional[int]):
+    """
+    Records that the given resource has been synced to Elasticsearch at the given
+    version. This invalidates any cached search responses involving the resource that
+    weren't pinned at a version the resource had already reached.
+
+    :param resource_id: the resource ID
+    :param version: the resource's Elasticsearch version, can be None
+    """
+    key = _generation_key(resource_id)
+    try:
+        redis = connect_to_redis()
+        if version is None:
+            redis.delete(key)
+        else:
+            redis.set(key, version)
+    except Exception as e:
+        log.warning(f'Failed to update search generation for {resource_id}: {e}')
+
+
+def is_pinned(version: Optional[int], generations: Dict[str, Optional[int]]) -> bool:
+    """
+    Determines whether a search at the given version can be cached indefinitely. This is
+    only the case when the version is at or below the version every resource in the
+    search has already been synced to, as no new data can be added at or before it.
+
+    :param version: the version being searched, None means latest
+    :param generations: the generations of the resources being searched
+    :returns: True if the search is pinned, False if not
+    """
+    if version is None or not generations:
+        return False
+    return all(
+        generation is not None and version <= generation
+        for generation in generations.values()
+    )
+
+
+def make_key(
+    search: Search,
+    req_params: dict,
+    generations: Optional[Dict[str, Optional[int]]] = None,
+) -> str:
+    """
+    Creates the cache key for the given search. The key is made up of the compiled
+    search body, the indexes, the request parameters and optionally the resource
+    generations.
+
+    :param search: the Search object that will be run
+    :param req_params: the request parameters the search will be run with
+    :param generations: the resource generations to include, or None if the search is
+        pinned and the generations are irrelevant
+    :returns: a hex digest
+    """
+    to_hash = {
+        'body': search.to_dict(),
+        'indexes': sorted(search._index or []),
+        'params': req_params,
+        'generations': generations,
+    }
+    key_data = json.dumps(to_hash, sort_keys=True, default=str)
+    return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+
+def get_slot(
+    search: Search,
+    req_params: dict,
+    resource_ids: List[str],
+    version: Optional[int],
+) -> Optional[Tuple[MutableMapping, str]]:
+    """
+    Works out which cache and key the response for the given search should be stored
+    under. If the resource generations can't be retrieved, None is returned and the
+    search should not be cached.
+
+    :param search: the Search object that will be run
+    :param req_params: the request parameters the search will be run with
+    :param resource_ids: the resources being searched
+    :param version: the version being searched, or None if it isn't version specific
+    :returns: None or a 2-tuple of the cache and the key
+    """
+    try:
+        generations = get_generations(resource_ids)
+    except Exception as e:
+        log.warning(f'Failed to retrieve search generations, not caching: {e}')
+        return None
+
+    pinned_cache, latest_cache = get_caches()
+    if is_pinned(version, generations):
+        return pinned_cache, make_key(search, req_params)
+    else:
+        return latest_cache, make_key(search, req_params, generations)
+
+
+def get_response(slot: Tuple[MutableMapping, str]) -> Optional[Response]:
+    """
+    Retrieves the cached response in the given slot, if there is one.
+
+    :param slot: the cache slot, as returned by get_slot
+    :returns: a Response object or None
+    """
+    cache, key = slot
+    with _lock:
+        return cache.get(key)
+
+
+def set_response(slot: Tuple[MutableMapping, str], response: Response):
+    """
+    Stores the given response in the given slot.
+
+    :param slot: the cache slot, as returned by get_slot
+    :param response: the Response object
+    """
+    cache, key = slot
+    with _lock:
+        cache[key] = response
+
+
+def run_cached(
+    search: Search,
+    req_params: dict,
+    resource_ids: List[str],
+    version: Optional[int],
+    execute,
+) -> Response:
+    """
+    Returns the response for the given search from the cache if available, otherwise
+    calls execute and caches the result.
+
+    :param search: the Search object that will be run
+    :param req_params: the request parameters the search will be run with
+    :param resource_ids: the resources being searched
+    :param version: the version being searched, or None if it isn't version specific
+    :param execute: a function which runs the search and returns a Response
+    :returns: a Response object
+    """
+    slot = get_slot(search, req_params, resource_ids, version)
+    if slot is None:
+        return execute()
+
+    response = get_response(slot)
+    if response is None:
+        response = execute()
+        set_response(slot, response)
+    return response
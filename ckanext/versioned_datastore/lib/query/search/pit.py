@@ -0,0 +1,106 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+from typing import Iterable, List, Optional, Tuple
+
+from ckan.plugins import toolkit
+
+from ckanext.versioned_datastore.lib.utils import es_client
+
+log = logging.getLogger(__name__)
+
+
+def get_keep_alive() -> str:
+    """
+    Returns how long a point in time should be kept alive for between each page of
+    results. This is an Elasticsearch time value (e.g. "1m") and is extended every time
+    the point in time is used.
+
+    :returns: the keep alive time value
+    """
+    return toolkit.config.get('ckanext.versioned_datastore.pit_keep_alive', '1m')
+
+
+# the search request parameters which are also used when opening a point in time
+OPEN_PARAMS = {'ignore_unavailable', 'expand_wildcards', 'preference', 'routing'}
+
+
+def open_pit(indexes: List[str], **params) -> str:
+    """
+    Opens a point in time over the given indexes and returns its ID.
+
+    :param indexes: the indexes to open the point in time on
+    :param params: any additional parameters to pass with the request (e.g.
+        ignore_unavailable)
+    :returns: the point in time ID
+    """
+    response = es_client().open_point_in_time(
+        index=','.join(indexes), keep_alive=get_keep_alive(), **params
+    )
+    return response['id']
+
+
+def close_pit(pit_id: str):
+    """
+    Closes the given point in time. Points in time close themselves when their keep
+    alive expires so failures are logged and ignored.
+
+    :param pit_id: the point in time ID
+    """
+    try:
+        es_client().close_point_in_time(id=pit_id)
+    except Exception as e:
+        log.warning(f'Failed to close point in time: {e}')
+
+
+def get_target_hash(resource_ids: Iterable[str], version: Optional[int]) -> str:
+    """
+    Creates a hash of the resources and version a point in time search is over. These
+    decide which indexes the point in time is opened on, so the hash is stored in the
+    cursor to make sure it's only used to carry on the same search. The hash doesn't
+    use the index names themselves as they can change as the resources are synced,
+    even though the point in time is still valid.
+
+    :param resource_ids: the resource IDs
+    :param version: the version, or None if the search isn't version specific
+    :returns: the hash as a hex string
+    """
+    data = json.dumps([sorted(resource_ids), version], separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def encode_cursor(pit_id: str, after: list, target: str) -> str:
+    """
+    Creates a cursor token from the given point in time ID, search after value and
+    target hash. The token is opaque to users and should be passed back as-is to get
+    the next page of results.
+
+    :param pit_id: the point in time ID
+    :param after: the search after value
+    :param target: the hash of the resources and version searched, as created by
+        get_target_hash
+    :returns: the cursor token
+    """
+    data = json.dumps(
+        {'pit': pit_id, 'after': after, 'target': target}, separators=(',', ':')
+    )
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, Optional[list], str]:
+    """
+    Decodes a cursor token created by encode_cursor back into the point in time ID,
+    search after value and target hash. If the cursor is invalid, a ValidationError is
+    raised.
+
+    :param cursor: the cursor token
+    :returns: a 3-tuple of the point in time ID, the search after value and the target
+        hash
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return data['pit'], data['after'], data['target']
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+        raise toolkit.ValidationError(f'Invalid cursor: {cursor}')
@@ -96,13 +96,47 @@ class SchemaQuery(Query):
         :param query_version: the query version to use (defaults to latest if not given)
         """
         super().__init__('schema', resource_ids, version)
-        self.query_version = (
+        self._query = {}
+        self._query_version = (
             query_version if query_version else get_latest_query_version()
         )
+        self._reset()
         if query:
             self.query = normalise_query(query, self.query_version)
-        else:
-            self.query = {}
+
+    def _reset(self):
+        """
+        Clears the memoised validation, hash, and DSL of this query. This is called
+        whenever the query or query version is replaced. The query dict should not be
+        modified in place.
+        """
+        self._validated = False
+        self._hash = None
+        self._dsl = None
+
+    @property
+    def query(self) -> dict:
+        """
+        :returns: the normalised query dict
+        """
+        return self._query
+
+    @query.setter
+    def query(self, query: dict):
+        self._query = query
+        self._reset()
+
+    @property
+    def query_version(self) -> str:
+        """
+        :returns: the query schema version
+        """
+        return self._query_version
+
+    @query_version.setter
+    def query_version(self, query_version: str):
+        self._query_version = query_version
+        self._reset()
 
     @property
     def hash(self) -> str:
@@ -111,7 +145,9 @@ class SchemaQuery(Query):
 
         :returns: the hash as a str
         """
-        return hash_query(self.query, self.query_version)
+        if self._hash is None:
+            self._hash = hash_query(self.query, self.query_version)
+        return self._hash
 
     def validate(self):
         """
@@ -119,17 +155,22 @@ class SchemaQuery(Query):
 
         If valid, nothing happens, if not valid, an error will be raised.
         """
-        validate_query(self.query, self.query_version)
+        if not self._validated:
+            validate_query(self.query, self.query_version)
+            self._validated = True
 
     def to_dsl(self) -> DSLQuery:
         """
         Checks that the query is valid according to the schema and then translates it to
-        a Search object.
+        a Search object. The result is memoised so the same object is returned each time
+        this is called.
 
         :returns: a Search object
         """
-        self.validate()
-        return translate_query(self.query, self.query_version)
+        if self._dsl is None:
+            self.validate()
+            self._dsl = translate_query(self.query, self.query_version)
+        return self._dsl
 
 
 class BasicQuery(Query):
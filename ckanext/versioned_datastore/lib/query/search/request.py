@@ -1,7 +1,9 @@
 import dataclasses
+from functools import partial
 from typing import Any, Dict, List, Optional
 
 from ckan.plugins import toolkit
+from elasticsearch.exceptions import NotFoundError
 from elasticsearch_dsl import AttrDict, MultiSearch, Search
 from elasticsearch_dsl.aggs import A
 from elasticsearch_dsl.query import Bool
@@ -9,7 +11,9 @@ from elasticsearch_dsl.response import Response
 from splitgill.indexing.fields import DocumentField
 from splitgill.search import rebuild_data, version_query
 
+from ckanext.versioned_datastore.lib.query.search import cache, pit
 from ckanext.versioned_datastore.lib.query.search.query import Query
+from ckanext.versioned_datastore.lib.query.search.routing import get_version_indexes
 from ckanext.versioned_datastore.lib.query.search.sort import Sort
 from ckanext.versioned_datastore.lib.utils import (
     es_client,
@@ -45,6 +49,11 @@ class SearchRequest:
     ignore_auth: bool = False
     # optional additional request parameters to be included when performing the search
     req_params: dict = dataclasses.field(default_factory=dict)
+    # setting this to True will cause the search to be run against a point in time
+    # (PIT), which provides a consistent view of the data for deep pagination. If no
+    # pit_id is set when the request is run, a new point in time will be opened
+    pit: bool = False
+    pit_id: Optional[str] = None
 
     def add_param(self, param: str, value: Any):
         """
@@ -57,6 +66,33 @@ class SearchRequest:
         """
         self.req_params[param] = value
 
+    def set_cursor(self, cursor: str):
+        """
+        Sets this request up to continue paginating from the given cursor. The cursor
+        contains the point in time ID and the after value from the previous page of
+        results. If the cursor was created by a search over different resources or at a
+        different version, a ValidationError is raised.
+
+        :param cursor: the cursor token, as returned by SearchResponse.next_cursor
+        """
+        pit_id, after, target = pit.decode_cursor(cursor)
+        if target != self.target_hash:
+            raise toolkit.ValidationError(
+                'This cursor was created by a search over different resources'
+            )
+        self.pit = True
+        self.pit_id = pit_id
+        self.after = after
+
+    @property
+    def target_hash(self) -> str:
+        """
+        :returns: a hash of the resources and version this request searches, which
+            determine the indexes it searches
+        """
+        version = None if self.force_no_version else self.query.version
+        return pit.get_target_hash(self.query.resource_ids, version)
+
     def add_sort(self, field: str, ascending: bool = True):
         """
         Convenience wrapper to add a sort to the sort list on the given field with the
@@ -85,14 +121,18 @@ class SearchRequest:
         A list of the indexes this request will search over. This list is created from
         the resource_ids specified in the query.
 
+        If a version is being searched, only the indexes that can contain data at that
+        version are included.
+
         :returns: a list of index names, this could include wildcards
         """
-        databases = map(get_database, self.query.resource_ids)
-
-        if self.force_no_version or self.query.version is not None:
-            # todo: could check latest version for each and optimise to latest?
+        if self.force_no_version:
+            databases = map(get_database, self.query.resource_ids)
             return [database.indices.wildcard for database in databases]
+        elif self.query.version is not None:
+            return get_version_indexes(self.query.resource_ids, self.query.version)
         else:
+            databases = map(get_database, self.query.resource_ids)
             return [database.indices.latest for database in databases]
 
     def set_no_results(self):
@@ -123,12 +163,15 @@ class SearchRequest:
 
         :returns: a new Elasticsearch Search object
         """
-        search = (
-            Search()
-            .index(self.indexes())
-            # we want to provide an accurate count, and damn the expense
-            .extra(track_total_hits=True)
-        )
+        # we want to provide an accurate count, and damn the expense
+        search = Search().extra(track_total_hits=True)
+        if self.pit_id is not None:
+            # the indexes are defined by the point in time, we can't specify them again
+            search = search.extra(
+                pit={'id': self.pit_id, 'keep_alive': pit.get_keep_alive()}
+            )
+        else:
+            search = search.index(self.indexes())
 
         search = search.query(self.query.to_dsl())
 
@@ -176,9 +219,13 @@ class SearchRequest:
                 sorts = [sort.to_sort() for sort in self.sorts]
             else:
                 sorts = [{DocumentField.VERSION: 'desc'}]
-            # TODO: can we use _doc here? Is it safe across indexes?
-            # always add the default sort to ensure search after values are unique
-            sorts.extend([Sort.desc('_id').to_sort(), {'_index': 'desc'}])
+            # always add a tiebreaker sort to ensure search after values are unique
+            if self.pit_id is not None:
+                # _shard_doc is unique within a point in time and much cheaper than
+                # sorting on the _id and _index
+                sorts.append({'_shard_doc': 'desc'})
+            else:
+                sorts.extend([Sort.desc('_id').to_sort(), {'_index': 'desc'}])
             search = search.sort(*sorts)
 
         # add any aggregations
@@ -189,15 +236,75 @@ class SearchRequest:
 
     def run(self) -> 'SearchResponse':
         """
-        Builds the search, runs it, and returns a SearchResponse object.
+        Builds the search, runs it, and returns a SearchResponse object. If search
+        response caching is enabled, the response may come from the cache.
 
         :returns: a SearchResponse object
         """
         for plugin in ivds_implementations():
             plugin.vds_before_search(self)
 
-        search = self.to_search()
+        opened_pit = False
+        if self.pit and self.pit_id is None:
+            # point in time searches sort on different fields, so the after value of a
+            # normal search can't be used to continue one. They have to be continued
+            # using the cursor from the previous page instead
+            if self.after is not None:
+                raise toolkit.ValidationError(
+                    'A point in time search can only be continued using a cursor'
+                )
+            params = {
+                param: value
+                for param, value in self.req_params.items()
+                if param in pit.OPEN_PARAMS
+            }
+            self.pit_id = pit.open_pit(self.indexes(), **params)
+            opened_pit = True
+
+        try:
+            search = self.to_search()
+        except Exception:
+            if opened_pit:
+                # the search can't be run so don't leave the point in time to expire
+                pit.close_pit(self.pit_id)
+                self.pit_id = None
+            raise
+
+        if self.pit_id is not None:
+            # point in time searches can't be cached as each response provides the
+            # point in time ID to use for the next page
+            response = SearchResponse(self, self._execute_pit(search))
+            if response.next_after is None:
+                # there are no more results, so we're done with the point in time
+                pit.close_pit(response.pit_id)
+            return response
+        elif cache.is_enabled():
+            result = cache.run_cached(
+                search,
+                self.req_params,
+                self.query.resource_ids,
+                self.cache_version,
+                partial(self._execute, search),
+            )
+        else:
+            result = self._execute(search)
+        return SearchResponse(self, result)
+
+    @property
+    def cache_version(self) -> Optional[int]:
+        """
+        :returns: the version this request should be cached at, or None if it isn't
+            version specific
+        """
+        return None if self.force_no_version else self.query.version
+
+    def _execute(self, search: Search) -> Response:
+        """
+        Runs the given search against Elasticsearch and returns the response.
 
+        :param search: the Search object to run
+        :returns: the Response object
+        """
         # use a multisearch to wrap the search to avoid any issues with URL length. When
         # you query a lot of indexes you can get errors because the URL contains all the
         # index names, comma separated, and it can cause a URL to be created which is
@@ -206,8 +313,24 @@ class SearchRequest:
         # with all parts of the search, including the indexes, as part of the payload
         multi_search = MultiSearch(using=es_client()).add(search)
         multi_search = multi_search.params(**self.req_params)
-        result = next(iter(multi_search.execute()))
-        return SearchResponse(self, result)
+        return next(iter(multi_search.execute()))
+
+    def _execute_pit(self, search: Search) -> Response:
+        """
+        Runs the given point in time search against Elasticsearch and returns the
+        response. The search is sent directly to the _search endpoint as no indexes are
+        included in the URL (they're part of the point in time) and the request
+        parameters have already been used when opening the point in time.
+
+        :param search: the Search object to run
+        :returns: the Response object
+        """
+        try:
+            return search.using(es_client()).execute()
+        except NotFoundError:
+            raise toolkit.ValidationError(
+                'The point in time for this cursor has expired or is invalid'
+            )
 
 
 @dataclasses.dataclass
@@ -325,3 +448,88 @@ class SearchResponse:
                 return list(self.hits[-1].hit.meta['sort'])
 
         return None
+
+    @property
+    def pit_id(self) -> Optional[str]:
+        """
+        Returns the point in time ID to use for the next request. Elasticsearch may
+        update the ID with each response, so this should be used in preference to the
+        ID the request was made with.
+
+        :returns: the point in time ID, or None if this isn't a point in time search
+        """
+        if self.request.pit_id is None:
+            return None
+        return self.response.to_dict().get('pit_id', self.request.pit_id)
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        """
+        Returns the cursor to be used to get the next set of results from a point in
+        time search. If this isn't a point in time search or there are no more results
+        to get, None is returned.
+
+        :returns: None or a cursor token
+        """
+        pit_id = self.pit_id
+        after = self.next_after
+        if pit_id is None or after is None:
+            return None
+        return pit.encode_cursor(pit_id, after, self.request.target_hash)
+
+
+def run_searches(requests: List[SearchRequest]) -> List[SearchResponse]:
+    """
+    Runs all the given search requests in a single _msearch request to Elasticsearch
+    and returns a SearchResponse for each, in the same order as the requests. This
+    saves a round trip per request when a number of searches need to be run together.
+    If search response caching is enabled, only the searches which aren't in the cache
+    are sent to Elasticsearch.
+
+    Point in time searches can't be run this way and a ValidationError is raised if any
+    are included.
+
+    :param requests: the SearchRequest objects
+    :returns: a list of SearchResponse objects
+    """
+    if any(request.pit for request in requests):
+        raise toolkit.ValidationError(
+            'Point in time searches cannot be run together with other searches'
+        )
+
+    searches = []
+    for request in requests:
+        for plugin in ivds_implementations():
+            plugin.vds_before_search(request)
+        searches.append(request.to_search())
+
+    results: List[Optional[Response]] = [None] * len(requests)
+    slots = [None] * len(requests)
+    if cache.is_enabled():
+        for i, (request, search) in enumerate(zip(requests, searches)):
+            slots[i] = cache.get_slot(
+                search,
+                request.req_params,
+                request.query.resource_ids,
+                request.cache_version,
+            )
+            if slots[i] is not None:
+                results[i] = cache.get_response(slots[i])
+
+    # the request parameters are set on each search so that they're included in each
+    # search's header in the _msearch body
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending:
+        multi_search = MultiSearch(using=es_client())
+        for i in pending:
+            multi_search = multi_search.add(
+                searches[i].params(**requests[i].req_params)
+            )
+        for i, result in zip(pending, multi_search.execute()):
+            results[i] = result
+            if slots[i] is not None:
+                cache.set_response(slots[i], result)
+
+    return [
+        SearchResponse(request, result) for request, result in zip(requests, results)
+    ]
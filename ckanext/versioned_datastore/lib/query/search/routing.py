@@ -0,0 +1,172 @@
+import dataclasses
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from cachetools import TTLCache
+from ckan.plugins import toolkit
+from elasticsearch_dsl import MultiSearch, Search
+from splitgill.indexing.fields import DocumentField
+
+from ckanext.versioned_datastore.lib.query.search import cache
+from ckanext.versioned_datastore.lib.utils import (
+    es_client,
+    get_database,
+    unprefix_index_name,
+)
+
+log = logging.getLogger(__name__)
+
+# the maximum number of indexes we'll retrieve spans for in one request
+MAX_INDEXES = 10000
+
+
+@dataclasses.dataclass
+class IndexSpan:
+    """
+    The range of versions the documents in an index are valid for.
+    """
+
+    index: str
+    # the lowest version of any document in the index
+    start: int
+    # the highest next version of any document in the index, or None if the documents
+    # in the index are valid indefinitely (this is the case for the latest index)
+    end: Optional[int] = None
+
+    def can_contain(self, version: int) -> bool:
+        """
+        Checks whether the index could contain any documents which are valid at the
+        given version.
+
+        :param version: the version
+        :returns: True if the index might have documents at the version, False if it
+            definitely doesn't
+        """
+        return self.start <= version and (self.end is None or version < self.end)
+
+
+# routes are cached against the resource's generation, so they are replaced as soon as
+# a sync is recorded, the TTL is just a safety net for when generations are unavailable
+_routes_cache = TTLCache(maxsize=1000, ttl=300)
+_lock = threading.Lock()
+
+
+def get_spans(resource_ids: List[str]) -> Dict[str, List[IndexSpan]]:
+    """
+    Retrieves the version spans of all indexes for each of the given resources from
+    Elasticsearch. This is done using a single aggregation over all the resources'
+    indexes.
+
+    :param resource_ids: the resource IDs
+    :returns: a dict of resource IDs -> lists of IndexSpan objects
+    """
+    spans = {resource_id: [] for resource_id in resource_ids}
+    if not resource_ids:
+        return spans
+
+    search = (
+        Search()
+        .index([get_database(resource_id).indices.wildcard for resource_id in spans])
+        .extra(size=0)
+    )
+    indexes_agg = search.aggs.bucket(
+        'indexes', 'terms', field='_index', size=MAX_INDEXES
+    )
+    indexes_agg.metric('start', 'min', field=DocumentField.VERSION)
+    indexes_agg.metric('end', 'max', field=DocumentField.NEXT)
+
+    # use a multisearch for the same reason as SearchRequest, lots of resources means
+    # lots of index names which means a very long URL
+    multi_search = MultiSearch(using=es_client()).add(search)
+    multi_search = multi_search.params(ignore_unavailable=True)
+    response = next(iter(multi_search.execute()))
+
+    for bucket in response.aggs.to_dict()['indexes']['buckets']:
+        resource_id = unprefix_index_name(bucket['key'])
+        if resource_id not in spans or bucket['start']['value'] is None:
+            continue
+        end = bucket['end']['value']
+        spans[resource_id].append(
+            IndexSpan(
+                bucket['key'],
+                int(bucket['start']['value']),
+                int(end) if end is not None else None,
+            )
+        )
+    return spans
+
+
+def get_routes(resource_ids: List[str]) -> Dict[str, List[IndexSpan]]:
+    """
+    Retrieves the index spans for each of the given resources, using cached values
+    where possible.
+
+    :param resource_ids: the resource IDs
+    :returns: a dict of resource IDs -> lists of IndexSpan objects
+    """
+    try:
+        generations = cache.get_generations(resource_ids)
+    except Exception as e:
+        log.warning(f'Failed to retrieve search generations: {e}')
+        generations = {}
+
+    routes = {}
+    missing = []
+    with _lock:
+        for resource_id in resource_ids:
+            key = (resource_id, generations.get(resource_id))
+            if key in _routes_cache:
+                routes[resource_id] = _routes_cache[key]
+            else:
+                missing.append(resource_id)
+
+    if missing:
+        spans = get_spans(missing)
+        with _lock:
+            for resource_id, resource_spans in spans.items():
+                key = (resource_id, generations.get(resource_id))
+                _routes_cache[key] = resource_spans
+        routes.update(spans)
+
+    return routes
+
+
+def get_version_indexes(resource_ids: List[str], version: int) -> List[str]:
+    """
+    Returns the indexes that need to be searched to find the data in the given resources
+    at the given version. Only the latest and archive indexes which contain documents
+    valid at the version are included. If a resource has no index information available
+    then its wildcard is used to ensure no data is missed.
+
+    :param resource_ids: the resource IDs
+    :param version: the version being searched
+    :returns: a list of index names
+    """
+    if not toolkit.asbool(
+        toolkit.config.get('ckanext.versioned_datastore.index_routing', True)
+    ):
+        return [
+            get_database(resource_id).indices.wildcard for resource_id in resource_ids
+        ]
+
+    try:
+        routes = get_routes(resource_ids)
+    except Exception as e:
+        log.warning(f'Failed to route versioned search, searching all indexes: {e}')
+        routes = {}
+
+    indexes = []
+    for resource_id in resource_ids:
+        spans = routes.get(resource_id)
+        if not spans:
+            # we don't know anything about this resource so search everything
+            indexes.append(get_database(resource_id).indices.wildcard)
+            continue
+        matching = [span.index for span in spans if span.can_contain(version)]
+        # if no index can contain data at this version then search one index we know
+        # exists. The version filter on the search will ensure nothing matches, but we
+        # can't leave the index list empty as that would result in all indexes being
+        # searched
+        indexes.extend(sorted(matching) if matching else [spans[0].index])
+    return indexes
@@ -111,6 +111,22 @@ def create_slug(
     return True, new_slug
 
 
+def is_saved_query(query: SchemaQuery) -> bool:
+    """
+    Checks whether the given query has been saved as a slug.
+
+    :param query: the query
+    :returns: True if there is a slug for the query, False if not
+    """
+    query_hash = generate_query_hash(query)
+    return (
+        model.Session.query(DatastoreSlug.id)
+        .filter(DatastoreSlug.query_hash == query_hash)
+        .first()
+        is not None
+    )
+
+
 def create_nav_slug(query: SchemaQuery) -> Tuple[bool, DatastoreSlug]:
     try:
         # clear old slugs before we make new ones
@@ -1,6 +1,7 @@
 import json
+import math
 from copy import deepcopy
-from typing import Dict
+from typing import Dict, List
 
 from ckan.plugins import toolkit
 from splitgill.utils import now
@@ -171,3 +172,75 @@ def remove_empty_groups(query):
         query['filters'] = processed_filters[0]
 
     return query
+
+
+def _distance_to_segment(point: list, start: list, end: list) -> float:
+    """
+    Calculates the planar distance between the point and the line segment from start to
+    end.
+
+    :param point: a [lon, lat] point
+    :param start: the [lon, lat] start of the segment
+    :param end: the [lon, lat] end of the segment
+    :returns: the distance, in degrees
+    """
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(point[0] - start[0], point[1] - start[1])
+    # find the projection of the point onto the segment, clamped to the segment's ends
+    t = ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / (dx * dx + dy * dy)
+    t = max(0.0, min(1.0, t))
+    return math.hypot(point[0] - (start[0] + t * dx), point[1] - (start[1] + t * dy))
+
+
+def simplify_ring(ring: List[list], tolerance: float) -> List[list]:
+    """
+    Simplifies the given linear ring using the Ramer-Douglas-Peucker algorithm, removing
+    points which are within the tolerance of the simplified line. If the simplified ring
+    would have fewer than the 4 points required for a valid ring, the ring is returned
+    unchanged.
+
+    :param ring: a list of [lon, lat] points where the first and last points are equal
+    :param tolerance: the maximum distance, in degrees, a removed point can be from the
+        simplified ring
+    :returns: the simplified ring
+    """
+    if tolerance <= 0 or len(ring) <= 4:
+        return ring
+
+    keep = [False] * len(ring)
+    keep[0] = keep[-1] = True
+    # use a stack rather than recursion as rings can contain many thousands of points
+    stack = [(0, len(ring) - 1)]
+    while stack:
+        first, last = stack.pop()
+        furthest, max_distance = None, tolerance
+        for index in range(first + 1, last):
+            distance = _distance_to_segment(ring[index], ring[first], ring[last])
+            if distance > max_distance:
+                furthest, max_distance = index, distance
+        if furthest is not None:
+            keep[furthest] = True
+            stack.append((first, furthest))
+            stack.append((furthest, last))
+
+    simplified = [point for point, kept in zip(ring, keep) if kept]
+    return simplified if len(simplified) >= 4 else ring
+
+
+def simplify_multipolygon(coordinates: List[list], tolerance: float) -> List[list]:
+    """
+    Simplifies every ring in the given GeoJSON MultiPolygon coordinates using
+    simplify_ring.
+
+    :param coordinates: the MultiPolygon coordinates list
+    :param tolerance: the maximum distance, in degrees, a removed point can be from the
+        simplified rings
+    :returns: the simplified coordinates list
+    """
+    if tolerance <= 0:
+        return coordinates
+    return [
+        [simplify_ring(ring, tolerance) for ring in polygon] for polygon in coordinates
+    ]
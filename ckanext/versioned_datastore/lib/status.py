@@ -0,0 +1,90 @@
+import logging
+from typing import Callable, Dict, Iterable, Optional
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+# the redis key of the hash which stores the Elasticsearch version of each resource with
+# data in Elasticsearch. This is shared between all web and worker processes
+VERSIONS_KEY = 'ckanext.versioned_datastore.index_versions'
+# a field which is always present in the hash once it has been loaded, this allows us to
+# tell the difference between a resource with no data and a hash which hasn't been
+# loaded
+LOADED_FIELD = '__loaded__'
+
+
+def get_ttl() -> int:
+    """
+    Returns the number of seconds the stored resource versions are kept for before they
+    are reloaded from Elasticsearch. The versions are updated after every sync so this
+    is just a safety net to correct any drift.
+
+    :returns: the ttl in seconds
+    """
+    return int(toolkit.config.get('ckanext.versioned_datastore.status_ttl', 3600))
+
+
+def get_versions(
+    resource_ids: Iterable[str], load: Callable[[], Dict[str, int]]
+) -> Dict[str, Optional[int]]:
+    """
+    Retrieves the Elasticsearch version of each of the given resources from redis. If
+    the versions haven't been loaded into redis yet, load is called to retrieve the
+    versions of all resources and they are stored for next time.
+
+    :param resource_ids: the resource IDs
+    :param load: a function which returns a dict of resource IDs -> versions for every
+        resource with data in Elasticsearch
+    :returns: a dict of resource IDs -> versions, or None if the resource has no data in
+        Elasticsearch
+    """
+    resource_ids = list(resource_ids)
+    redis = connect_to_redis()
+    values = redis.hmget(VERSIONS_KEY, [LOADED_FIELD, *resource_ids])
+    if values[0] is not None:
+        return {
+            resource_id: int(value) if value is not None else None
+            for resource_id, value in zip(resource_ids, values[1:])
+        }
+
+    versions = load()
+    with redis.pipeline() as pipeline:
+        pipeline.delete(VERSIONS_KEY)
+        pipeline.hset(VERSIONS_KEY, mapping={LOADED_FIELD: 1, **versions})
+        pipeline.expire(VERSIONS_KEY, get_ttl())
+        pipeline.execute()
+    return {resource_id: versions.get(resource_id) for resource_id in resource_ids}
+
+
+def set_version(resource_id: str, version: Optional[int]):
+    """
+    Updates the stored Elasticsearch version of the given resource. This is only done if
+    the versions have already been loaded, otherwise they'll be loaded in full the next
+    time they're needed.
+
+    :param resource_id: the resource ID
+    :param version: the resource's Elasticsearch version, can be None
+    """
+    try:
+        redis = connect_to_redis()
+        if not redis.hexists(VERSIONS_KEY, LOADED_FIELD):
+            return
+        if version is None:
+            redis.hdel(VERSIONS_KEY, resource_id)
+        else:
+            redis.hset(VERSIONS_KEY, resource_id, version)
+    except Exception as e:
+        log.warning(f'Failed to update stored version for {resource_id}: {e}')
+
+
+def clear():
+    """
+    Removes the stored Elasticsearch versions, they will be reloaded in full the next
+    time they're needed.
+    """
+    try:
+        connect_to_redis().delete(VERSIONS_KEY)
+    except Exception as e:
+        log.warning(f'Failed to clear stored versions: {e}')
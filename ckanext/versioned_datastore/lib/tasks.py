@@ -9,7 +9,7 @@ from ckan.plugins import toolkit
 from ckantools.cache import CacheClearError, clear_cache_region
 from rq.job import Job
 
-from ckanext.versioned_datastore.lib import utils
+from ckanext.versioned_datastore.lib import access, utils
 
 
 class Task(abc.ABC):
@@ -53,6 +53,7 @@ class Task(abc.ABC):
             clear_cache_region('versioned_datastore', utils, cache_name='vds')
         except CacheClearError as e:
             self.log.error(e)
+        access.invalidate()
 
     def start(self):
         """
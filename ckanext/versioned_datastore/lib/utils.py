@@ -1,13 +1,17 @@
 import logging
 import re
+import time
 from collections import defaultdict
-from typing import Dict, Iterable, List, Optional, Set, TypeVar
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Type, TypeVar
 
 from beaker.cache import cache_region
 from ckan import plugins
 from ckan.plugins import get_plugin, toolkit
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError
 from pymongo import MongoClient
+from splitgill.indexing.fields import DocumentField
 from splitgill.manager import SplitgillClient, SplitgillDatabase
 
 from ckanext.versioned_datastore.interfaces import (
@@ -15,7 +19,7 @@ from ckanext.versioned_datastore.interfaces import (
     IVersionedDatastoreDownloads,
     IVersionedDatastoreQuerySchema,
 )
-from ckanext.versioned_datastore.lib import common
+from ckanext.versioned_datastore.lib import access, common, status
 
 log = logging.getLogger(__name__)
 
@@ -45,11 +49,36 @@ def get_available_resources(
     to enable quick checking between a list of requested IDs and the list of available
     IDs.
 
+    The available resources are cached per user, see the access module for details.
+
     :param datastore_only: whether to only return resource IDs that are datastore active
     :param ignore_auth: whether to ignore authentication (default: False)
     :returns: a set of resource IDs
     """
-    resource_ids = set()
+    key = ('ignore_auth',) if ignore_auth else ('user', user_id)
+    resources = access.get_cached(
+        key, partial(load_available_resources, ignore_auth, user_id)
+    )
+    return {
+        resource_id
+        for resource_id, datastore_active in resources.items()
+        if not datastore_only or datastore_active
+    }
+
+
+def load_available_resources(
+    ignore_auth: bool = False, user_id: str = ''
+) -> Dict[str, bool]:
+    """
+    Pages through all the packages available to the given user and returns the IDs of
+    their resources and whether each is datastore active. This is slow, use
+    get_available_resources instead which caches the result.
+
+    :param ignore_auth: whether to ignore authentication (default: False)
+    :param user_id: the user to check access for
+    :returns: a dict of resource IDs -> whether they are datastore active
+    """
+    resources = {}
 
     offset = 0
     action = toolkit.get_action('current_package_list_with_resources')
@@ -65,15 +94,11 @@ def get_available_resources(
         if not packages:
             break
         for package in packages:
-            # add the datastore active resources
-            resource_ids.update(
-                resource['id']
-                for resource in package['resources']
-                if not datastore_only or resource.get('datastore_active', False)
-            )
+            for resource in package['resources']:
+                resources[resource['id']] = resource.get('datastore_active', False)
         offset += len(packages)
 
-    return resource_ids
+    return resources
 
 
 @cache_region('vds', 'public_resources')
@@ -95,9 +120,11 @@ def get_public_resources() -> Dict[str, bool]:
             break
         for package in packages:
             for resource in package.get('resources', []):
-                resource_ids[resource['id']] = is_datastore_resource(resource['id'])
+                resource_ids[resource['id']] = False
         offset += len(packages)
 
+    # look up the datastore status of all the resources in one go
+    resource_ids.update(get_datastore_statuses(resource_ids))
     return resource_ids
 
 
@@ -113,15 +140,13 @@ def get_latest_resource_fields(resource_ids: List[str]) -> Dict[str, Dict[str, D
         within those resources
     """
     fields = defaultdict(dict)
-    for resource_id in resource_ids:
-        database = get_database(resource_id)
-
-        try:
-            parsed_fields = database.get_field_names()
-        except toolkit.NotFoundError:
-            # temporary fix for splitgill#38 (so we can ignore unavailable resources)
-            return fields
-
+    resource_fields = map_resources(
+        lambda resource_id: get_database(resource_id).get_field_names(),
+        resource_ids,
+        # temporary fix for splitgill#38 (so we can ignore unavailable resources)
+        ignore=(toolkit.NotFoundError, NotFoundError),
+    )
+    for resource_id, parsed_fields in resource_fields.items():
         for field in parsed_fields:
             fields[field.path][resource_id] = {
                 'name': field.name,
@@ -137,6 +162,130 @@ def get_latest_resource_fields(resource_ids: List[str]) -> Dict[str, Dict[str, D
     return fields
 
 
+def get_resource_concurrency() -> int:
+    """
+    Returns the maximum number of resources to make Elasticsearch requests for at the
+    same time when an action needs to make separate requests for each resource. If this
+    is 1 or less, the requests are made one after the other.
+
+    :returns: the number of resources to process concurrently
+    """
+    return int(
+        toolkit.config.get('ckanext.versioned_datastore.resource_concurrency', 8) or 1
+    )
+
+
+def get_resource_timeout() -> float:
+    """
+    Returns the number of seconds the requests for a single resource are allowed to
+    take when they are made concurrently. If a resource takes longer than this, a
+    TimeoutError is raised (see map_resources).
+
+    :returns: the timeout in seconds
+    """
+    return float(toolkit.config.get('ckanext.versioned_datastore.resource_timeout', 60))
+
+
+R = TypeVar('R')
+
+
+def map_resources(
+    function: Callable[[str], R],
+    resource_ids: Iterable[str],
+    ignore: Tuple[Type[Exception], ...] = (),
+) -> Dict[str, R]:
+    """
+    Calls the given function for each of the given resource IDs and returns the results
+    in a dict. The calls are made concurrently using a bounded pool of threads as they
+    spend almost all their time waiting on Elasticsearch.
+
+    The function is called outside the request context so it shouldn't use anything
+    which requires it (e.g. the current user or check_access).
+
+    If a call takes longer than the resource timeout, a TimeoutError naming the
+    resources which timed out is raised, unless TimeoutError is one of the ignored
+    exception types, in which case they are left out of the results. Either way, the
+    thread making a timed out call can't be stopped and carries on running in the
+    background until the call completes.
+
+    :param function: a function which takes a resource ID
+    :param resource_ids: the resource IDs
+    :param ignore: exception types which, if raised by the function, cause the resource
+        to be left out of the results instead of being raised
+    :returns: a dict of resource IDs -> the function's result, in the same order as the
+        resource IDs
+    """
+    resource_ids = list(resource_ids)
+    width = min(get_resource_concurrency(), len(resource_ids))
+    results = {}
+
+    if width <= 1:
+        for resource_id in resource_ids:
+            try:
+                results[resource_id] = function(resource_id)
+            except ignore:
+                pass
+        return results
+
+    timeout = get_resource_timeout()
+    started = {}
+
+    def call(resource_id: str) -> R:
+        started[resource_id] = time.monotonic()
+        return function(resource_id)
+
+    executor = ThreadPoolExecutor(max_workers=width)
+    try:
+        futures = {
+            executor.submit(call, resource_id): resource_id
+            for resource_id in resource_ids
+        }
+        pending = set(futures)
+        while pending:
+            # wait until a call completes or the next running call times out
+            now = time.monotonic()
+            deadlines = [
+                started[futures[future]] + timeout
+                for future in pending
+                if futures[future] in started
+            ]
+            done, pending = wait(
+                pending,
+                timeout=max(min(deadlines, default=now + timeout) - now, 0),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                try:
+                    results[futures[future]] = future.result()
+                except ignore:
+                    pass
+
+            now = time.monotonic()
+            timed_out = [
+                future
+                for future in pending
+                if futures[future] in started
+                and now - started[futures[future]] >= timeout
+            ]
+            if timed_out:
+                names = ', '.join(sorted(futures[future] for future in timed_out))
+                if not issubclass(TimeoutError, ignore):
+                    raise TimeoutError(f'Timed out waiting for resources: {names}')
+                log.warning(f'Timed out waiting for resources: {names}')
+                pending.difference_update(timed_out)
+    finally:
+        # don't wait for any calls that timed out and don't start any that haven't
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    return {
+        resource_id: results[resource_id]
+        for resource_id in resource_ids
+        if resource_id in results
+    }
+
+
 def get_database(resource_id: str) -> SplitgillDatabase:
     """
     Retrieves a SplitgillDatabase object for the given resource ID. If the
@@ -279,7 +428,74 @@ def is_datastore_resource(resource_id: str) -> bool:
     :param resource_id: the resource id
     :returns: True if the resource is a datastore resource, False if not
     """
-    return get_database(resource_id).get_elasticsearch_version() is not None
+    return get_datastore_statuses([resource_id])[resource_id]
+
+
+def get_datastore_statuses(resource_ids: Iterable[str]) -> Dict[str, bool]:
+    """
+    Checks if any data has made it to Elasticsearch for each of the given resource IDs.
+    The Elasticsearch version of every resource is stored in redis and updated after
+    each sync so this doesn't usually require any requests to Elasticsearch. If redis
+    is unavailable, each resource is checked in Elasticsearch directly.
+
+    :param resource_ids: the resource ids
+    :returns: a dict of resource IDs -> True if the resource is a datastore resource,
+        False if not
+    """
+    resource_ids = list(resource_ids)
+    try:
+        versions = status.get_versions(resource_ids, load_index_versions)
+    except Exception as e:
+        log.warning(f'Failed to retrieve stored resource versions: {e}')
+        versions = {
+            resource_id: get_database(resource_id).get_elasticsearch_version()
+            for resource_id in resource_ids
+        }
+    return {resource_id: versions[resource_id] is not None for resource_id in versions}
+
+
+def load_index_versions() -> Dict[str, int]:
+    """
+    Retrieves the Elasticsearch version of every resource which has data in
+    Elasticsearch using a single aggregation over all the resource indexes. As with
+    Splitgill's get_elasticsearch_version, both the version and next fields are checked
+    to account for updates that only include deletions.
+
+    :returns: a dict of resource IDs -> versions
+    """
+    versions = {}
+    agg = {
+        'composite': {
+            'size': 1000,
+            'sources': [{'index': {'terms': {'field': '_index'}}}],
+        },
+        'aggs': {
+            'version': {'max': {'field': DocumentField.VERSION}},
+            'next': {'max': {'field': DocumentField.NEXT}},
+        },
+    }
+    while True:
+        result = es_client().search(
+            # all the indexes of all the resources
+            index=f'data-{get_sg_name("*")}',
+            aggs={'indexes': agg},
+            size=0,
+        )
+        indexes = result['aggregations']['indexes']
+        for bucket in indexes['buckets']:
+            values = [bucket['version']['value'], bucket['next']['value']]
+            values = [int(value) for value in values if value is not None]
+            if not values:
+                continue
+            try:
+                resource_id = unprefix_index_name(bucket['key']['index'])
+            except ValueError:
+                continue
+            versions[resource_id] = max(versions.get(resource_id, 0), *values)
+        if not indexes['buckets'] or 'after_key' not in indexes:
+            break
+        agg['composite']['after'] = indexes['after_key']
+    return versions
 
 
 def is_datastore_only_resource(resource_url: str) -> bool:
@@ -50,13 +50,16 @@ def vds_basic_query(
         return {'indexes': request.indexes(), 'search': request.to_search().to_dict()}
 
     response = request.run()
-    return {
+    result = {
         'total': response.count,
         'records': response.data,
         'facets': format_facets(response.aggs),
         'fields': get_fields(resource_id, request.query.version),
         'after': response.next_after,
     }
+    if request.pit:
+        result['cursor'] = response.next_cursor
+    return result
 
 
 @action(schema.vds_basic_count(), helptext.vds_basic_query, get=True)
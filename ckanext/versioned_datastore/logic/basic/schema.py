@@ -34,6 +34,8 @@ def vds_basic_query() -> dict:
         'facets': [ignore_missing, list_of_strings()],
         'facet_limits': [ignore_missing, json_validator],
         'run_query': [ignore_missing, boolean_validator],
+        'pit': [ignore_missing, boolean_validator],
+        'cursor': [ignore_missing, str],
     }
 
 
@@ -69,7 +69,10 @@ def make_request(data_dict: dict) -> SearchRequest:
         sorts=list(map(Sort.from_basic, data_dict.get('sort', []))),
         fields=data_dict.get('fields', []),
         data_dict=data_dict,
+        pit=data_dict.get('pit', False),
     )
+    if data_dict.get('cursor'):
+        request.set_cursor(data_dict['cursor'])
     if 'facets' in data_dict:
         facet_limits = data_dict.get('facet_limits', {})
         for facet in data_dict['facets']:
@@ -3,6 +3,7 @@ from ckantools.decorators import action
 
 from ckanext.versioned_datastore.lib.downloads.download import DownloadRunManager
 from ckanext.versioned_datastore.lib.downloads.notifiers import validate_notifier_args
+from ckanext.versioned_datastore.lib.downloads.queues import get_owner
 from ckanext.versioned_datastore.logic.download import helptext, schema
 from ckanext.versioned_datastore.logic.download.arg_objects import (
     DerivativeArgs,
@@ -43,6 +44,8 @@ def vds_download_queue(
         except toolkit.NotAuthorized:
             server.custom_filename = None
 
+    owner = get_owner(context)
+
     download_runner = DownloadRunManager(
         query_args=query,
         derivative_args=file,
@@ -50,12 +53,8 @@ def vds_download_queue(
         notifier_args=notifier,
     )
 
-    job = toolkit.enqueue_job(
-        download_runner.run,
-        queue='download',
-        title=download_runner.request.created.strftime('%Y-%m-%d %H:%M:%S'),
-        rq_kwargs={'timeout': '24h'},
-    )
+    # this raises a ValidationError if the user has too many downloads in progress
+    job = download_runner.queue(owner)
 
     return {
         'queued_at': job.enqueued_at.isoformat(),
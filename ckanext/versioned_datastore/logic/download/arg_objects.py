@@ -2,6 +2,7 @@ from ckan.plugins import toolkit
 from ckantools.validators.ivalidators import BaseArgs
 
 from ckanext.datastore.logic.schema import json_validator
+from ckanext.versioned_datastore.lib.downloads.core import WriterOptions
 from ckanext.versioned_datastore.lib.query.search.query import SchemaQuery
 from ckanext.versioned_datastore.lib.query.utils import convert_to_multisearch
 from ckanext.versioned_datastore.lib.utils import get_available_datastore_resources
@@ -21,6 +22,7 @@ class QueryArgs(BaseArgs):
     query_version: str
     version: int
     slug_or_doi: str
+    core_options: dict
 
     fields = {
         'resource_ids': [ignore_missing, validate_resource_ids],
@@ -28,6 +30,7 @@ class QueryArgs(BaseArgs):
         'query_version': [ignore_missing, str],
         'version': [ignore_missing, int_validator],
         'slug_or_doi': [ignore_missing, str],
+        'core_options': [ignore_missing, json_validator],
     }
 
     def validate(self):
@@ -35,6 +38,11 @@ class QueryArgs(BaseArgs):
             validate_datastore_resource_ids(self.query['resource_ids'])
             if not self.resource_ids:
                 self.resource_ids = self.query['resource_ids']
+        if self.core_options:
+            try:
+                WriterOptions.create(self.core_options)
+            except (ValueError, TypeError) as e:
+                raise toolkit.Invalid(f'Invalid core options: {e}')
 
     def to_schema_query(self) -> SchemaQuery:
         query = self.query
@@ -1,7 +1,9 @@
 from collections import defaultdict
 from typing import List, Optional
 
+from ckan.plugins import toolkit
 from ckantools.decorators import action
+from ckantools.validators import validate_by_schema
 from elasticsearch.exceptions import NotFoundError
 from elasticsearch_dsl import A, MultiSearch, Q, Search
 from splitgill.search import keyword, number, version_query
@@ -11,11 +13,17 @@ from ckanext.versioned_datastore.lib.query.schema import (
     hash_query,
     validate_query,
 )
+from ckanext.versioned_datastore.lib.query.search.request import (
+    SearchRequest,
+    SearchResponse,
+    run_searches,
+)
 from ckanext.versioned_datastore.lib.utils import (
     es_client,
     get_database,
     get_latest_resource_fields,
     ivds_implementations,
+    map_resources,
     unprefix_index_name,
 )
 from ckanext.versioned_datastore.logic.multi import helptext, schema
@@ -35,10 +43,20 @@ def vds_multi_query(data_dict: dict):
 
     :param data_dict: the data dict of options
     :returns: a dict which contains the total number of records found, an after value
-        for pagination, and a list of dicts of record data
+        for pagination, and a list of dicts of record data. If a point in time search
+        was requested, a cursor value for pagination is also included
     """
     request = make_request(data_dict)
-    response = request.run()
+    return _format_query_response(request.run())
+
+
+def _format_query_response(response: SearchResponse) -> dict:
+    """
+    Creates the vds_multi_query result from the given response.
+
+    :param response: the SearchResponse object
+    :returns: the result dict
+    """
     result = {
         'total': response.count,
         'after': response.next_after,
@@ -50,6 +68,8 @@ def vds_multi_query(data_dict: dict):
             for hit in response.hits
         ],
     }
+    if response.request.pit:
+        result['cursor'] = response.next_cursor
 
     for plugin in ivds_implementations():
         plugin.vds_after_multi_query(response, result)
@@ -69,6 +89,16 @@ def vds_multi_count(data_dict: dict):
     :returns: a dict which contains the total count and a breakdown of the hits per
         resource
     """
+    return _format_count_response(_make_count_request(data_dict).run())
+
+
+def _make_count_request(data_dict: dict) -> SearchRequest:
+    """
+    Creates the SearchRequest for a vds_multi_count call.
+
+    :param data_dict: the data dict of options
+    :returns: a SearchRequest object
+    """
     request = make_request(data_dict)
     request.set_no_results()
     # use an aggregation to get the hit count of each resource, set the size to the
@@ -77,10 +107,18 @@ def vds_multi_count(data_dict: dict):
     request.add_agg(
         'counts', 'terms', field='_index', size=len(request.query.resource_ids)
     )
-    response = request.run()
+    return request
+
+
+def _format_count_response(response: SearchResponse) -> dict:
+    """
+    Creates the vds_multi_count result from the given response.
 
+    :param response: the SearchResponse object
+    :returns: the result dict
+    """
     # default the counts to 0 for all resources
-    counts = {resource_id: 0 for resource_id in request.query.resource_ids}
+    counts = {resource_id: 0 for resource_id in response.request.query.resource_ids}
     # then update with the counts from the resources that matched the query
     for bucket in response.aggs['counts']['buckets']:
         counts[unprefix_index_name(bucket['key'])] += bucket['doc_count']
@@ -231,15 +269,15 @@ def vds_multi_autocomplete_field(
     if not resource_ids:
         resource_ids = sorted(get_available_datastore_resources())
 
-    for resource_id in resource_ids:
-        database = get_database(resource_id)
-
-        try:
-            parsed_fields = database.get_parsed_fields(version=version)
-        except NotFoundError:
-            # temporary fix for splitgill#38 (so we can ignore unavailable resources)
-            continue
-
+    resource_fields = map_resources(
+        lambda resource_id: get_database(resource_id).get_parsed_fields(
+            version=version
+        ),
+        resource_ids,
+        # temporary fix for splitgill#38 (so we can ignore unavailable resources)
+        ignore=(NotFoundError,),
+    )
+    for resource_id, parsed_fields in resource_fields.items():
         for field in parsed_fields:
             if text in (field.path.lower() if lowercase else field.path):
                 fields[field.path][resource_id] = {
@@ -309,18 +347,18 @@ def vds_multi_fields(
     for plugin in ivds_implementations():
         plugin.vds_modify_field_groups(request.query.resource_ids, field_groups)
 
-    for resource_id in request.query.resource_ids:
-        database = get_database(resource_id)
-        try:
-            fields = database.get_parsed_fields(
-                version=request.query.version,
-                query=query,
-                sample_probability=sample,
-                chunk_size=100,
-            )
-        except NotFoundError:
-            # temporary fix for splitgill#38 (so we can ignore unavailable resources)
-            continue
+    resource_fields = map_resources(
+        lambda resource_id: get_database(resource_id).get_parsed_fields(
+            version=request.query.version,
+            query=query,
+            sample_probability=sample,
+            chunk_size=100,
+        ),
+        request.query.resource_ids,
+        # temporary fix for splitgill#38 (so we can ignore unavailable resources)
+        ignore=(NotFoundError,),
+    )
+    for resource_id, fields in resource_fields.items():
         field_groups.add(resource_id, fields)
 
     return field_groups.select(size)
@@ -349,16 +387,101 @@ def vds_multi_stats(data_dict: dict, field: str, missing: Optional[float] = None
     :param missing: value to use for records missing this field, or None to ignore them
     :returns: a dict of statistical data
     """
+    return _format_stats_response(_make_stats_request(data_dict, field, missing).run())
+
+
+def _make_stats_request(
+    data_dict: dict, field: str, missing: Optional[float] = None
+) -> SearchRequest:
+    """
+    Creates the SearchRequest for a vds_multi_stats call.
+
+    :param data_dict: the data dict of options
+    :param field: the field to get stats for
+    :param missing: value to use for records missing this field, or None to ignore them
+    :returns: a SearchRequest object
+    """
     request = make_request(data_dict)
     request.set_no_results()
     agg_options = {'field': number(field)}
     if missing is not None:
         agg_options['missing'] = missing
     request.add_agg('field_stats', 'stats', **agg_options)
-    response = request.run()
+    return request
+
+
+def _format_stats_response(response: SearchResponse) -> dict:
+    """
+    Creates the vds_multi_stats result from the given response.
+
+    :param response: the SearchResponse object
+    :returns: the result dict
+    """
     return response.aggs['field_stats']
 
 
+# the actions which can be included in a vds_multi_batch call, mapped to their schema,
+# a function to create their SearchRequest and a function to format their result
+batch_actions = {
+    'vds_multi_query': (schema.vds_multi_query, make_request, _format_query_response),
+    'vds_multi_count': (
+        schema.vds_multi_count,
+        _make_count_request,
+        _format_count_response,
+    ),
+    'vds_multi_stats': (
+        schema.vds_multi_stats,
+        lambda data_dict: _make_stats_request(
+            data_dict, data_dict['field'], data_dict.get('missing')
+        ),
+        _format_stats_response,
+    ),
+}
+
+
+@action(schema.vds_multi_batch(), helptext.vds_multi_batch, get=True)
+def vds_multi_batch(context: dict, requests: List[dict]):
+    """
+    Runs a number of vds_multi_query, vds_multi_count, and vds_multi_stats requests
+    together in a single request to Elasticsearch and returns their results in a list,
+    in the same order as the requests. Each request must be a dict with an "action" key
+    naming the action and a "params" key containing the data dict that would be passed
+    to the action if it was called on its own. Point in time queries cannot be batched.
+
+    :param context: the action context
+    :param requests: a list of request dicts
+    :returns: a list of results, one for each request
+    """
+    max_requests = int(
+        toolkit.config.get('ckanext.versioned_datastore.batch_max_requests', 50)
+    )
+    if len(requests) > max_requests:
+        raise toolkit.ValidationError(
+            {'requests': [f'A maximum of {max_requests} requests can be batched']}
+        )
+
+    # the context may contain this action's schema so don't pass it on
+    request_context = {key: value for key, value in context.items() if key != 'schema'}
+    search_requests = []
+    formatters = []
+    for position, request in enumerate(requests):
+        action_name = request.get('action')
+        if action_name not in batch_actions:
+            raise toolkit.ValidationError(
+                {'requests': [f'Invalid action at position {position}: {action_name}']}
+            )
+        action_schema, make, formatter = batch_actions[action_name]
+        params = validate_by_schema(
+            request_context.copy(), request.get('params', {}), action_schema()
+        )
+        toolkit.check_access(action_name, request_context.copy(), params)
+        search_requests.append(make(params))
+        formatters.append(formatter)
+
+    responses = run_searches(search_requests)
+    return [formatter(response) for formatter, response in zip(formatters, responses)]
+
+
 @action(schema.vds_multi_direct(), helptext.vds_multi_direct)
 def vds_multi_direct(data_dict: dict):
     """
@@ -50,6 +50,12 @@ def vds_multi_stats(context, data_dict) -> dict:
     return {'success': True}
 
 
+@auth(anon=True)
+def vds_multi_batch(context, data_dict) -> dict:
+    # allow access to everyone, each request in the batch is checked individually
+    return {'success': True}
+
+
 @auth()
 def vds_multi_direct(context, data_dict):
     # only allow for admins
@@ -7,3 +7,4 @@ vds_multi_hash = ''
 vds_multi_fields = ''
 vds_multi_stats = ''
 vds_multi_direct = ''
+vds_multi_batch = ''
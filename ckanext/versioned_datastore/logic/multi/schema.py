@@ -1,4 +1,8 @@
-from ckantools.validators import list_of_strings, list_validator
+from ckantools.validators import (
+    list_of_dicts_validator,
+    list_of_strings,
+    list_validator,
+)
 
 from ckanext.datastore.logic.schema import json_validator
 from ckanext.versioned_datastore.logic.validators import (
@@ -20,6 +24,8 @@ multi_params = {
 multi_paging = {
     'after': [ignore_missing, list_validator],
     'size': [ignore_missing, int_validator],
+    'pit': [ignore_missing, boolean_validator],
+    'cursor': [ignore_missing, str],
 }
 
 
@@ -89,3 +95,9 @@ def vds_multi_direct() -> dict:
         'search': [ignore_missing, json_validator],
         'version': [ignore_missing, str],
     }
+
+
+def vds_multi_batch() -> dict:
+    return {
+        'requests': [not_empty, list_of_dicts_validator],
+    }
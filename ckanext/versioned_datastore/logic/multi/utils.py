@@ -36,7 +36,10 @@ def make_request(data_dict: dict) -> SearchRequest:
         size=data_dict.get('size'),
         after=data_dict.get('after'),
         data_dict=data_dict,
+        pit=data_dict.get('pit', False),
     )
+    if data_dict.get('cursor'):
+        request.set_cursor(data_dict['cursor'])
 
     # ignore any resources that are unavailable for whatever reason
     request.add_param('ignore_unavailable', True)
@@ -0,0 +1,28 @@
+"""
+Add checkpoints to download core model.
+
+Revision ID: 8aabd96aef50
+Revises: 5932a36b7cf3
+Create Date: 2026-10-17 11:02:41.518327
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision = '8aabd96aef50'
+down_revision = '5932a36b7cf3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'vds_download_core',
+        sa.Column('checkpoints', JSONB, nullable=False, server_default='{}'),
+    )
+
+
+def downgrade():
+    op.drop_column('vds_download_core', 'checkpoints')
@@ -0,0 +1,59 @@
+"""
+Add download core resource catalogue.
+
+Revision ID: b3f1c6d2e8a4
+Revises: 8aabd96aef50
+Create Date: 2026-10-17 14:20:12.804361
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c6d2e8a4'
+down_revision = '8aabd96aef50'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'vds_download_core_resource',
+        sa.Column(
+            'core_id',
+            sa.UnicodeText,
+            sa.ForeignKey(
+                'vds_download_core.id', onupdate='CASCADE', ondelete='CASCADE'
+            ),
+            primary_key=True,
+        ),
+        sa.Column('resource_id', sa.UnicodeText, primary_key=True),
+        sa.Column('query_hash', sa.UnicodeText, nullable=False),
+        sa.Column('version', sa.BigInteger, nullable=False),
+    )
+    op.create_index(
+        'vds_download_core_resource_lookup',
+        'vds_download_core_resource',
+        ['query_hash', 'resource_id', 'version'],
+    )
+    # add the datastore resources which already have totals on the existing core
+    # records, non-datastore resources don't have core files
+    op.execute(
+        """
+        INSERT INTO vds_download_core_resource
+            (core_id, resource_id, query_hash, version)
+        SELECT core.id,
+               resource.id,
+               core.query_hash,
+               CAST(core.resource_ids_and_versions ->> resource.id AS BIGINT)
+        FROM vds_download_core AS core,
+             jsonb_object_keys(core.resource_totals) AS resource(id)
+        WHERE core.resource_ids_and_versions ->> resource.id IS NOT NULL
+          AND core.resource_ids_and_versions ->> resource.id != '-1'
+        """
+    )
+
+
+def downgrade():
+    op.drop_index('vds_download_core_resource_lookup')
+    op.drop_table('vds_download_core_resource')
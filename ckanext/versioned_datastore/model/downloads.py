@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import List
+from typing import Iterable, List, Optional
 
 from ckan.model import DomainObject, Session, meta
 from ckan.model.types import make_uuid
@@ -8,11 +8,14 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Table,
     UnicodeText,
+    cast,
     desc,
+    literal,
 )
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import backref, relationship
 
@@ -36,6 +39,25 @@ datastore_downloads_core_files_table = Table(
     Column('total', BigInteger, nullable=True),
     Column('resource_totals', JSONB, nullable=False, default=dict),
     Column('field_counts', JSONB, nullable=False, default=dict),
+    Column('checkpoints', JSONB, nullable=False, default=dict, server_default='{}'),
+)
+
+# an index of the resources which have been written to core files, so that core files
+# for a resource at a specific version can be found without searching through the JSON
+# on every core record
+datastore_downloads_core_resources_table = Table(
+    'vds_download_core_resource',
+    meta.metadata,
+    Column(
+        'core_id',
+        UnicodeText,
+        ForeignKey('vds_download_core.id', onupdate='CASCADE', ondelete='CASCADE'),
+        primary_key=True,
+    ),
+    Column('resource_id', UnicodeText, primary_key=True),
+    Column('query_hash', UnicodeText, nullable=False),
+    Column('version', BigInteger, nullable=False),
+    Index('vds_download_core_resource_lookup', 'query_hash', 'resource_id', 'version'),
 )
 
 # describes derived files generated from the core files
@@ -99,6 +121,7 @@ class CoreFileRecord(DomainObject):
     total: int
     resource_totals: dict
     field_counts: dict
+    checkpoints: dict
     derivatives: list
     requests: list
 
@@ -115,6 +138,116 @@ class CoreFileRecord(DomainObject):
         except InvalidRequestError:
             self.commit()
 
+    def add_to_catalogue(self, resource_ids: Iterable[str]):
+        """
+        Adds the given resources to the core resource catalogue so that this record can
+        be found by find_resource. This should only be called once the resources' core
+        files have been completely written and their totals stored on this record.
+
+        :param resource_ids: the IDs of the resources in this record's core files
+        """
+        rows = [
+            {
+                'core_id': self.id,
+                'resource_id': resource_id,
+                'query_hash': self.query_hash,
+                'version': self.resource_ids_and_versions[resource_id],
+            }
+            for resource_id in resource_ids
+            if resource_id in self.resource_ids_and_versions
+        ]
+        if not rows:
+            return
+        Session.execute(
+            insert(datastore_downloads_core_resources_table)
+            .values(rows)
+            .on_conflict_do_nothing()
+        )
+        Session.commit()
+
+    def update_resource(
+        self, resource_id: str, total: int, field_counts: Optional[dict]
+    ):
+        """
+        Sets the record total and field counts of a single resource on this record. The
+        values are merged into the stored JSON in the database rather than replacing it
+        so that multiple processes can update different resources at the same time.
+
+        :param resource_id: the resource ID
+        :param total: the number of records from the resource
+        :param field_counts: the resource's field counts
+        """
+        table = datastore_downloads_core_files_table
+        Session.execute(
+            table.update()
+            .where(table.c.id == self.id)
+            .values(
+                resource_totals=table.c.resource_totals.op('||')(
+                    literal({resource_id: total}, JSONB)
+                ),
+                field_counts=table.c.field_counts.op('||')(
+                    literal({resource_id: field_counts}, JSONB)
+                ),
+                modified=datetime.utcnow(),
+            )
+        )
+        Session.commit()
+
+    def set_checkpoint(self, resource_id: str, checkpoint: Optional[dict]):
+        """
+        Sets or removes the checkpoint of a single resource's core file on this record.
+        Like update_resource, this is done with a single update so that multiple
+        processes can set checkpoints for different resources at the same time.
+
+        :param resource_id: the resource ID
+        :param checkpoint: the checkpoint, or None to remove it
+        """
+        table = datastore_downloads_core_files_table
+        if checkpoint is None:
+            checkpoints = table.c.checkpoints.op('-')(
+                cast(literal(resource_id), UnicodeText)
+            )
+        else:
+            checkpoints = table.c.checkpoints.op('||')(
+                literal({resource_id: checkpoint}, JSONB)
+            )
+        Session.execute(
+            table.update().where(table.c.id == self.id).values(checkpoints=checkpoints)
+        )
+        Session.commit()
+
+    @classmethod
+    def remove_resource(cls, record_ids: List[str], resource_id: str):
+        """
+        Removes the total and field counts of a single resource from the given core
+        records and removes them from the core resource catalogue for the resource. This
+        is used when the resource's core file is deleted so that the records no longer
+        claim to have it and it's generated again the next time it's needed.
+
+        :param record_ids: the IDs of the core records
+        :param resource_id: the resource ID
+        """
+        if not record_ids:
+            return
+        table = datastore_downloads_core_files_table
+        catalogue = datastore_downloads_core_resources_table
+        key = cast(literal(resource_id), UnicodeText)
+        Session.execute(
+            table.update()
+            .where(table.c.id.in_(record_ids))
+            .values(
+                resource_totals=table.c.resource_totals.op('-')(key),
+                field_counts=table.c.field_counts.op('-')(key),
+            )
+        )
+        Session.execute(
+            catalogue.delete().where(
+                catalogue.c.core_id.in_(record_ids),
+                catalogue.c.resource_id == resource_id,
+            )
+        )
+        Session.commit()
+
     @classmethod
     def get_by_hash(cls, query_hash, resource_hash):
         return (
@@ -155,26 +288,30 @@ class CoreFileRecord(DomainObject):
 
     @classmethod
     def find_resource(cls, query_hash, resource_id, resource_version, exclude=None):
-        exclude = exclude or []
-        have_resource = (
+        """
+        Finds the most recently modified core record with the given query hash which
+        has a core file for the given resource at the given version, using the core
+        resource catalogue.
+
+        :param query_hash: the query hash
+        :param resource_id: the resource ID
+        :param resource_version: the resource version
+        :param exclude: optional list of core record IDs to ignore
+        :returns: the core record, or None if there isn't one
+        """
+        catalogue = datastore_downloads_core_resources_table
+        query = (
             Session.query(cls)
+            .join(catalogue, catalogue.c.core_id == cls.id)
             .filter(
-                cls.query_hash == query_hash,
-                cls.resource_ids_and_versions.has_key(resource_id),
-                cls.resource_totals.has_key(resource_id),
-                cls.id.notin_(exclude),
+                catalogue.c.query_hash == query_hash,
+                catalogue.c.resource_id == resource_id,
+                catalogue.c.version == resource_version,
             )
-            .order_by(desc(cls.modified))
-            .all()
         )
-        have_resource_version = [
-            r
-            for r in have_resource
-            if r.resource_ids_and_versions[resource_id] == resource_version
-        ]
-        if have_resource_version:
-            return have_resource_version[0]
-        return
+        if exclude:
+            query = query.filter(cls.id.notin_(exclude))
+        return query.order_by(desc(cls.modified)).first()
 
 
 class DerivativeFileRecord(DomainObject):
@@ -264,6 +401,24 @@ class DownloadRequest(DomainObject):
     def update_status(self, status_text, message=None):
         self.update(state=status_text, message=message)
 
+    def update_progress(self, status_text, message=None):
+        """
+        Updates the state and message of this request, unless it has already failed.
+        The jobs of split downloads run at the same time, so this stops one job's
+        progress from hiding another job's failure from the final job.
+
+        :param status_text: the new state
+        :param message: the new message (default None)
+        """
+        table = datastore_downloads_requests_table
+        Session.execute(
+            table.update()
+            .where(table.c.id == self.id, table.c.state != self.state_failed)
+            .values(state=status_text, message=message, modified=datetime.utcnow())
+        )
+        # this also expires this object so its state is reloaded next time it's used
+        Session.commit()
+
 
 meta.mapper(CoreFileRecord, datastore_downloads_core_files_table, properties={})
 
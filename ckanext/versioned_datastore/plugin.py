@@ -16,7 +16,8 @@ from splitgill.manager import SplitgillClient
 
 from ckanext.versioned_datastore import cli, helpers, routes
 from ckanext.versioned_datastore.interfaces import IVersionedDatastoreQuerySchema
-from ckanext.versioned_datastore.lib import utils
+from ckanext.versioned_datastore.lib import access, utils
+from ckanext.versioned_datastore.lib.downloads.queues import DOWNLOAD_QUEUES
 from ckanext.versioned_datastore.lib.query.schema import register_schema
 from ckanext.versioned_datastore.lib.query.schemas.v1_0_0 import v1_0_0Schema
 from ckanext.versioned_datastore.lib.query.search.query import SchemaQuery
@@ -112,8 +113,36 @@ class VersionedSearchPlugin(SingletonPlugin):
 
     # IConfigurable
     def configure(self, ckan_config):
-        # do the setup for Splitgill first, create Mongo client, Elasticsearch client,
-        # and then the Splitgill client
+        # do the setup for Splitgill first
+        self.create_clients(ckan_config)
+
+        # register all custom query schemas
+        for plugin in utils.iqs_implementations():
+            for query_version, query_schema in plugin.get_query_schemas():
+                register_schema(query_version, query_schema)
+
+        # reserve any requested slugs
+        from .lib.query.slugs.slugs import reserve_slug
+
+        for plugin in utils.ivds_implementations():
+            slugs = plugin.vds_reserve_slugs()
+            for reserved_pretty_slug, query_parameters in slugs.items():
+                query = SchemaQuery(**query_parameters)
+                with suppress(Exception):
+                    reserve_slug(reserved_pretty_slug, query)
+
+        # configure cache
+        configure_cache(ckan_config, 'versioned_datastore', 'vds')
+
+    def create_clients(self, ckan_config):
+        """
+        Creates the Mongo client, Elasticsearch client, and then the Splitgill client
+        and stores them against this plugin instance. This is called during configure
+        but can also be called again to replace the clients, for example in a forked
+        process which can't share its parent's connections.
+
+        :param ckan_config: the CKAN config
+        """
         self.mongo_client = MongoClient(
             host=ckan_config.get('ckanext.versioned_datastore.mongo_host'),
             port=int(ckan_config.get('ckanext.versioned_datastore.mongo_port')),
@@ -136,24 +165,6 @@ class VersionedSearchPlugin(SingletonPlugin):
             self.mongo_client, self.elasticsearch_client, mongo_db_name
         )
 
-        # register all custom query schemas
-        for plugin in utils.iqs_implementations():
-            for query_version, query_schema in plugin.get_query_schemas():
-                register_schema(query_version, query_schema)
-
-        # reserve any requested slugs
-        from .lib.query.slugs.slugs import reserve_slug
-
-        for plugin in utils.ivds_implementations():
-            slugs = plugin.vds_reserve_slugs()
-            for reserved_pretty_slug, query_parameters in slugs.items():
-                query = SchemaQuery(**query_parameters)
-                with suppress(Exception):
-                    reserve_slug(reserved_pretty_slug, query)
-
-        # configure cache
-        configure_cache(ckan_config, 'versioned_datastore', 'vds')
-
     def is_sg_configured(self) -> bool:
         """
         Returns whether Splitgill is configured and ready for use. This checks if the
@@ -284,6 +295,7 @@ class VersionedSearchPlugin(SingletonPlugin):
             clear_cache_region('versioned_datastore', utils, cache_name='vds')
         except CacheClearError as e:
             log.error(e)
+        access.invalidate()
 
     # IResourceController
     def before_resource_show(self, resource_dict):
@@ -321,6 +333,7 @@ class VersionedSearchPlugin(SingletonPlugin):
             clear_cache_region('versioned_datastore', utils, cache_name='vds')
         except CacheClearError as e:
             log.error(e)
+        access.invalidate()
 
     # IResourceController
     def before_resource_delete(
@@ -334,6 +347,7 @@ class VersionedSearchPlugin(SingletonPlugin):
             clear_cache_region('versioned_datastore', utils, cache_name='vds')
         except CacheClearError as e:
             log.error(e)
+        access.invalidate()
 
     # IPackageController
     def after_dataset_create(self, context: dict, pkg_dict: dict):
@@ -341,6 +355,7 @@ class VersionedSearchPlugin(SingletonPlugin):
             clear_cache_region('versioned_datastore', utils, cache_name='vds')
         except CacheClearError as e:
             log.error(e)
+        access.invalidate()
 
     # IPackageController
     def after_dataset_update(self, context: dict, pkg_dict: dict):
@@ -348,6 +363,7 @@ class VersionedSearchPlugin(SingletonPlugin):
             clear_cache_region('versioned_datastore', utils, cache_name='vds')
         except CacheClearError as e:
             log.error(e)
+        access.invalidate()
 
     # IPackageController
     def after_dataset_delete(self, context: dict, pkg_dict: dict):
@@ -355,6 +371,7 @@ class VersionedSearchPlugin(SingletonPlugin):
             clear_cache_region('versioned_datastore', utils, cache_name='vds')
         except CacheClearError as e:
             log.error(e)
+        access.invalidate()
 
     # IConfigurer
     def update_config(self, config):
@@ -374,7 +391,7 @@ class VersionedSearchPlugin(SingletonPlugin):
 
     # IStatus
     def modify_status_reports(self, status_reports):
-        queued_downloads = get_queue_length('download')
+        queued_downloads = sum(map(get_queue_length, DOWNLOAD_QUEUES))
 
         status_reports.append(
             {
@@ -4,14 +4,14 @@ from flask import Blueprint, send_from_directory
 blueprint = Blueprint(name='downloads', import_name=__name__, url_prefix='/downloads')
 
 
-@blueprint.route('/direct/<zip_name>')
+@blueprint.route('/direct/<path:zip_name>')
 def direct(zip_name):
     """
     Serves up the requested zip from the download directory. This is only registered
     with flask when running in debug mode and therefore is only for testing in
     development. In production we should always serve files through the web server.
 
-    :param zip_name: the zip name
+    :param zip_name: the zip name, including its shard directory if there is one
     :returns: the send file response
     """
     download_dir = toolkit.config.get('ckanext.versioned_datastore.download_dir')
@@ -1,6 +1,7 @@
 import os
 import shutil
 from contextlib import suppress
+from functools import partial
 
 import pytest
 from ckan import plugins
@@ -9,7 +10,9 @@ from ckan.plugins import toolkit
 from ckan.tests import factories, helpers
 from mock import patch
 
+from ckanext.versioned_datastore.lib import status
 from ckanext.versioned_datastore.lib.common import DATASTORE_ONLY_RESOURCE
+from ckanext.versioned_datastore.lib.downloads import inflight, queues
 from ckanext.versioned_datastore.lib.utils import sg_client
 from ckanext.versioned_datastore.model import details, downloads, slugs, stats
 from tests.helpers import data as test_data
@@ -26,6 +29,7 @@ def reset_db():
         slugs.navigational_slugs_table,
         details.datastore_resource_details_table,
         downloads.datastore_downloads_core_files_table,
+        downloads.datastore_downloads_core_resources_table,
         downloads.datastore_downloads_derivative_files_table,
         downloads.datastore_downloads_requests_table,
     ]
@@ -55,6 +59,10 @@ def reset_datastore():
         with suppress(Exception):
             sg.elasticsearch.indices.delete_index_template(name=index_template['name'])
 
+    # and finally clear the stored resource versions
+    with suppress(Exception):
+        status.clear()
+
 
 def reset_downloads():
     download_dir = toolkit.config.get('ckanext.versioned_datastore.download_dir')
@@ -62,6 +70,111 @@ def reset_downloads():
         shutil.rmtree(download_dir)
 
 
+class FakeRedis:
+    """
+    Just enough of a redis client to store the strings, hashes, and sorted sets used by
+    the extension. All values are kept in one dict, keyed on the redis key.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value.encode()
+        return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def expire(self, key, ttl):
+        pass
+
+    def hmget(self, key, fields):
+        values = self.values.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def hexists(self, key, field):
+        return field in self.values.get(key, {})
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        values = self.values.setdefault(key, {})
+        if mapping:
+            values.update({k: str(v).encode() for k, v in mapping.items()})
+        if field is not None:
+            values[field] = str(value).encode()
+
+    def hdel(self, key, field):
+        self.values.get(key, {}).pop(field, None)
+
+    def zadd(self, key, mapping):
+        members = self.values.setdefault(key, {})
+        added = len(set(mapping) - set(members))
+        members.update(mapping)
+        return added
+
+    def zrem(self, key, member):
+        self.values.get(key, {}).pop(member, None)
+
+    def zcard(self, key):
+        return len(self.values.get(key, {}))
+
+    def zremrangebyscore(self, key, low, high):
+        members = self.values.get(key, {})
+        for member, score in list(members.items()):
+            if score <= high:
+                del members[member]
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """
+    Queues up calls to a FakeRedis and makes them when the pipeline is executed.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        def call(*args, **kwargs):
+            self.calls.append(partial(method, *args, **kwargs))
+            return self
+
+        return call
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [call() for call in calls]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+@pytest.fixture
+def with_fake_redis():
+    """
+    Replaces the redis connections used by the extension with a FakeRedis, which is
+    yielded so that tests can check what's been stored.
+    """
+    fake = FakeRedis()
+    with patch.object(status, 'connect_to_redis', return_value=fake), patch.object(
+        queues, 'connect_to_redis', return_value=fake
+    ), patch.object(inflight, 'connect_to_redis', return_value=fake):
+        yield fake
+
+
 @pytest.fixture
 def with_vds():
     if not plugins.plugin_loaded('versioned_datastore'):
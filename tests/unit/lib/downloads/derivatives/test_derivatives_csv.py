@@ -0,0 +1,73 @@
+import csv
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.versioned_datastore.lib.downloads.derivatives import csv as csv_derivative
+from ckanext.versioned_datastore.lib.downloads.derivatives.csv import (
+    CsvDerivativeGenerator,
+)
+from ckanext.versioned_datastore.lib.downloads.utils import RecordStats, get_fields
+
+
+def read(path, delimiter=','):
+    with open(path, newline='') as f:
+        return list(csv.reader(f, delimiter=delimiter))
+
+
+class TestCsvDerivativeGenerator:
+    def test_write(self, tmp_path):
+        fields = ['a', 'b.c', 'd.e', 'f']
+        generator = CsvDerivativeGenerator(str(tmp_path), fields, None)
+        with generator:
+            generator.write({'a': 1, 'b': {'c': 'x'}, 'd': [{'e': 1}, {'e': 2}]})
+            generator.write({'f': ['y', 'z'], 'g': None})
+        assert read(tmp_path / 'resource.csv') == [
+            fields,
+            ['1', 'x', '1 | 2', ''],
+            ['', '', '', 'y | z'],
+        ]
+
+    def test_resource_id(self, tmp_path):
+        generator = CsvDerivativeGenerator(
+            str(tmp_path), ['a'], None, resource_id='rid', delimiter='tab'
+        )
+        with generator:
+            generator.write({'a': 1})
+        assert read(tmp_path / 'rid.csv', '\t') == [
+            ['a', CsvDerivativeGenerator.RESOURCE_ID_FIELD_NAME],
+            ['1', 'rid'],
+        ]
+
+    def test_unexpected_field(self, tmp_path):
+        generator = CsvDerivativeGenerator(str(tmp_path), ['a'], None)
+        with pytest.raises(ValueError):
+            with generator:
+                generator.write({'b': 1})
+
+    def test_batches(self, tmp_path):
+        generator = CsvDerivativeGenerator(str(tmp_path), ['a'], None)
+        with patch.object(csv_derivative, 'BATCH_SIZE', 2):
+            with generator:
+                for n in range(5):
+                    generator.write({'a': n})
+                # the first 4 rows have been written and the last is waiting
+                assert len(generator.rows) == 1
+            # reopening the file (as happens for multi resource downloads) doesn't
+            # write the header again
+            with generator:
+                generator.write({'a': 5})
+        assert read(tmp_path / 'resource.csv') == [['a']] + [[str(n)] for n in range(6)]
+
+    def test_single_pass_empty_field(self, tmp_path):
+        records = [{'a': 1, 'b': ''}, {'a': 2, 'b': ''}]
+        stats = RecordStats()
+        for record in records:
+            stats.add(record)
+        fields = get_fields({'rid': stats.field_counts()}, False)
+        assert fields == ['a', 'b']
+        generator = CsvDerivativeGenerator(str(tmp_path), fields, None)
+        with generator:
+            for record in records:
+                generator.write(record)
+        assert read(tmp_path / 'resource.csv') == [['a', 'b'], ['1', ''], ['2', '']]
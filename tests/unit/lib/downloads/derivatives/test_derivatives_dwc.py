@@ -1,12 +1,20 @@
+import csv
 import json
 import os
 import shutil
+import zipfile
 from uuid import uuid4
 
 import pytest
-from mock import patch
+from mock import MagicMock, patch
 
+from ckanext.versioned_datastore.lib.downloads.derivatives.dwc import (
+    generator as generator_module,
+)
 from ckanext.versioned_datastore.lib.downloads.derivatives.dwc import urls
+from ckanext.versioned_datastore.lib.downloads.derivatives.dwc.generator import (
+    DwcDerivativeGenerator,
+)
 from ckanext.versioned_datastore.lib.downloads.derivatives.dwc.schema import Schema
 
 schema_cache = '/tmp/schema_cache'
@@ -123,3 +131,84 @@ class TestDwcSchemaSerialisation:
 
         assert len(loaded_schema.extensions) == 1
         assert loaded_schema.extensions[0].location.url == extension_url.url
+
+
+class TestDwcDerivativeGenerator:
+    @pytest.fixture
+    def generator(self, tmp_path):
+        extension = MagicMock(location=MagicMock(fields=['media']))
+        extension.name = 'Multimedia'
+        schema = MagicMock(
+            row_type_name='Occurrence',
+            extensions=[extension],
+            props={'type': MagicMock()},
+            extension_props={'Multimedia': {'url': MagicMock()}},
+        )
+        fields = ['_id', 'type', 'x', 'media.url', 'media.title']
+        with patch.object(Schema, 'load', return_value=schema):
+            generator = DwcDerivativeGenerator(str(tmp_path), fields, MagicMock())
+        with patch.object(generator, 'make_meta', return_value='meta'), patch.object(
+            generator, 'make_eml', return_value='eml'
+        ):
+            yield generator
+
+    def test_write(self, generator, tmp_path):
+        records = [
+            # the first record's type isn't valid so the type field isn't used
+            {'_id': 1, 'type': 'Specimen', 'x': 'y', 'basisOfRecord': ['p', 'q']},
+            {'_id': 2, 'media': [{'url': 'a', 'title': 't'}, {'url': 'b'}]},
+        ]
+        # the generator is opened once for each resource in combined downloads
+        for record in records:
+            with generator:
+                generator.write(record)
+        generator.cleanup()
+
+        with zipfile.ZipFile(tmp_path / 'resource.zip') as archive:
+            assert archive.namelist() == [
+                'eml.xml',
+                'meta.xml',
+                'multimedia.csv',
+                'occurrence.csv',
+            ]
+            # the archive is compressed when it's added to the download zip
+            assert all(
+                info.compress_type == zipfile.ZIP_STORED for info in archive.infolist()
+            )
+            assert archive.read('meta.xml') == b'meta'
+            core = archive.read('occurrence.csv').decode().splitlines()
+            multimedia = archive.read('multimedia.csv').decode().splitlines()
+        assert list(csv.reader(core)) == [
+            ['_id', 'basisOfRecord', 'datasetID', 'dynamicProperties'],
+            ['1', 'p | q', '', '{"type": "Specimen", "x": "y"}'],
+            ['2', '', '', '{}'],
+        ]
+        assert list(csv.reader(multimedia)) == [['_id', 'url'], ['2', 'a'], ['2', 'b']]
+        # the build directory is removed
+        assert os.listdir(tmp_path) == ['resource.zip']
+
+    def test_not_opened(self, generator, tmp_path):
+        generator.cleanup()
+        assert os.listdir(tmp_path) == []
+
+    def test_get_metadata(self, generator):
+        generator._query.resource_ids = ['r1', 'r2', 'r3']
+        packages = {
+            'p1': {'id': 'p1', 'resources': [{'id': 'r1'}, {'id': 'r2'}]},
+            'p2': {'id': 'p2', 'resources': [{'id': 'r3'}]},
+        }
+        package_show = MagicMock(side_effect=lambda context, data: packages[data['id']])
+        session = MagicMock()
+        session.query.return_value.filter.return_value = [
+            ('r1', 'p1'),
+            ('r2', 'p1'),
+            ('r3', 'p2'),
+        ]
+        with patch.object(generator_module, 'Session', session), patch(
+            'ckan.plugins.toolkit.get_action', return_value=package_show
+        ):
+            resources, package_dicts = generator.get_metadata()
+        assert [r['id'] for r in resources] == ['r1', 'r2', 'r3']
+        assert package_dicts == [packages['p1'], packages['p2']]
+        # each package is only retrieved once
+        assert package_show.call_count == 2
@@ -0,0 +1,46 @@
+import gzip
+import json
+from unittest.mock import patch
+
+from ckanext.versioned_datastore.lib.downloads import utils
+from ckanext.versioned_datastore.lib.downloads.derivatives import jsonl
+from ckanext.versioned_datastore.lib.downloads.derivatives.jsonl import (
+    JsonLinesDerivativeGenerator,
+)
+
+records = [{'a': 1, 'b': {'c': 'é'}}, {'a': None, 'd': [1.5, True]}]
+
+
+def write(generator):
+    # open the file twice, as happens for combined multi resource downloads
+    for record in records:
+        with generator:
+            generator.write(dict(record))
+
+
+class TestJsonLinesDerivativeGenerator:
+    def test_write(self, tmp_path):
+        write(JsonLinesDerivativeGenerator(str(tmp_path), [], None))
+        with open(tmp_path / 'resource.jsonl', 'rb') as f:
+            lines = f.read().splitlines()
+        assert lines[0] == '{"a":1,"b":{"c":"é"}}'.encode('utf-8')
+        assert [json.loads(line) for line in lines] == records
+
+    def test_fallback_encoder(self, tmp_path):
+        with patch.object(jsonl, 'dumps', utils._fallback_dumps):
+            write(JsonLinesDerivativeGenerator(str(tmp_path), [], None))
+        with open(tmp_path / 'resource.jsonl', 'rb') as f:
+            lines = f.read().splitlines()
+        assert lines[0] == '{"a":1,"b":{"c":"é"}}'.encode('utf-8')
+        assert [json.loads(line) for line in lines] == records
+
+    def test_compress(self, tmp_path):
+        write(
+            JsonLinesDerivativeGenerator(
+                str(tmp_path), [], None, resource_id='rid', compress='true'
+            )
+        )
+        with gzip.open(tmp_path / 'rid.jsonl.gz', 'rt', encoding='utf-8') as f:
+            written = [json.loads(line) for line in f]
+        name = JsonLinesDerivativeGenerator.RESOURCE_ID_FIELD_NAME
+        assert written == [{**record, name: 'rid'} for record in records]
@@ -0,0 +1,101 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from ckanext.versioned_datastore.lib.downloads.derivatives.parquet import (
+    ParquetDerivativeGenerator,
+    compile_field,
+)
+
+pyarrow = pytest.importorskip('pyarrow')
+pytest.importorskip('pyarrow.parquet')
+
+schemas = {
+    'a': {
+        'type': 'record',
+        'name': 'Record',
+        'fields': [
+            {'name': 'n', 'type': ['long', 'null']},
+            {
+                'name': 'nested',
+                'type': [
+                    {
+                        'type': 'record',
+                        'name': 'nestedRecord',
+                        'fields': [{'name': 'x', 'type': ['string', 'null']}],
+                    },
+                    'null',
+                ],
+            },
+        ],
+    },
+    'b': {
+        'type': 'record',
+        'name': 'Record',
+        'fields': [
+            {'name': 'n', 'type': ['double', 'null']},
+            {
+                'name': 'tags',
+                'type': [{'type': 'array', 'items': [['string', 'null']]}, 'null'],
+            },
+        ],
+    },
+}
+
+
+class TestCompileField:
+    def test_basic(self):
+        assert compile_field(['long', 'null'])[0] == pyarrow.int64()
+        assert compile_field(['boolean', 'null'])[0] == pyarrow.bool_()
+        arrow_type, converter = compile_field(['long', 'double', 'null'])
+        assert arrow_type == pyarrow.float64()
+        assert converter(1) == 1.0
+
+    def test_mixed(self):
+        arrow_type, converter = compile_field(
+            ['string', {'type': 'array', 'items': [['long', 'null']]}, 'null']
+        )
+        assert arrow_type == pyarrow.string()
+        assert converter([1, 2]) == '[1, 2]'
+        assert converter('x') == 'x'
+        assert converter(None) is None
+
+    def test_nested(self):
+        arrow_type, converter = compile_field(schemas['a']['fields'][1]['type'])
+        assert arrow_type == pyarrow.struct([('x', pyarrow.string())])
+        assert converter({'x': 'y', 'z': 1}) == {'x': 'y'}
+        arrow_type, converter = compile_field(schemas['b']['fields'][1]['type'])
+        assert arrow_type == pyarrow.list_(pyarrow.string())
+
+
+class TestParquetDerivativeGenerator:
+    def write(self, tmp_path, fields, records, **kwargs):
+        # c is a non-datastore resource
+        query = MagicMock(resource_ids=['a', 'b', 'c'])
+        generator = ParquetDerivativeGenerator(str(tmp_path), fields, query, **kwargs)
+        generator.schema_loader = schemas.get
+        for resource_records in records:
+            with generator:
+                for record in resource_records:
+                    generator.write(record)
+        generator.cleanup()
+        return pyarrow.parquet.ParquetFile(str(tmp_path / generator.output_name))
+
+    def test_write(self, tmp_path):
+        records = [
+            [{'n': 1, 'nested': {'x': 'y'}}, {'n': 2}],
+            [{'n': 1.5, 'tags': ['p', 'q']}],
+        ]
+        parquet_file = self.write(
+            tmp_path, ['n', 'nested.x', 'tags'], records, row_group_size=1
+        )
+        assert parquet_file.metadata.num_row_groups == 3
+        assert parquet_file.read().to_pylist() == [
+            {'n': 1.0, 'nested': {'x': 'y'}, 'tags': None},
+            {'n': 2.0, 'nested': None, 'tags': None},
+            {'n': 1.5, 'nested': None, 'tags': ['p', 'q']},
+        ]
+
+    def test_excluded_fields(self, tmp_path):
+        parquet_file = self.write(tmp_path, ['n'], [[{'n': 1}]])
+        assert parquet_file.schema_arrow.names == ['n']
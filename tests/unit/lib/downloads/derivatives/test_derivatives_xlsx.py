@@ -0,0 +1,60 @@
+from unittest.mock import patch
+
+import openpyxl
+
+from ckanext.versioned_datastore.lib.downloads.derivatives import xlsx
+from ckanext.versioned_datastore.lib.downloads.derivatives.xlsx import (
+    XlsxDerivativeGenerator,
+)
+
+
+def read(path):
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    return {
+        sheet.title: [list(row) for row in sheet.iter_rows(values_only=True)]
+        for sheet in workbook.worksheets
+    }
+
+
+class TestXlsxDerivativeGenerator:
+    def test_write(self, tmp_path):
+        generator = XlsxDerivativeGenerator(
+            str(tmp_path), ['a', 'b.c', 'd'], None, resource_id='rid'
+        )
+        with generator:
+            generator.write({'a': 1, 'b': {'c': ['x', 'y']}})
+            generator.write({'d': '=1+1\x07'})
+        generator.cleanup()
+        assert read(tmp_path / 'rid.xlsx') == {
+            'Records': [
+                ['a', 'b.c', 'd', XlsxDerivativeGenerator.RESOURCE_ID_FIELD_NAME],
+                [1, 'x | y', None, 'rid'],
+                # formulae are written as text and illegal characters are removed
+                [None, None, '=1+1', 'rid'],
+            ]
+        }
+        assert (
+            openpyxl.load_workbook(tmp_path / 'rid.xlsx').active['C3'].data_type == 's'
+        )
+
+    def test_sheets(self, tmp_path):
+        generator = XlsxDerivativeGenerator(str(tmp_path), ['a'], None)
+        with patch.object(xlsx, 'MAX_ROWS', 3):
+            # the generator is opened once for each resource in combined downloads
+            for start in (0, 3):
+                with generator:
+                    for n in range(start, start + 3):
+                        generator.write({'a': n})
+            generator.cleanup()
+        assert read(tmp_path / 'resource.xlsx') == {
+            'Records': [['a'], [0], [1]],
+            'Records 2': [['a'], [2], [3]],
+            'Records 3': [['a'], [4], [5]],
+        }
+
+    def test_empty(self, tmp_path):
+        generator = XlsxDerivativeGenerator(str(tmp_path), ['a'], None)
+        with generator:
+            pass
+        generator.cleanup()
+        assert read(tmp_path / 'resource.xlsx') == {'Records': [['a']]}
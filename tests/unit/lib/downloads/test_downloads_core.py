@@ -0,0 +1,356 @@
+from unittest.mock import MagicMock, patch
+
+import fastavro
+import pytest
+from elasticsearch import NotFoundError
+from elasticsearch_dsl import Search
+
+from ckanext.versioned_datastore.lib.downloads import core
+from ckanext.versioned_datastore.lib.downloads.core import (
+    CoreFile,
+    WriterOptions,
+    generate_core_files,
+    merge_slices,
+    write_resumable,
+)
+
+schema = {
+    'type': 'record',
+    'name': 'Record',
+    'fields': [{'name': 'n', 'type': ['long', 'null']}],
+}
+
+
+class FakeSearch:
+    """
+    Mimics enough of an elasticsearch-dsl search to scan records, splitting them
+    between the slices by their value.
+    """
+
+    def __init__(self, count, slice_id=0, slices=1):
+        self.count = count
+        self.slice_id = slice_id
+        self.slices = slices
+
+    def index(self, *args):
+        return self
+
+    def filter(self, query):
+        return self
+
+    def extra(self, slice):
+        return FakeSearch(self.count, slice['id'], slice['max'])
+
+    def scan(self):
+        for n in range(self.count):
+            if n % self.slices == self.slice_id:
+                hit = MagicMock()
+                hit.data.to_dict.return_value = {'n': n}
+                yield hit
+
+
+class FakePagedSearch:
+    """
+    Mimics enough of an elasticsearch-dsl search to page through records in order using
+    search_after.
+    """
+
+    def __init__(self, count, params=None):
+        self.count = count
+        self.params = params or {}
+
+    def index(self, *args):
+        return self
+
+    def filter(self, query):
+        return self
+
+    def sort(self, *args):
+        return self
+
+    def extra(self, **params):
+        return FakePagedSearch(self.count, {**self.params, **params})
+
+    def execute(self):
+        start = (
+            self.params['search_after'][0] + 1 if 'search_after' in self.params else 0
+        )
+        hits = []
+        for n in range(start, min(start + self.params['size'], self.count)):
+            hit = MagicMock()
+            hit.data.to_dict.return_value = {'n': n}
+            hit.meta.sort = [n]
+            hits.append(hit)
+        # the point in time ID changes after the first request
+        return MagicMock(hits=hits, pit_id=f'{self.params["pit"]["id"]}+')
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return sorted(record['n'] for record in fastavro.reader(f))
+
+
+@pytest.fixture
+def fake_search():
+    def get_database(resource_id):
+        database = MagicMock()
+        database.search.return_value = FakeSearch(25 if resource_id == 'a' else 7)
+        return database
+
+    with patch.object(core, 'get_database', side_effect=get_database), patch.object(
+        core, 'get_version_indexes', return_value=[]
+    ), patch.object(core, 'rebuild_data', side_effect=lambda data: data), patch.object(
+        core, '_init_worker'
+    ):
+        yield
+
+
+class TestWriterOptions:
+    def test_defaults(self):
+        options = WriterOptions.create()
+        assert options == WriterOptions()
+        assert options.writer_kwargs()['codec'] == 'deflate'
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_codec', 'bzip2')
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_codec_level', '5')
+    def test_config(self):
+        options = WriterOptions.create()
+        assert options.codec == 'bzip2'
+        assert options.codec_level == 5
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_codec', 'bzip2')
+    def test_overrides(self):
+        options = WriterOptions.create({'codec': 'null', 'block_size': '10'})
+        assert options.codec == 'null'
+        assert options.block_size == 10
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            WriterOptions.create({'codec': 'not a codec'})
+        with pytest.raises(ValueError):
+            WriterOptions.create({'block_size': 0})
+        with pytest.raises(ValueError):
+            WriterOptions.create({'beans': 4})
+
+
+def test_block_size(tmp_path):
+    core_file = CoreFile(
+        'a', 1, str(tmp_path / 'a_1.avro'), schema, WriterOptions(block_size=10)
+    )
+    database = MagicMock()
+    database.search.return_value = FakeSearch(25)
+    with patch.object(core, 'get_database', return_value=database), patch.object(
+        core, 'get_version_indexes', return_value=[]
+    ), patch.object(core, 'rebuild_data', side_effect=lambda data: data):
+        assert core.write_slice(core_file, {}, core_file.path) == 25
+
+    with open(core_file.path, 'rb') as f:
+        blocks = [block.num_records for block in fastavro.block_reader(f)]
+    assert blocks == [10, 10, 5]
+    assert read(core_file.path) == list(range(25))
+
+
+def test_merge_slices(tmp_path):
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / f'slice.{i}')
+        with open(path, 'wb') as f:
+            fastavro.writer(
+                f,
+                fastavro.parse_schema(schema),
+                [{'n': i * 10 + n} for n in range(5)],
+                codec='bzip2',
+            )
+        paths.append(path)
+
+    core_file = CoreFile('a', 1, str(tmp_path / 'a_1.avro'), schema)
+    merge_slices(core_file, paths)
+
+    assert read(core_file.path) == sorted(
+        i * 10 + n for i in range(3) for n in range(5)
+    )
+    assert not any((tmp_path / f'slice.{i}').exists() for i in range(3))
+
+
+@pytest.mark.usefixtures('fake_search')
+class TestGenerateCoreFiles:
+    def generate(self, tmp_path, single_pass=False):
+        core_files = [
+            CoreFile(
+                'a', 1, str(tmp_path / 'a_1.avro'), None if single_pass else schema
+            ),
+            CoreFile(
+                'b', 1, str(tmp_path / 'b_1.avro'), None if single_pass else schema
+            ),
+        ]
+        temp_dir = tmp_path / 'temp'
+        temp_dir.mkdir()
+        on_start = MagicMock()
+        generate_core_files(core_files, {}, str(temp_dir), on_start, single_pass)
+        assert [core_file.total for core_file in core_files] == [25, 7]
+        assert read(core_files[0].path) == list(range(25))
+        assert read(core_files[1].path) == list(range(7))
+        assert on_start.call_count == 2
+        # all the slice files should have been cleaned up
+        assert not list(temp_dir.iterdir())
+        return core_files
+
+    def test_sequential(self, tmp_path):
+        self.generate(tmp_path)
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_slices', '3')
+    @pytest.mark.ckan_config(
+        'ckanext.versioned_datastore.download_resource_workers', '2'
+    )
+    def test_sliced(self, tmp_path):
+        self.generate(tmp_path)
+
+    @pytest.mark.ckan_config(
+        'ckanext.versioned_datastore.download_resource_workers', '2'
+    )
+    def test_concurrent_resources(self, tmp_path):
+        self.generate(tmp_path)
+
+    def check_single_pass(self, core_files):
+        for core_file, count in zip(core_files, [25, 7]):
+            # 0 is a value too
+            assert core_file.field_counts == {'n': count}
+            assert core_file.schema == {
+                'type': 'record',
+                'name': 'Record',
+                'fields': [{'name': 'n', 'type': ['long', 'null']}],
+            }
+
+    def test_single_pass(self, tmp_path):
+        self.check_single_pass(self.generate(tmp_path, single_pass=True))
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_slices', '3')
+    def test_single_pass_sliced(self, tmp_path):
+        self.check_single_pass(self.generate(tmp_path, single_pass=True))
+
+
+@pytest.mark.ckan_config(
+    'ckanext.versioned_datastore.download_checkpoint_interval', '10'
+)
+class TestWriteResumable:
+    @pytest.fixture(autouse=True)
+    def client(self):
+        database = MagicMock()
+        database.search.return_value = FakePagedSearch(25)
+        client = MagicMock()
+        client.open_point_in_time.return_value = {'id': 'pit'}
+        with patch.object(core, 'get_database', return_value=database), patch.object(
+            core, 'get_version_indexes', return_value=[]
+        ), patch.object(
+            core, 'rebuild_data', side_effect=lambda data: data
+        ), patch.object(core, 'es_client', return_value=client):
+            yield client
+
+    def make_core_file(self, tmp_path, checkpoint=None):
+        return CoreFile(
+            'a',
+            1,
+            str(tmp_path / 'a_1.avro'),
+            schema,
+            WriterOptions(block_size=10),
+            checkpoint=checkpoint,
+        )
+
+    def test_checkpoints(self, tmp_path, client):
+        core_file = self.make_core_file(tmp_path)
+        on_checkpoint = MagicMock()
+        assert write_resumable(core_file, {}, on_checkpoint) == 25
+        assert read(core_file.path) == list(range(25))
+
+        checkpoints = [c.args[1] for c in on_checkpoint.call_args_list]
+        assert [c['records'] for c in checkpoints[:-1]] == [10, 20]
+        assert [c['sort'] for c in checkpoints[:-1]] == [[9], [19]]
+        assert [c['pit'] for c in checkpoints[:-1]] == ['pit+', 'pit++']
+        # the file is complete so the checkpoint is removed
+        assert checkpoints[-1] is None
+        client.close_point_in_time.assert_called_once_with(id='pit+++')
+
+    def test_resume(self, tmp_path):
+        core_file = self.make_core_file(tmp_path)
+        on_checkpoint = MagicMock()
+        write_resumable(core_file, {}, on_checkpoint)
+        checkpoint = on_checkpoint.call_args_list[0].args[1]
+
+        # simulate an interruption part way through the second block
+        with open(core_file.path, 'r+b') as f:
+            f.truncate(checkpoint['offset'])
+            f.seek(checkpoint['offset'])
+            f.write(b'half a block')
+
+        resumed = self.make_core_file(tmp_path, checkpoint)
+        with patch.object(core, 'page_records', wraps=core.page_records) as pages:
+            assert write_resumable(resumed, {}, MagicMock()) == 25
+        assert pages.call_args.args[3:5] == ('pit+', [9])
+        assert read(resumed.path) == list(range(25))
+        with open(resumed.path, 'rb') as f:
+            blocks = [block.num_records for block in fastavro.block_reader(f)]
+        assert blocks == [10, 10, 5]
+
+    def test_invalid_checkpoint(self, tmp_path):
+        core_file = self.make_core_file(tmp_path)
+        on_checkpoint = MagicMock()
+        write_resumable(core_file, {}, on_checkpoint)
+        checkpoint = on_checkpoint.call_args_list[0].args[1]
+
+        bad_checkpoints = [
+            {**checkpoint, **bad}
+            for bad in [{'version': 2}, {'sync': '00' * 16}, {'offset': 1}]
+        ]
+        # checkpoints from before points in time were used
+        bad_checkpoints.append({k: v for k, v in checkpoint.items() if k != 'pit'})
+        for bad_checkpoint in bad_checkpoints:
+            resumed = self.make_core_file(tmp_path, bad_checkpoint)
+            with patch.object(core, 'page_records', wraps=core.page_records) as pages:
+                assert write_resumable(resumed, {}, MagicMock()) == 25
+            # started from the beginning
+            assert pages.call_args.args[4] is None
+            assert read(resumed.path) == list(range(25))
+
+    def test_expired_pit(self, tmp_path, client):
+        core_file = self.make_core_file(tmp_path)
+        on_checkpoint = MagicMock()
+        write_resumable(core_file, {}, on_checkpoint)
+        checkpoint = on_checkpoint.call_args_list[0].args[1]
+
+        client.search.side_effect = NotFoundError('expired', MagicMock(), {})
+        client.open_point_in_time.return_value = {'id': 'new-pit'}
+        resumed = self.make_core_file(tmp_path, checkpoint)
+        with patch.object(core, 'page_records', wraps=core.page_records) as pages:
+            assert write_resumable(resumed, {}, MagicMock()) == 25
+        # the records may have changed since the checkpoint so it starts again
+        assert pages.call_args.args[3:5] == ('new-pit', None)
+        assert read(resumed.path) == list(range(25))
+
+
+class TestCountAllRecords:
+    def test_count(self):
+        client = MagicMock()
+        client.options.return_value.msearch.return_value = {
+            'responses': [
+                {'hits': {'total': {'value': 4, 'relation': 'eq'}, 'hits': []}},
+                {'hits': {'total': {'value': 6, 'relation': 'eq'}, 'hits': []}},
+            ]
+        }
+        database = MagicMock()
+        database.search.side_effect = lambda version: Search()
+        with patch.object(core, 'es_client', return_value=client), patch.object(
+            core, 'get_database', return_value=database
+        ), patch.object(
+            core,
+            'get_version_indexes',
+            side_effect=lambda resource_ids, version: resource_ids,
+        ):
+            assert core.count_all_records({'a': 1, 'b': 2}, {'match_all': {}}, 3) == 10
+        # one request is made for all the resources, bounded by the timeout
+        client.options.assert_called_once_with(request_timeout=3)
+        client.options.return_value.msearch.assert_called_once()
+
+    def test_no_resources(self):
+        with patch.object(core, 'es_client') as es_client:
+            assert core.count_all_records({}, {}, 3) == 0
+        assert not es_client.called
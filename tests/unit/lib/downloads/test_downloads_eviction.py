@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.versioned_datastore.lib.downloads import eviction
+from ckanext.versioned_datastore.lib.downloads.eviction import CachedFile, collect
+
+old = datetime.utcnow() - timedelta(days=30)
+
+
+def make_file(name, size, days_ago, uses, modified=old):
+    return CachedFile(
+        name, size, modified, datetime.utcnow() - timedelta(days=days_ago), uses
+    )
+
+
+@pytest.fixture
+def files():
+    cached_files = [
+        # recently used, but only once
+        make_file('a', 10, 1, 1),
+        # used a lot, but not recently
+        make_file('b', 10, 20, 50),
+        # somewhere in between
+        make_file('c', 10, 10, 10),
+    ]
+    with patch.object(eviction, 'find_files', return_value=cached_files), patch.object(
+        eviction, 'evict'
+    ) as evict, patch.object(eviction, 'is_pinned', return_value=False):
+        yield evict
+
+
+def paths(cached_files):
+    return [cached_file.path for cached_file in cached_files]
+
+
+@pytest.mark.usefixtures('files')
+class TestCollect:
+    def test_within_budget(self):
+        assert collect('/downloads', 30) == []
+
+    def test_no_budget(self):
+        assert collect('/downloads') == []
+
+    def test_lru(self, files):
+        assert paths(collect('/downloads', 15, 'lru')) == ['b', 'c']
+        assert files.call_count == 2
+
+    def test_lfu(self):
+        assert paths(collect('/downloads', 25, 'lfu')) == ['a']
+
+    def test_dry_run(self, files):
+        assert paths(collect('/downloads', 0, dry_run=True)) == ['b', 'c', 'a']
+        assert not files.called
+
+    def test_pinned(self):
+        with patch.object(
+            eviction, 'is_pinned', side_effect=lambda f: f.path == 'b'
+        ) as is_pinned:
+            assert paths(collect('/downloads', 15)) == ['c', 'a']
+        assert is_pinned.call_count == 3
+
+    def test_grace_period(self):
+        with patch.object(
+            eviction,
+            'find_files',
+            return_value=[make_file('new', 10, 50, 0, datetime.utcnow())],
+        ):
+            assert collect('/downloads', 0) == []
+
+    def test_invalid_policy(self):
+        with pytest.raises(ValueError):
+            collect('/downloads', 0, 'fifo')
+
+
+def test_evict_core_file(tmp_path):
+    folder = tmp_path / 'core' / 'query-hash'
+    folder.mkdir(parents=True)
+    core_path = folder / 'a_1.avro'
+    core_path.touch()
+
+    cached_file = CachedFile(
+        str(core_path), 0, old, old, record_ids=['core'], resource_id='a'
+    )
+    with patch.object(eviction.CoreFileRecord, 'remove_resource') as remove_resource:
+        eviction.evict(cached_file)
+    assert not core_path.exists()
+    remove_resource.assert_called_once_with(['core'], 'a')
+    # the folder is left for any download about to write to it
+    assert folder.exists()
+
+
+class TestQueueCollection:
+    def test_no_budget(self):
+        with patch('ckan.plugins.toolkit.enqueue_job') as enqueue_job:
+            eviction.queue_collection()
+        assert not enqueue_job.called
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_disk_budget', '100')
+    def test_interval(self):
+        redis = MagicMock()
+        redis.set.side_effect = [True, None]
+        with patch.object(eviction, 'connect_to_redis', return_value=redis), patch(
+            'ckan.plugins.toolkit.enqueue_job'
+        ) as enqueue_job:
+            eviction.queue_collection()
+            eviction.queue_collection()
+        assert enqueue_job.call_count == 1
+
+
+def test_find_sharded_files(tmp_path):
+    zip_paths = [tmp_path / 'flat.zip', tmp_path / 'sh' / 'sharded.zip']
+    core_paths = [
+        tmp_path / 'core' / 'flat-hash' / 'a_1.avro',
+        tmp_path / 'core' / 'sh' / 'sharded-hash' / 'a_1.avro',
+    ]
+    for path in zip_paths + core_paths:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    # custom filename links aren't download files
+    (tmp_path / 'custom').mkdir()
+    (tmp_path / 'custom' / 'custom.zip').touch()
+
+    session = MagicMock()
+    session.query.return_value.filter.return_value = [('derivative', str(zip_paths[1]))]
+    session.query.return_value.__iter__.return_value = iter(
+        [('core', 'sharded-hash', {'a': 1})]
+    )
+    with patch.object(eviction, 'Session', session), patch.object(
+        eviction, '_get_usage', return_value={}
+    ):
+        cached_files = {f.path: f for f in eviction.find_files(str(tmp_path))}
+
+    assert set(cached_files) == set(map(str, zip_paths + core_paths))
+    assert cached_files[str(zip_paths[1])].record_ids == ['derivative']
+    assert cached_files[str(core_paths[1])].record_ids == ['core']
+    assert cached_files[str(core_paths[1])].resource_id == 'a'
+    assert cached_files[str(core_paths[0])].record_ids == []
@@ -0,0 +1,41 @@
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.versioned_datastore.lib.downloads import inflight
+
+
+class TestInFlight:
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_claim(self):
+        assert inflight.claim('hash', 'request-1', 'job-1') is None
+        assert inflight.claim('hash', 'request-2', 'job-2') == {
+            'request_id': 'request-1',
+            'job_id': 'job-1',
+        }
+        assert inflight.claim('other-hash', 'request-2', 'job-2') is None
+
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_get_claim(self):
+        assert inflight.get_claim('hash') is None
+        inflight.claim('hash', 'request-1', 'job-1')
+        assert inflight.get_claim('hash') == {
+            'request_id': 'request-1',
+            'job_id': 'job-1',
+        }
+
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_release(self):
+        inflight.claim('hash', 'request-1', 'job-1')
+        # releasing another request's claim does nothing
+        inflight.release(['hash'], 'request-2')
+        assert inflight.claim('hash', 'request-2', 'job-2') is not None
+        inflight.release(['hash'], 'request-1')
+        assert inflight.claim('hash', 'request-2', 'job-2') is None
+
+    def test_redis_failure(self):
+        with patch.object(inflight, 'connect_to_redis', side_effect=Exception('nope')):
+            assert inflight.claim('hash', 'request-1', 'job-1') is None
+            assert inflight.get_claim('hash') is None
+            # shouldn't raise
+            inflight.release(['hash'], 'request-1')
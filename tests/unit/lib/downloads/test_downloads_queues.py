@@ -0,0 +1,81 @@
+from unittest.mock import patch
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.versioned_datastore.lib.downloads import queues
+
+
+class TestGetQueueName:
+    def test_no_limits(self):
+        assert not queues.is_sized()
+        assert queues.get_queue_name(10) == queues.DEFAULT_QUEUE
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_small_limit', '10')
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_large_limit', '100')
+    def test_limits(self):
+        assert queues.is_sized()
+        assert queues.get_queue_name(0) == queues.SMALL_QUEUE
+        assert queues.get_queue_name(10) == queues.SMALL_QUEUE
+        assert queues.get_queue_name(11) == queues.DEFAULT_QUEUE
+        assert queues.get_queue_name(100) == queues.DEFAULT_QUEUE
+        assert queues.get_queue_name(101) == queues.LARGE_QUEUE
+        # couldn't be counted
+        assert queues.get_queue_name(None) == queues.DEFAULT_QUEUE
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_large_limit', '100')
+    def test_large_only(self):
+        assert queues.get_queue_name(0) == queues.DEFAULT_QUEUE
+        assert queues.get_queue_name(101) == queues.LARGE_QUEUE
+
+
+class TestUserLimit:
+    def test_no_limit(self, with_fake_redis):
+        for i in range(5):
+            queues.add_in_progress('user', f'request-{i}')
+        assert not with_fake_redis.values
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_user_limit', '2')
+    def test_limit(self, with_fake_redis):
+        queues.add_in_progress('user', 'request-1')
+        queues.add_in_progress('user', 'request-2')
+        with pytest.raises(toolkit.ValidationError):
+            queues.add_in_progress('user', 'request-3')
+        # the rejected download isn't recorded
+        key = queues._get_key('user')
+        assert set(with_fake_redis.values[key]) == {'request-1', 'request-2'}
+        # other users aren't affected
+        queues.add_in_progress('other-user', 'request-4')
+        queues.remove_in_progress('user', 'request-1')
+        queues.add_in_progress('user', 'request-3')
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_user_limit', '1')
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_expired(self):
+        queues.add_in_progress('user', 'request-1')
+        with patch.object(
+            queues.time,
+            'time',
+            return_value=queues.time.time() + queues.IN_PROGRESS_TTL,
+        ):
+            queues.add_in_progress('user', 'request-2')
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_user_limit', '1')
+    def test_unknown_owner(self, with_fake_redis):
+        queues.add_in_progress(None, 'request-1')
+        queues.add_in_progress(None, 'request-2')
+        assert not with_fake_redis.values
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_user_limit', '1')
+    def test_redis_failure(self):
+        with patch.object(queues, 'connect_to_redis', side_effect=Exception('nope')):
+            # shouldn't raise
+            queues.add_in_progress('user', 'request-1')
+            queues.add_in_progress('user', 'request-2')
+            queues.remove_in_progress('user', 'request-1')
+
+    def test_get_owner(self):
+        assert queues.get_owner({'user': 'someone'}) == 'someone'
+        # anonymous users aren't limited
+        assert queues.get_owner({'user': ''}) is None
+        assert queues.get_owner({}) is None
@@ -1,9 +1,15 @@
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+import fastavro
 import pytest
 from ckan.model import Session
+from ckan.plugins import toolkit
+from rq.job import Job
 
+from ckanext.versioned_datastore.lib.common import NON_DATASTORE_VERSION
+from ckanext.versioned_datastore.lib.downloads import inflight
 from ckanext.versioned_datastore.lib.downloads.download import DownloadRunManager
+from ckanext.versioned_datastore.lib.downloads.queues import DEFAULT_QUEUE, SMALL_QUEUE
 from ckanext.versioned_datastore.logic.download.arg_objects import (
     DerivativeArgs,
     NotifierArgs,
@@ -80,3 +86,357 @@ class MockPlugin:
 
     def download_after_init(self, request):
         return
+
+
+class TestShouldStream:
+    def make_run_manager(self, tmp_path, format='csv'):
+        run_manager = DownloadRunManager.__new__(DownloadRunManager)
+        run_manager.derivative_options = MagicMock(format=format)
+        run_manager.derivative_record = MagicMock(filepath=None)
+        run_manager.query = MagicMock()
+        run_manager.resource_ids_and_versions = {'a': 1}
+        run_manager.core_dir = str(tmp_path)
+        return run_manager
+
+    def should_stream(self, run_manager, slug_or_doi=None, saved=False):
+        query_args = MagicMock(slug_or_doi=slug_or_doi)
+        with patch(
+            'ckanext.versioned_datastore.lib.downloads.download.is_saved_query',
+            return_value=saved,
+        ):
+            return run_manager.should_stream(query_args)
+
+    def test_disabled(self, tmp_path):
+        assert not self.should_stream(self.make_run_manager(tmp_path))
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_direct', 'true')
+    def test_enabled(self, tmp_path):
+        run_manager = self.make_run_manager(tmp_path)
+        assert self.should_stream(run_manager)
+        assert not self.should_stream(run_manager, slug_or_doi='some-slug')
+        assert not self.should_stream(run_manager, saved=True)
+        assert not self.should_stream(self.make_run_manager(tmp_path, format='raw'))
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_direct', 'true')
+    def test_existing_core_file(self, tmp_path):
+        run_manager = self.make_run_manager(tmp_path)
+        run_manager.query.hash = 'query-hash'
+        core_folder = tmp_path / 'query-hash'
+        core_folder.mkdir()
+        (core_folder / 'a_1.avro').touch()
+        assert not self.should_stream(run_manager)
+
+
+def make_run_manager(resource_ids_and_versions):
+    run_manager = DownloadRunManager.__new__(DownloadRunManager)
+    run_manager.resource_ids_and_versions = resource_ids_and_versions
+    run_manager.query = MagicMock(hash='query-hash')
+    run_manager.derivative_options = MagicMock(fields=[])
+    run_manager.derivative_record = MagicMock(filepath=None)
+    run_manager.direct = False
+    run_manager.request = MagicMock(id='request', state=DownloadRequest.state_core_gen)
+    run_manager.core_record = MagicMock(resource_totals={}, field_counts={})
+    run_manager.notifier = MagicMock()
+    run_manager._temp = []
+    run_manager.owner = None
+    run_manager.queue_name = DEFAULT_QUEUE
+    run_manager.claimed = []
+    run_manager.refresh = MagicMock()
+    run_manager.finish = MagicMock()
+    return run_manager
+
+
+def queue(run_manager, claims=None, claim=None):
+    claims = claims or {}
+    with patch(
+        'ckan.plugins.toolkit.enqueue_job',
+        side_effect=lambda *args, **kwargs: MagicMock(spec=Job),
+    ) as enqueue_job, patch.object(
+        inflight, 'get_claim', side_effect=claims.get
+    ), patch.object(inflight, 'claim', claim or MagicMock(return_value=None)):
+        run_manager.queue()
+    return enqueue_job.call_args_list
+
+
+class TestSplitJobs:
+    def test_disabled(self):
+        run_manager = make_run_manager({'a': 1, 'b': 1})
+        calls = queue(run_manager)
+        assert len(calls) == 1
+        assert calls[0].args[0] == run_manager.run
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_split_jobs', 'true')
+    def test_single_resource(self):
+        run_manager = make_run_manager({'a': 1, 'b': NON_DATASTORE_VERSION})
+        calls = queue(run_manager)
+        assert len(calls) == 1
+        assert calls[0].args[0] == run_manager.run
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_split_jobs', 'true')
+    def test_split(self):
+        run_manager = make_run_manager({'a': 1, 'b': 2})
+        calls = queue(run_manager)
+        functions = [c.args[0] for c in calls]
+        assert functions == [
+            run_manager.start,
+            run_manager.run_core,
+            run_manager.run_core,
+            run_manager.run_package,
+        ]
+        assert [c.kwargs['args'] for c in calls[1:3]] == [['a'], ['b']]
+        package_dependency = calls[3].kwargs['rq_kwargs']['depends_on']
+        assert len(package_dependency.dependencies) == 2
+        assert package_dependency.allow_failure
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_small_limit', '10')
+    def test_sized(self):
+        run_manager = make_run_manager({'a': 1})
+        with patch.object(run_manager, 'estimate_size', return_value=4):
+            calls = queue(run_manager)
+        assert calls[0].kwargs['queue'] == SMALL_QUEUE
+        with patch.object(run_manager, 'estimate_size', return_value=11):
+            calls = queue(run_manager)
+        assert calls[0].kwargs['queue'] == DEFAULT_QUEUE
+
+    def test_user_limit(self):
+        run_manager = make_run_manager({'a': 1})
+        claim = MagicMock()
+        with patch(
+            'ckanext.versioned_datastore.lib.downloads.download.add_in_progress',
+            side_effect=toolkit.ValidationError('too many'),
+        ):
+            with pytest.raises(toolkit.ValidationError):
+                queue(run_manager, claim=claim)
+        run_manager.request.update_status.assert_called_once_with(
+            DownloadRequest.state_failed, 'Too many downloads in progress'
+        )
+        assert not claim.called
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_small_limit', '10')
+    @pytest.mark.ckan_config(
+        'ckanext.versioned_datastore.download_estimate_timeout', '2'
+    )
+    def test_sized_timeout(self):
+        run_manager = make_run_manager({'a': 1, 'b': NON_DATASTORE_VERSION})
+        run_manager.query.to_dsl.return_value = {'match_all': {}}
+        with patch(
+            'ckanext.versioned_datastore.lib.downloads.download.count_all_records',
+            side_effect=TimeoutError(),
+        ) as count_all_records:
+            calls = queue(run_manager)
+        count_all_records.assert_called_once_with({'a': 1}, {'match_all': {}}, 2.0)
+        # the download couldn't be counted in time so it goes on the default queue
+        assert calls[0].kwargs['queue'] == DEFAULT_QUEUE
+
+    def test_package(self):
+        run_manager = make_run_manager({'a': 1, 'b': 2})
+        run_manager.core_record.resource_totals = {'a': 4, 'b': 3}
+        run_manager.core_record.field_counts = {'a': {}, 'b': {}}
+        with patch.object(run_manager, 'update_core_record') as update_core_record:
+            run_manager.run_package()
+        update_core_record.assert_called_once_with({'a': 4, 'b': 3}, {'a': {}, 'b': {}})
+        assert run_manager.finish.called
+
+    def test_package_missing_core(self):
+        run_manager = make_run_manager({'a': 1, 'b': 2})
+        run_manager.core_record.resource_totals = {'a': 4}
+        with pytest.raises(Exception, match='No core file for b'):
+            run_manager.run_package()
+        run_manager.request.update_status.assert_called_once()
+        assert run_manager.notifier.notify_error.called
+        assert not run_manager.finish.called
+
+    def test_package_after_failure(self):
+        run_manager = make_run_manager({'a': 1, 'b': 2})
+        run_manager.request.state = DownloadRequest.state_failed
+        run_manager.run_package()
+        assert run_manager.notifier.notify_error.called
+        assert not run_manager.finish.called
+
+    def test_core_after_failure(self):
+        run_manager = make_run_manager({'a': 1, 'b': 2})
+        run_manager.request.state = DownloadRequest.state_failed
+        with patch.object(run_manager, 'build_core') as build_core:
+            run_manager.run_core('a')
+        assert not build_core.called
+
+    def test_core_failure(self):
+        run_manager = make_run_manager({'a': 1, 'b': 2})
+        run_manager.direct = False
+        with patch.object(run_manager, 'build_core', side_effect=Exception('oh no')):
+            with pytest.raises(Exception):
+                run_manager.run_core('a')
+        run_manager.request.update_status.assert_called_once()
+        # the package job does the notifying
+        assert not run_manager.notifier.notify_error.called
+
+    def test_core_progress(self):
+        run_manager = make_run_manager({'a': 1, 'b': 2})
+        run_manager.direct = True
+        with patch(
+            'ckanext.versioned_datastore.lib.downloads.download.count_records',
+            return_value=4,
+        ), patch(
+            'ckanext.versioned_datastore.lib.downloads.download.calculate_field_counts',
+            return_value={},
+        ):
+            run_manager.run_core('a')
+        # progress updates can't overwrite the failed state set by another core job
+        run_manager.request.update_progress.assert_called_once_with(
+            DownloadRequest.state_core_gen, 'a'
+        )
+        assert not run_manager.request.update_status.called
+        run_manager.core_record.update_resource.assert_called_once_with('a', 4, {})
+        # there's no core file so nothing is added to the catalogue
+        assert not run_manager.core_record.add_to_catalogue.called
+
+    def test_core_catalogue(self):
+        run_manager = make_run_manager({'a': 1, 'b': 2})
+        with patch.object(
+            run_manager, 'build_core', return_value=({'a': 4}, {'a': {}})
+        ):
+            run_manager.run_core('a')
+        run_manager.core_record.update_resource.assert_called_once_with('a', 4, {})
+        run_manager.core_record.add_to_catalogue.assert_called_once_with(['a'])
+
+
+class TestCoalesce:
+    def test_leader(self):
+        run_manager = make_run_manager({'a': 1})
+        calls = queue(run_manager)
+        assert calls[0].args[0] == run_manager.run
+        assert 'depends_on' not in calls[0].kwargs['rq_kwargs']
+        assert run_manager.claimed == [run_manager.hash, run_manager.record_hash]
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_split_jobs', 'true')
+    @pytest.mark.parametrize('resource_ids_and_versions', [{'a': 1}, {'a': 1, 'b': 1}])
+    def test_claim_after_enqueue(self, resource_ids_and_versions):
+        run_manager = make_run_manager(resource_ids_and_versions)
+        enqueued = []
+
+        def claim(download_hash, request_id, job_id):
+            # the final job, which followers depend on, must already be enqueued
+            assert job_id in enqueued
+
+        with patch(
+            'ckan.plugins.toolkit.enqueue_job',
+            side_effect=lambda *args, **kwargs: enqueued.append(
+                kwargs['rq_kwargs'].get('job_id')
+            ),
+        ), patch.object(inflight, 'get_claim', return_value=None), patch.object(
+            inflight, 'claim', side_effect=claim
+        ) as claim_mock:
+            run_manager.queue()
+        assert [c.args[0] for c in claim_mock.call_args_list] == [
+            run_manager.hash,
+            run_manager.record_hash,
+        ]
+
+    def test_follower(self):
+        run_manager = make_run_manager({'a': 1})
+        claim = MagicMock()
+        leader = {'request_id': 'leader', 'job_id': 'leader-job'}
+        calls = queue(run_manager, {run_manager.hash: leader}, claim)
+        assert not claim.called
+        assert len(calls) == 1
+        assert calls[0].args[0] == run_manager.run
+        assert calls[0].kwargs['kwargs'] == {'leader_id': 'leader'}
+        dependency = calls[0].kwargs['rq_kwargs']['depends_on']
+        assert dependency.dependencies == ['leader-job']
+        assert not run_manager.claimed
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_small_limit', '10')
+    def test_sized_follower(self):
+        run_manager = make_run_manager({'a': 1})
+        leader = {'request_id': 'leader', 'job_id': 'leader-job'}
+        # if the leader fails the follower generates the download itself, so it goes
+        # on the queue for its size rather than the smallest one
+        with patch.object(run_manager, 'estimate_size', return_value=11):
+            calls = queue(run_manager, {run_manager.hash: leader})
+        assert calls[0].kwargs['kwargs'] == {'leader_id': 'leader'}
+        assert calls[0].kwargs['queue'] == DEFAULT_QUEUE
+
+    def test_same_records(self):
+        run_manager = make_run_manager({'a': 1})
+        leader = {'request_id': 'leader', 'job_id': 'leader-job'}
+        calls = queue(run_manager, {run_manager.record_hash: leader})
+        assert calls[0].args[0] == run_manager.run
+        assert 'kwargs' not in calls[0].kwargs
+        dependency = calls[0].kwargs['rq_kwargs']['depends_on']
+        assert dependency.dependencies == ['leader-job']
+        assert run_manager.claimed == [run_manager.hash]
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_coalesce', 'false')
+    def test_disabled(self):
+        run_manager = make_run_manager({'a': 1})
+        claim = MagicMock()
+        queue(run_manager, claim=claim)
+        assert not claim.called
+
+    def test_adopt(self, tmp_path):
+        run_manager = make_run_manager({'a': 1})
+        zip_path = tmp_path / 'download.zip'
+        leader = MagicMock(state=DownloadRequest.state_complete)
+        leader.derivative_record.filepath = str(zip_path)
+        with patch.object(DownloadRequest, 'get', return_value=leader):
+            # the file doesn't exist
+            assert not run_manager.adopt('leader')
+            zip_path.touch()
+            assert run_manager.adopt('leader')
+            assert run_manager.derivative_record == leader.derivative_record
+            leader.state = DownloadRequest.state_failed
+            assert not run_manager.adopt('leader')
+
+
+class TestLayout:
+    def make_run_manager(self, tmp_path):
+        run_manager = make_run_manager({'a': 1})
+        run_manager.download_dir = str(tmp_path)
+        run_manager.core_dir = str(tmp_path / 'core')
+        return run_manager
+
+    def test_unsharded(self, tmp_path):
+        run_manager = self.make_run_manager(tmp_path)
+        assert run_manager.core_folder_path == str(tmp_path / 'core' / 'query-hash')
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_sharded', 'true')
+    def test_sharded(self, tmp_path):
+        run_manager = self.make_run_manager(tmp_path)
+        assert run_manager.core_folder_path == str(
+            tmp_path / 'core' / 'qu' / 'query-hash'
+        )
+        # existing unsharded core folders are still used
+        (tmp_path / 'core' / 'query-hash').mkdir(parents=True)
+        assert run_manager.core_folder_path == str(tmp_path / 'core' / 'query-hash')
+
+    def test_existing_derivative(self, tmp_path):
+        run_manager = self.make_run_manager(tmp_path)
+        zip_path = tmp_path / 'do' / 'download-hash.zip'
+        zip_path.parent.mkdir()
+        zip_path.touch()
+        records = [
+            MagicMock(filepath=None),
+            MagicMock(filepath=str(tmp_path / 'missing.zip')),
+            MagicMock(filepath=str(zip_path)),
+        ]
+        with patch.object(
+            DerivativeFileRecord, 'get_by_hash', return_value=records
+        ), patch.object(DownloadRunManager, 'hash', 'download-hash'):
+            core_record, derivative_record = run_manager.check_for_records()
+        assert derivative_record is records[2]
+        assert core_record is records[2].core_record
+
+    def test_load_schema(self, tmp_path):
+        run_manager = self.make_run_manager(tmp_path)
+        run_manager.resource_ids_and_versions = {'a': 1, 'b': NON_DATASTORE_VERSION}
+        schema = {
+            'type': 'record',
+            'name': 'Record',
+            'fields': [{'name': 'n', 'type': ['long', 'null']}],
+        }
+        core_path = tmp_path / 'core' / 'query-hash' / 'a_1.avro'
+        core_path.parent.mkdir(parents=True)
+        with open(core_path, 'wb') as f:
+            fastavro.writer(f, fastavro.parse_schema(schema), [{'n': 1}])
+        assert run_manager.load_schema('a') == schema
+        assert run_manager.load_schema('b') is None
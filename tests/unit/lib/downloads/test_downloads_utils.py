@@ -4,7 +4,7 @@ import pytest
 from splitgill.model import Record
 
 from ckanext.versioned_datastore.lib.downloads import utils
-from ckanext.versioned_datastore.lib.downloads.utils import get_schema
+from ckanext.versioned_datastore.lib.downloads.utils import get_schema, get_shard_path
 from ckanext.versioned_datastore.lib.importing.options import (
     create_default_options_builder,
 )
@@ -85,6 +85,96 @@ class TestGetSchema:
         ]
 
 
+class TestRecordStats:
+    def test_schema(self):
+        stats = utils.RecordStats()
+        stats.add(
+            {
+                '_id': '1',
+                'name': 'Paru',
+                'size': 5,
+                'dob': '2021-01-12',
+                'good': True,
+                'toys': ['Feather stick', 'Monsieur Canard', 'Catnip Carrot'],
+                'food': [
+                    {'name': 'Chicken', 'weight': 40},
+                    {'name': 'Kibble', 'weight': 36},
+                ],
+            }
+        )
+        # this should match the schema get_schema creates from elasticsearch
+        assert stats.schema()['fields'] == [
+            {'name': '_id', 'type': ['string', 'null']},
+            {'name': 'dob', 'type': ['string', 'null']},
+            {
+                'name': 'food',
+                'type': [
+                    {
+                        'items': [
+                            [
+                                {
+                                    'fields': [
+                                        {'name': 'name', 'type': ['string', 'null']},
+                                        {'name': 'weight', 'type': ['long', 'null']},
+                                    ],
+                                    'name': 'food.Record',
+                                    'type': 'record',
+                                },
+                                'null',
+                            ]
+                        ],
+                        'type': 'array',
+                    },
+                    'null',
+                ],
+            },
+            {'name': 'good', 'type': ['boolean', 'null']},
+            {'name': 'name', 'type': ['string', 'null']},
+            {'name': 'size', 'type': ['long', 'null']},
+            {
+                'name': 'toys',
+                'type': [{'items': [['string', 'null']], 'type': 'array'}, 'null'],
+            },
+        ]
+
+    def test_type_union(self):
+        stats = utils.RecordStats()
+        stats.add({'a': 1, 'b': {'c': 'x'}})
+        other = utils.RecordStats()
+        other.add({'a': 'one', 'b': None, 'd': None})
+        other.add({'a': 1.5, 'b': {'e': False}})
+        stats.update(other)
+        assert stats.schema()['fields'] == [
+            {'name': 'a', 'type': ['string', 'long', 'double', 'null']},
+            {
+                'name': 'b',
+                'type': [
+                    {
+                        'type': 'record',
+                        'name': 'bRecord',
+                        'fields': [
+                            {'name': 'c', 'type': ['string', 'null']},
+                            {'name': 'e', 'type': ['boolean', 'null']},
+                        ],
+                    },
+                    'null',
+                ],
+            },
+            {'name': 'd', 'type': ['null']},
+        ]
+
+    def test_field_counts(self):
+        stats = utils.RecordStats()
+        stats.add({'a': 1, 'b': '', 'c': [{'d': 'x'}, {'d': 'y', 'e': None}]})
+        stats.add({'a': 2, 'b': 'beans', 'c': [], 'f': ['', None]})
+        assert stats.field_counts() == {'a': 2, 'b': 1, 'c.d': 1, 'c.e': 0, 'f': 0}
+
+    def test_field_counts_empty_fields(self):
+        stats = utils.RecordStats()
+        stats.add({'a': '', 'b': None, 'c': {'d': ''}, 'e': []})
+        assert stats.field_counts() == {'a': 0, 'b': 0, 'c.d': 0, 'e': 0}
+
+
 class TestFilterDataFields:
     def test_excludes_field_with_zero_count(self):
         data = {'one': 'a', 'two': 'b', 'three': 'c'}
@@ -165,3 +255,12 @@ class TestFlattenDict:
         for k, v in expected_output.items():
             assert k in flattened
             assert v == flattened[k]
+
+
+class TestGetShardPath:
+    def test_unsharded(self):
+        assert get_shard_path('/downloads', 'abcdef.zip') == '/downloads/abcdef.zip'
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.download_sharded', 'true')
+    def test_sharded(self):
+        assert get_shard_path('/downloads', 'abcdef.zip') == '/downloads/ab/abcdef.zip'
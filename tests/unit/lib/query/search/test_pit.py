@@ -0,0 +1,93 @@
+from unittest.mock import patch
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.versioned_datastore.lib.query.search import pit
+from ckanext.versioned_datastore.lib.query.search.pit import (
+    decode_cursor,
+    encode_cursor,
+    get_target_hash,
+)
+from ckanext.versioned_datastore.lib.query.search.query import DirectQuery
+from ckanext.versioned_datastore.lib.query.search.request import SearchRequest
+
+
+class TestCursor:
+    def test_round_trip(self):
+        after = [1234, 'abc', 56]
+        cursor = encode_cursor('pit-id==', after, 'target')
+        assert decode_cursor(cursor) == ('pit-id==', after, 'target')
+
+    def test_target_hash(self):
+        assert get_target_hash(['a', 'b'], 4) == get_target_hash(['b', 'a'], 4)
+        assert get_target_hash(['a', 'b'], 4) != get_target_hash(['a', 'b'], 5)
+        assert get_target_hash(['a', 'b'], 4) != get_target_hash(['a'], 4)
+
+    @pytest.mark.parametrize(
+        'cursor',
+        [
+            'not a cursor',
+            'bm9wZQ==',
+            'e30=',
+            # a cursor from before the target was added
+            'eyJwaXQiOiJwaXQtaWQiLCJhZnRlciI6WzFdfQ==',
+        ],
+    )
+    def test_invalid(self, cursor):
+        with pytest.raises(toolkit.ValidationError):
+            decode_cursor(cursor)
+
+
+class TestPitRequest:
+    def test_set_cursor(self):
+        request = SearchRequest(DirectQuery(['test-1']))
+        request.set_cursor(encode_cursor('pit-id', [1, 'a'], request.target_hash))
+        assert request.pit
+        assert request.pit_id == 'pit-id'
+        assert request.after == [1, 'a']
+
+    def test_set_cursor_other_resources(self):
+        cursor = encode_cursor(
+            'pit-id', [1, 'a'], SearchRequest(DirectQuery(['test-2'])).target_hash
+        )
+        request = SearchRequest(DirectQuery(['test-1']))
+        with pytest.raises(toolkit.ValidationError):
+            request.set_cursor(cursor)
+        assert not request.pit
+        assert request.pit_id is None
+
+    def test_to_search(self):
+        request = SearchRequest(DirectQuery(['test-1']), size=10, pit_id='pit-id')
+        search = request.to_search()
+        assert search._index is None
+        assert search._extra['pit']['id'] == 'pit-id'
+        sorts = search.to_dict()['sort']
+        assert sorts[-1] == {'_shard_doc': 'desc'}
+        assert not any('_index' in sort for sort in sorts)
+
+    def test_after_without_cursor(self):
+        request = SearchRequest(DirectQuery(['test-1']), after=[1, 'a', 'b'], pit=True)
+        with patch.object(pit, 'open_pit') as open_pit:
+            with pytest.raises(toolkit.ValidationError):
+                request.run()
+        assert not open_pit.called
+
+    def test_closed_on_error(self):
+        # the search window is too big, so building the search fails
+        request = SearchRequest(
+            DirectQuery(['test-1']), size=100, offset=9950, pit=True
+        )
+        request.add_param('ignore_unavailable', True)
+        request.add_param('request_cache', True)
+        with patch.object(
+            SearchRequest, 'indexes', return_value=['index-1']
+        ), patch.object(
+            pit, 'open_pit', return_value='pit-id'
+        ) as open_pit, patch.object(pit, 'close_pit') as close_pit:
+            with pytest.raises(toolkit.ValidationError):
+                request.run()
+        # only the parameters opening a point in time takes are passed on
+        open_pit.assert_called_once_with(['index-1'], ignore_unavailable=True)
+        close_pit.assert_called_once_with('pit-id')
+        assert request.pit_id is None
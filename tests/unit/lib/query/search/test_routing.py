@@ -0,0 +1,83 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.versioned_datastore.lib.query.search import routing
+from ckanext.versioned_datastore.lib.query.search.routing import IndexSpan
+
+
+def mock_database(resource_id):
+    database = MagicMock()
+    database.indices.wildcard = f'data-{resource_id}-*'
+    return database
+
+
+@pytest.fixture
+def databases():
+    with patch.object(routing, 'get_database', side_effect=mock_database):
+        yield
+
+
+class TestIndexSpan:
+    def test_latest(self):
+        span = IndexSpan('data-a-latest', 10)
+        assert not span.can_contain(9)
+        assert span.can_contain(10)
+        assert span.can_contain(1000)
+
+    def test_arc(self):
+        span = IndexSpan('data-a-arc-0', 2, 10)
+        assert not span.can_contain(1)
+        assert span.can_contain(2)
+        assert span.can_contain(9)
+        assert not span.can_contain(10)
+
+
+@pytest.mark.usefixtures('databases')
+class TestGetVersionIndexes:
+    routes = {
+        'a': [
+            IndexSpan('data-a-latest', 10),
+            IndexSpan('data-a-arc-1', 5, 12),
+            IndexSpan('data-a-arc-0', 1, 6),
+        ],
+        'b': [IndexSpan('data-b-latest', 3)],
+    }
+
+    def test_routes(self):
+        with patch.object(routing, 'get_routes', return_value=self.routes):
+            assert routing.get_version_indexes(['a'], 5) == [
+                'data-a-arc-0',
+                'data-a-arc-1',
+            ]
+            assert routing.get_version_indexes(['a'], 11) == [
+                'data-a-arc-1',
+                'data-a-latest',
+            ]
+            assert routing.get_version_indexes(['a', 'b'], 20) == [
+                'data-a-latest',
+                'data-b-latest',
+            ]
+
+    def test_no_matching_index(self):
+        with patch.object(routing, 'get_routes', return_value=self.routes):
+            assert routing.get_version_indexes(['b'], 1) == ['data-b-latest']
+
+    def test_unknown_resource(self):
+        with patch.object(routing, 'get_routes', return_value=self.routes):
+            assert routing.get_version_indexes(['a', 'c'], 20) == [
+                'data-a-latest',
+                'data-c-*',
+            ]
+
+    def test_routing_failure(self):
+        with patch.object(routing, 'get_routes', side_effect=Exception('nope')):
+            assert routing.get_version_indexes(['a', 'b'], 5) == [
+                'data-a-*',
+                'data-b-*',
+            ]
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.index_routing', 'false')
+    def test_disabled(self):
+        with patch.object(routing, 'get_routes', return_value=self.routes):
+            assert routing.get_version_indexes(['a'], 5) == ['data-a-*']
@@ -0,0 +1,136 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan.plugins import toolkit
+from elasticsearch_dsl import Q, Search
+
+from ckanext.versioned_datastore.lib.query.search import cache
+from ckanext.versioned_datastore.lib.query.search import request as request_module
+from ckanext.versioned_datastore.lib.query.search.query import DirectQuery
+from ckanext.versioned_datastore.lib.query.search.request import (
+    SearchRequest,
+    run_searches,
+)
+
+
+@pytest.fixture
+def empty_caches():
+    with patch.object(cache, '_pinned_cache', None), patch.object(
+        cache, '_latest_cache', None
+    ), patch.object(cache, 'get_cache_size', return_value=10):
+        yield
+
+
+def patch_generations(generations):
+    return patch.object(cache, 'get_generations', return_value=generations)
+
+
+class TestIsPinned:
+    def test_no_version(self):
+        assert not cache.is_pinned(None, {'a': 10})
+
+    def test_no_generations(self):
+        assert not cache.is_pinned(5, {})
+
+    def test_unknown_generation(self):
+        assert not cache.is_pinned(5, {'a': 10, 'b': None})
+
+    def test_version_ahead_of_generation(self):
+        assert not cache.is_pinned(11, {'a': 10, 'b': 20})
+
+    def test_historic_version(self):
+        assert cache.is_pinned(10, {'a': 10, 'b': 20})
+
+
+class TestMakeKey:
+    def test_stable(self):
+        search_1 = Search(index=['b', 'a']).query(Q('term', x=1))
+        search_2 = Search(index=['a', 'b']).query(Q('term', x=1))
+        assert cache.make_key(search_1, {}) == cache.make_key(search_2, {})
+
+    def test_differs(self):
+        search = Search(index=['a']).query(Q('term', x=1))
+        key = cache.make_key(search, {})
+        assert key != cache.make_key(search.query(Q('term', y=2)), {})
+        assert key != cache.make_key(search, {'ignore_unavailable': True})
+        assert key != cache.make_key(search, {}, {'a': 10})
+        assert cache.make_key(search, {}, {'a': 10}) != cache.make_key(
+            search, {}, {'a': 11}
+        )
+
+
+@pytest.mark.usefixtures('empty_caches')
+class TestRunCached:
+    def test_repeat_uses_cache(self):
+        search = Search(index=['a'])
+        execute = MagicMock()
+        with patch_generations({'a': 10}):
+            first = cache.run_cached(search, {}, ['a'], None, execute)
+            second = cache.run_cached(search, {}, ['a'], None, execute)
+        assert first is second
+        assert execute.call_count == 1
+
+    def test_generation_change_invalidates(self):
+        search = Search(index=['a'])
+        execute = MagicMock()
+        with patch_generations({'a': 10}):
+            cache.run_cached(search, {}, ['a'], None, execute)
+        with patch_generations({'a': 11}):
+            cache.run_cached(search, {}, ['a'], None, execute)
+        assert execute.call_count == 2
+
+    def test_pinned_survives_generation_change(self):
+        search = Search(index=['a'])
+        execute = MagicMock()
+        with patch_generations({'a': 10}):
+            cache.run_cached(search, {}, ['a'], 5, execute)
+        with patch_generations({'a': 11}):
+            cache.run_cached(search, {}, ['a'], 5, execute)
+        assert execute.call_count == 1
+
+    def test_generation_failure_skips_cache(self):
+        search = Search(index=['a'])
+        execute = MagicMock()
+        with patch.object(cache, 'get_generations', side_effect=Exception('nope')):
+            cache.run_cached(search, {}, ['a'], None, execute)
+            cache.run_cached(search, {}, ['a'], None, execute)
+        assert execute.call_count == 2
+
+
+@pytest.mark.usefixtures('empty_caches')
+class TestRunSearches:
+    def test_only_uncached_searches_are_run(self):
+        requests = [
+            SearchRequest(DirectQuery(['test-1'])),
+            SearchRequest(DirectQuery(['test-2'])),
+        ]
+        multi_search = MagicMock()
+        multi_search.add.return_value = multi_search
+        multi_search.execute.side_effect = lambda: (
+            [MagicMock()] * len(multi_search.add.call_args_list)
+        )
+
+        with patch_generations({'test-1': 10, 'test-2': 10}), patch.object(
+            request_module, 'MultiSearch', return_value=multi_search
+        ), patch.object(
+            SearchRequest, 'indexes', lambda self: self.query.resource_ids
+        ), patch.object(
+            request_module, 'ivds_implementations', return_value=[]
+        ), patch.object(request_module, 'es_client'):
+            first = run_searches(requests)
+            assert multi_search.add.call_count == 2
+
+            multi_search.add.reset_mock()
+            requests.append(SearchRequest(DirectQuery(['test-3'])))
+            second = run_searches(requests)
+
+        # only the new search should have been sent
+        assert multi_search.add.call_count == 1
+        assert first[0].response is second[0].response
+        assert first[1].response is second[1].response
+        assert len(second) == 3
+
+    def test_pit_not_allowed(self):
+        requests = [SearchRequest(DirectQuery(['test-1']), pit=True)]
+        with pytest.raises(toolkit.ValidationError):
+            run_searches(requests)
@@ -5,9 +5,11 @@ from collections import OrderedDict
 
 import jsonschema
 import pytest
+from elasticsearch_dsl import Q
 from mock import MagicMock, patch
 
 from ckanext.versioned_datastore.lib.query import schema as schema_lib
+from ckanext.versioned_datastore.lib.query.search.query import SchemaQuery
 
 
 class TestQuery(object):
@@ -76,3 +78,56 @@ class TestQuery(object):
             assert list(schema_lib.schemas.keys()) == ['v1.0.0', 'v1.0.1']
             schema_lib.register_schema('v2.0.1', MagicMock())
             assert list(schema_lib.schemas.keys()) == ['v1.0.0', 'v1.0.1', 'v2.0.1']
+
+    def test_translate_query_is_cached(self):
+        schema = MagicMock(translate=MagicMock(return_value=Q('term', a=1)))
+        with patch(
+            'ckanext.versioned_datastore.lib.query.schema.schemas', {'v1.0.0': schema}
+        ):
+            schema_lib.clear_query_caches()
+            first = schema_lib.translate_query({'a': 1, 'b': 2}, 'v1.0.0')
+            # same query with a different key order
+            second = schema_lib.translate_query({'b': 2, 'a': 1}, 'v1.0.0')
+        assert schema.translate.call_count == 1
+        assert first == second
+        # copies should be returned so that the cached object can't be changed
+        assert first is not second
+
+    def test_query_cache_settings(self):
+        schema = MagicMock(
+            translate=MagicMock(return_value=Q('term', a=1)),
+            get_settings=MagicMock(return_value=('index', 0)),
+        )
+        with patch(
+            'ckanext.versioned_datastore.lib.query.schema.schemas', {'v1.0.0': schema}
+        ):
+            schema_lib.clear_query_caches()
+            schema_lib.translate_query({'a': 1}, 'v1.0.0')
+            schema_lib.translate_query({'a': 1}, 'v1.0.0')
+            assert schema.translate.call_count == 1
+            # the cached translation isn't used once the settings change
+            schema.get_settings.return_value = ('index', 0.1)
+            schema_lib.translate_query({'a': 1}, 'v1.0.0')
+            assert schema.translate.call_count == 2
+
+    def test_schema_query_memoises(self):
+        schema = MagicMock(
+            translate=MagicMock(return_value=Q('term', a=1)),
+            hash=MagicMock(return_value='abc'),
+            normalise=MagicMock(side_effect=lambda q: q),
+        )
+        with patch(
+            'ckanext.versioned_datastore.lib.query.schema.schemas', {'v1.0.0': schema}
+        ):
+            schema_lib.clear_query_caches()
+            query = SchemaQuery(['test'], query={'a': 1}, query_version='v1.0.0')
+            assert query.to_dsl() is query.to_dsl()
+            assert query.hash == query.hash
+            assert schema.validate.call_count == 1
+            assert schema.translate.call_count == 1
+            assert schema.hash.call_count == 1
+
+            # replacing the query resets the memoised values
+            query.query = {'a': 2}
+            query.to_dsl()
+            assert schema.translate.call_count == 2
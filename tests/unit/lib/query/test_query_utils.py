@@ -1,6 +1,8 @@
 from ckanext.versioned_datastore.lib.query.utils import (
     convert_small_or_groups,
     remove_empty_groups,
+    simplify_multipolygon,
+    simplify_ring,
 )
 
 
@@ -52,3 +54,29 @@ class TestQueryUtils(object):
         expected_query = {}
         output_query = remove_empty_groups(test_query)
         assert output_query == expected_query
+
+    def test_simplify_ring(self):
+        # a square with an extra point on each edge which is very close to the edge
+        ring = [
+            [0, 0],
+            [0.5, 0.001],
+            [1, 0],
+            [1.001, 0.5],
+            [1, 1],
+            [0, 1],
+            [0, 0],
+        ]
+        assert simplify_ring(ring, 0.01) == [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+        # the points are further from the edges than the tolerance so are kept
+        assert simplify_ring(ring, 0.0001) == ring
+        assert simplify_ring(ring, 0) == ring
+
+    def test_simplify_ring_keeps_valid_ring(self):
+        # a tiny triangle that would be simplified to a line
+        ring = [[0, 0], [0.001, 0], [0.001, 0.001], [0, 0.001], [0, 0]]
+        assert simplify_ring(ring, 1) == ring
+
+    def test_simplify_multipolygon(self):
+        ring = [[0, 0], [0.5, 0.001], [1, 0], [1, 1], [0, 1], [0, 0]]
+        simplified = [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+        assert simplify_multipolygon([[ring, ring]], 0.01) == [[simplified, simplified]]
@@ -6,6 +6,7 @@ import os
 
 import jsonschema
 import pytest
+from mock import patch
 from splitgill.indexing.fields import DocumentField
 from splitgill.search import ALL_POINTS, keyword, number, text
 
@@ -324,6 +325,24 @@ class TestV1_0_0Translator(object):
         }
         self.compare_query_and_search(query_in, query_out)
 
+    @pytest.mark.ckan_config(
+        'ckanext.versioned_datastore.named_area_index', 'named-areas'
+    )
+    def test_translate_named_area_indexed_shape(self):
+        query_in = {'filters': {'and': [{'geo_named_area': {'country': 'Curaçao'}}]}}
+        query_out = {
+            'geo_shape': {
+                ALL_POINTS: {
+                    'indexed_shape': {
+                        'index': 'named-areas',
+                        'id': 'country:Curaçao',
+                        'path': 'shape',
+                    }
+                }
+            }
+        }
+        self.compare_query_and_search(query_in, query_out)
+
     def test_translate_11(self):
         a_square = [
             [102.0, 2.0],
@@ -426,3 +445,68 @@ class TestV1_0_0Translator(object):
         }
         with pytest.raises(jsonschema.ValidationError):
             schema.validate(nope)
+
+
+class TestV1_0_0NamedAreas(object):
+    def test_lazy_loading(self):
+        with patch.object(
+            v1_0_0Schema, 'load_cached_geojson', return_value={'Nowhere': []}
+        ) as load_mock:
+            schema = v1_0_0Schema()
+            assert load_mock.call_count == 0
+            assert schema.geojson['marine'] == {'Nowhere': []}
+            assert schema.geojson['marine'] == {'Nowhere': []}
+            assert load_mock.call_count == 1
+            assert set(schema.geojson) == {'country', 'marine', 'geography'}
+
+    def test_cached_geojson(self, tmp_path):
+        filename = '50m-marine-regions-v4.1.0.geojson'
+        expected = v1_0_0Schema.load_geojson(filename, ('name',))
+        with patch(
+            'ckanext.versioned_datastore.lib.query.schemas.v1_0_0.get_geojson_cache_dir',
+            return_value=str(tmp_path),
+        ):
+            assert v1_0_0Schema.load_cached_geojson(filename, ('name',)) == expected
+            assert len(list(tmp_path.glob('*.json'))) == 1
+            with patch.object(v1_0_0Schema, 'load_geojson') as load_mock:
+                assert v1_0_0Schema.load_cached_geojson(filename, ('name',)) == expected
+                assert load_mock.call_count == 0
+
+    def test_cached_geojson_failure(self, tmp_path):
+        filename = '50m-marine-regions-v4.1.0.geojson'
+        lookup = {'Nowhere': [[[[0, 0], [1, 0], [0, 0]]]]}
+        with patch(
+            'ckanext.versioned_datastore.lib.query.schemas.v1_0_0.get_geojson_cache_dir',
+            return_value=str(tmp_path),
+        ), patch.object(v1_0_0Schema, 'load_geojson', return_value=lookup), patch(
+            'json.dump', side_effect=ValueError('nope')
+        ):
+            assert v1_0_0Schema.load_cached_geojson(filename, ('name',)) == lookup
+        # the temporary file is cleaned up and nothing is cached
+        assert list(tmp_path.iterdir()) == []
+
+    def test_hash_settings(self):
+        schema = v1_0_0Schema()
+        named = {'filters': {'and': [{'geo_named_area': {'country': 'Curaçao'}}]}}
+        other = {'search': 'beans'}
+        default_hashes = schema.hash(named), schema.hash(other)
+        with patch(
+            'ckanext.versioned_datastore.lib.query.schemas.v1_0_0.get_named_area_tolerance',
+            return_value=0.1,
+        ):
+            assert schema.get_settings() == (None, 0.1)
+            # the tolerance changes the shape searched for named areas
+            assert schema.hash(named) != default_hashes[0]
+            assert schema.hash(other) == default_hashes[1]
+
+    def test_hash_index(self):
+        schema = v1_0_0Schema()
+        named = {'filters': {'and': [{'geo_named_area': {'country': 'Curaçao'}}]}}
+        default_hash = schema.hash(named)
+        with patch(
+            'ckanext.versioned_datastore.lib.query.schemas.v1_0_0.get_named_area_index',
+            return_value='named-areas',
+        ):
+            assert schema.get_settings() == ('named-areas', 0)
+            # the indexed shapes match the same records, so the hash doesn't change
+            assert schema.hash(named) == default_hash
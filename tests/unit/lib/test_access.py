@@ -0,0 +1,58 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.versioned_datastore.lib import access
+
+
+@pytest.fixture
+def empty_cache():
+    with patch.object(access, '_cache', None):
+        yield
+
+
+def patch_generation(generation):
+    return patch.object(access, 'get_generation', return_value=generation)
+
+
+@pytest.mark.usefixtures('empty_cache')
+class TestGetCached:
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.access_cache_size', '10')
+    def test_repeat_uses_cache(self):
+        load = MagicMock(return_value={'a': True})
+        with patch_generation(1):
+            assert access.get_cached('user', load) == {'a': True}
+            assert access.get_cached('user', load) == {'a': True}
+        assert load.call_count == 1
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.access_cache_size', '10')
+    def test_users_are_separate(self):
+        load = MagicMock(return_value={'a': True})
+        with patch_generation(1):
+            access.get_cached('user1', load)
+            access.get_cached('user2', load)
+        assert load.call_count == 2
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.access_cache_size', '10')
+    def test_generation_change_invalidates(self):
+        load = MagicMock(return_value={'a': True})
+        with patch_generation(1):
+            access.get_cached('user', load)
+        with patch_generation(2):
+            access.get_cached('user', load)
+        assert load.call_count == 2
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.access_cache_size', '10')
+    def test_generation_failure_skips_cache(self):
+        load = MagicMock(return_value={'a': True})
+        with patch.object(access, 'get_generation', side_effect=Exception('nope')):
+            access.get_cached('user', load)
+            access.get_cached('user', load)
+        assert load.call_count == 2
+
+    def test_disabled_by_default(self):
+        load = MagicMock(return_value={'a': True})
+        with patch_generation(1):
+            access.get_cached('user', load)
+            access.get_cached('user', load)
+        assert load.call_count == 2
@@ -0,0 +1,133 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.versioned_datastore.lib import status, utils
+from ckanext.versioned_datastore.lib.importing import tasks
+
+
+class TestGetVersions:
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_loads_once(self):
+        load = MagicMock(return_value={'a': 4})
+        assert status.get_versions(['a', 'b'], load) == {'a': 4, 'b': None}
+        assert status.get_versions(['a', 'b'], load) == {'a': 4, 'b': None}
+        assert load.call_count == 1
+
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_set_version(self):
+        load = MagicMock(return_value={'a': 4})
+        status.get_versions(['a'], load)
+        status.set_version('a', 6)
+        status.set_version('b', 2)
+        assert status.get_versions(['a', 'b'], load) == {'a': 6, 'b': 2}
+        status.set_version('a', None)
+        assert status.get_versions(['a', 'b'], load) == {'a': None, 'b': 2}
+        assert load.call_count == 1
+
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_set_version_before_load(self):
+        status.set_version('a', 6)
+        load = MagicMock(return_value={'a': 4})
+        assert status.get_versions(['a'], load) == {'a': 4}
+
+    def test_set_version_failure(self):
+        with patch.object(status, 'connect_to_redis', side_effect=Exception('nope')):
+            # shouldn't raise
+            status.set_version('a', 6)
+
+    def test_clear_failure(self):
+        with patch.object(status, 'connect_to_redis', side_effect=Exception('nope')):
+            # shouldn't raise
+            status.clear()
+
+
+class TestGetDatastoreStatuses:
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_statuses(self):
+        with patch.object(utils, 'load_index_versions', return_value={'a': 4}):
+            assert utils.get_datastore_statuses(['a', 'b']) == {'a': True, 'b': False}
+
+    @pytest.mark.usefixtures('with_fake_redis')
+    def test_is_datastore_resource(self):
+        database = MagicMock()
+        with patch.object(utils, 'load_index_versions', return_value={'a': 4}) as load:
+            with patch.object(utils, 'get_database', return_value=database):
+                assert utils.is_datastore_resource('a')
+                assert not utils.is_datastore_resource('b')
+                # the versions are reloaded if they've been cleared
+                status.clear()
+                load.return_value = {'a': 4, 'b': 1}
+                assert utils.is_datastore_resource('b')
+        assert load.call_count == 2
+        # Elasticsearch is only checked directly when redis isn't available
+        assert not database.get_elasticsearch_version.called
+
+    def test_redis_failure(self):
+        database = MagicMock()
+        database.get_elasticsearch_version.return_value = 3
+        with patch.object(status, 'connect_to_redis', side_effect=Exception('nope')):
+            with patch.object(utils, 'get_database', return_value=database):
+                assert utils.get_datastore_statuses(['a']) == {'a': True}
+
+
+class TestSyncResourceTask:
+    def test_failure_clears_versions(self, with_fake_redis, tmp_path):
+        status.get_versions(['a'], MagicMock(return_value={'a': 4}))
+        database = MagicMock()
+        database.get_elasticsearch_version.return_value = 4
+        database.get_committed_version.return_value = 5
+        database.sync.side_effect = Exception('oh no')
+        task = tasks.SyncResourceTask({'id': 'a', 'package_id': 'p'})
+        with patch.object(tasks, 'get_database', return_value=database):
+            with patch.object(tasks.ImportStats, 'track'):
+                with pytest.raises(Exception, match='oh no'):
+                    task.run(tmp_path)
+        assert status.VERSIONS_KEY not in with_fake_redis.values
+
+
+class TestLoadIndexVersions:
+    def test_pages_and_merges(self):
+        client = MagicMock()
+        client.search.side_effect = [
+            {
+                'aggregations': {
+                    'indexes': {
+                        'buckets': [
+                            {
+                                'key': {'index': 'data-a-latest'},
+                                'version': {'value': 5.0},
+                                'next': {'value': None},
+                            },
+                            {
+                                'key': {'index': 'data-a-arc-0'},
+                                'version': {'value': 1.0},
+                                'next': {'value': 7.0},
+                            },
+                        ],
+                        'after_key': {'index': 'data-a-latest'},
+                    }
+                }
+            },
+            {
+                'aggregations': {
+                    'indexes': {
+                        'buckets': [
+                            {
+                                'key': {'index': 'data-b-latest'},
+                                'version': {'value': 2.0},
+                                'next': {'value': None},
+                            },
+                            {
+                                'key': {'index': 'not-a-resource'},
+                                'version': {'value': 2.0},
+                                'next': {'value': None},
+                            },
+                        ],
+                    }
+                }
+            },
+        ]
+        with patch.object(utils, 'es_client', return_value=client):
+            assert utils.load_index_versions() == {'a': 7, 'b': 2}
+        assert client.search.call_count == 2
@@ -1,3 +1,5 @@
+import time
+
 import pytest
 from mock import MagicMock
 from splitgill.model import Record
@@ -11,6 +13,7 @@ from ckanext.versioned_datastore.lib.utils import (
     is_datastore_only_resource,
     is_datastore_resource,
     is_ingestible,
+    map_resources,
 )
 
 
@@ -61,3 +64,49 @@ def test_is_ingestible():
     assert not is_ingestible({'format': 'csv', 'url': None})
     # if there's no format and the resource is not datastore only then it is not ingestible
     assert not is_ingestible({'format': None, 'url': 'http://banana.com/test.csv'})
+
+
+class TestMapResources:
+    def test_results_in_order(self):
+        results = map_resources(lambda resource_id: resource_id * 2, ['a', 'b', 'c'])
+        assert list(results.items()) == [('a', 'aa'), ('b', 'bb'), ('c', 'cc')]
+
+    def test_ignore(self):
+        def function(resource_id):
+            if resource_id == 'b':
+                raise KeyError(resource_id)
+            return resource_id
+
+        assert map_resources(function, ['a', 'b'], ignore=(KeyError,)) == {'a': 'a'}
+        with pytest.raises(KeyError):
+            map_resources(function, ['a', 'b'])
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.resource_timeout', '0.2')
+    def test_timeout(self):
+        def function(resource_id):
+            if resource_id == 'slow':
+                time.sleep(1)
+            return resource_id
+
+        start = time.monotonic()
+        with pytest.raises(TimeoutError, match='slow'):
+            map_resources(function, ['a', 'slow', 'b'])
+        assert time.monotonic() - start < 1
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.resource_timeout', '0.2')
+    def test_ignore_timeout(self):
+        def function(resource_id):
+            if resource_id == 'slow':
+                time.sleep(1)
+            return resource_id
+
+        start = time.monotonic()
+        results = map_resources(function, ['a', 'slow', 'b'], ignore=(TimeoutError,))
+        assert results == {'a': 'a', 'b': 'b'}
+        assert time.monotonic() - start < 1
+
+    @pytest.mark.ckan_config('ckanext.versioned_datastore.resource_concurrency', '1')
+    def test_sequential(self):
+        function = MagicMock(side_effect=lambda resource_id: resource_id)
+        assert map_resources(function, ['a', 'b']) == {'a': 'a', 'b': 'b'}
+        assert function.call_count == 2
@@ -0,0 +1,150 @@
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.versioned_datastore.logic.multi import action as multi_action
+from ckanext.versioned_datastore.logic.multi.action import vds_multi_batch
+
+
+@pytest.fixture
+def batch():
+    """
+    Patches the datastore resource checks, the access check, and the creation and
+    running of the searches so that vds_multi_batch can be called directly. The
+    schemas and formatters of the batchable actions are left as they are.
+    """
+    public_resources = {'r1': True, 'r2': True, 'r3': True}
+    validators = 'ckanext.versioned_datastore.logic.validators'
+    actions = {
+        name: (schema, MagicMock(side_effect=lambda params: params), formatter)
+        for name, (schema, _, formatter) in multi_action.batch_actions.items()
+    }
+    with patch(
+        f'{validators}.get_public_resources', return_value=public_resources
+    ), patch(
+        f'{validators}.check_datastore_resource_id', return_value=False
+    ), patch.dict(multi_action.batch_actions, actions), patch.object(
+        toolkit, 'check_access'
+    ) as check_access, patch.object(multi_action, 'run_searches') as run_searches:
+        yield check_access, run_searches
+
+
+def count_response(resource_ids, total):
+    return MagicMock(
+        count=total,
+        request=MagicMock(query=MagicMock(resource_ids=resource_ids)),
+        aggs={'counts': {'buckets': []}},
+    )
+
+
+def query_response(total):
+    return MagicMock(
+        count=total, next_after=None, hits=[], request=MagicMock(pit=False)
+    )
+
+
+class TestMultiBatch:
+    def test_invalid_action(self, batch):
+        check_access, run_searches = batch
+        requests = [
+            {'action': 'vds_multi_count', 'params': {'resource_ids': ['r1']}},
+            {'action': 'vds_multi_fields', 'params': {'resource_ids': ['r1']}},
+        ]
+        with pytest.raises(toolkit.ValidationError) as e:
+            vds_multi_batch({}, requests)
+        assert e.value.error_dict == {
+            'requests': ['Invalid action at position 1: vds_multi_fields']
+        }
+        assert not run_searches.called
+
+    def test_invalid_params(self, batch):
+        check_access, run_searches = batch
+        requests = [
+            {'action': 'vds_multi_count', 'params': {'resource_ids': ['r1']}},
+            # stats requests need a field
+            {'action': 'vds_multi_stats', 'params': {'resource_ids': ['r2']}},
+        ]
+        with pytest.raises(toolkit.ValidationError) as e:
+            vds_multi_batch({}, requests)
+        assert 'field' in e.value.error_dict
+        assert check_access.call_count == 1
+        assert not run_searches.called
+
+    def test_invalid_resource_ids(self, batch):
+        check_access, run_searches = batch
+        requests = [
+            {'action': 'vds_multi_count', 'params': {'resource_ids': ['r1']}},
+            {'action': 'vds_multi_count', 'params': {'resource_ids': ['not-a-vds']}},
+        ]
+        with pytest.raises(toolkit.ValidationError) as e:
+            vds_multi_batch({}, requests)
+        assert 'resource_ids' in e.value.error_dict
+        assert not run_searches.called
+
+    def test_access_checked_per_request(self, batch):
+        check_access, run_searches = batch
+        run_searches.side_effect = lambda requests: [
+            count_response(['r1'], 1),
+            query_response(2),
+        ]
+        requests = [
+            {'action': 'vds_multi_count', 'params': {'resource_ids': ['r1']}},
+            {
+                'action': 'vds_multi_query',
+                'params': {'resource_ids': ['r2', 'r3'], 'size': 5},
+            },
+        ]
+        vds_multi_batch({'user': 'someone', 'schema': {}}, requests)
+
+        assert check_access.call_args_list == [
+            call('vds_multi_count', {'user': 'someone'}, {'resource_ids': ['r1']}),
+            call(
+                'vds_multi_query',
+                {'user': 'someone'},
+                {'resource_ids': ['r2', 'r3'], 'size': 5},
+            ),
+        ]
+
+    def test_access_denied(self, batch):
+        check_access, run_searches = batch
+
+        def deny(action_name, context, params):
+            if 'r2' in params['resource_ids']:
+                raise toolkit.NotAuthorized()
+
+        check_access.side_effect = deny
+        requests = [
+            {'action': 'vds_multi_count', 'params': {'resource_ids': ['r1']}},
+            {'action': 'vds_multi_count', 'params': {'resource_ids': ['r2']}},
+        ]
+        with pytest.raises(toolkit.NotAuthorized):
+            vds_multi_batch({}, requests)
+        assert not run_searches.called
+
+    def test_response_order(self, batch):
+        check_access, run_searches = batch
+        run_searches.side_effect = lambda requests: [
+            query_response(3),
+            count_response(['r1'], 5),
+            query_response(7),
+        ]
+        requests = [
+            {'action': 'vds_multi_query', 'params': {'resource_ids': ['r3']}},
+            {'action': 'vds_multi_count', 'params': {'resource_ids': ['r1']}},
+            {'action': 'vds_multi_query', 'params': {'resource_ids': ['r2']}},
+        ]
+        results = vds_multi_batch({}, requests)
+
+        # the search requests are run in the order they were given in
+        search_requests = run_searches.call_args.args[0]
+        assert [request['resource_ids'] for request in search_requests] == [
+            ['r3'],
+            ['r1'],
+            ['r2'],
+        ]
+        assert results == [
+            {'total': 3, 'after': None, 'records': []},
+            {'total': 5, 'counts': {'r1': 0}},
+            {'total': 7, 'after': None, 'records': []},
+        ]